@@ -1,13 +1,13 @@
 {
     "name": "Factura Electrónica CR Hacienda Connector",
     "summary": "Integra Odoo 19 con Hacienda Costa Rica (Recepción v4.4)",
-    "version": "19.0.5.0.7",
+    "version": "19.0.5.0.10",
     "category": "Accounting",
     "license": "LGPL-3",
     "author": "FenixCR Solutions",
     "icon": "/l10n_cr_einvoice/static/description/Gemini_Generated_Image_hs6p77hs6p77hs6p.png",
     "images": ["static/description/Gemini_Generated_Image_hs6p77hs6p77hs6p.png"],
-    "depends": ["account", "product", "uom"],
+    "depends": ["account", "product", "uom", "bus"],
     "external_dependencies": {
         "python": ["requests", "lxml", "cryptography"],
     },
@@ -20,15 +20,22 @@
         "views/account_move_views.xml",
         "views/account_payment_term_views.xml",
         "views/fp_electronic_document_views.xml",
+        "views/fp_hacienda_reconciliation_views.xml",
         "views/account_tax_views.xml",
         "views/account_journal_views.xml",
         "views/account_invoice_report_views.xml",
         "views/product_template_views.xml",
         "views/uom_uom_views.xml",
         "views/fp_catalog_views.xml",
+        "wizard/fp_mass_action_wizard_views.xml",
         "data/mail_template_data.xml",
         "data/ir_cron_data.xml",
     ],
+    "assets": {
+        "web.assets_backend": [
+            "l10n_cr_einvoice/static/src/js/fp_status_bus.js",
+        ],
+    },
     "installable": True,
     "application": True,
 }
@@ -0,0 +1,38 @@
+import json
+import logging
+
+from odoo import http
+from odoo.http import request
+
+_logger = logging.getLogger(__name__)
+
+FP_CALLBACK_ROUTE = "/l10n_cr_einvoice/hacienda/callback"
+
+
+class FpHaciendaCallbackController(http.Controller):
+    @http.route(
+        f"{FP_CALLBACK_ROUTE}/<string:token>",
+        type="http",
+        auth="public",
+        methods=["POST"],
+        csrf=False,
+        save_session=False,
+    )
+    def fp_hacienda_callback(self, token, **kwargs):
+        """Receive the status notification Hacienda posts to ``callbackUrl``."""
+        company = request.env["res.company"].sudo().search([("fp_hacienda_callback_token", "=", token)], limit=1)
+        if not token or not company:
+            return request.make_json_response({"error": "not found"}, status=404)
+
+        try:
+            response_data = json.loads(request.httprequest.get_data() or b"{}")
+        except ValueError:
+            return request.make_json_response({"error": "invalid json"}, status=400)
+        if not isinstance(response_data, dict) or not response_data.get("clave"):
+            return request.make_json_response({"error": "missing clave"}, status=400)
+
+        move = request.env["account.move"].sudo().with_company(company)._fp_process_hacienda_callback(company, response_data)
+        if not move:
+            _logger.warning("Callback de Hacienda para clave desconocida %s", response_data.get("clave"))
+            return request.make_json_response({"error": "unknown clave"}, status=404)
+        return request.make_json_response({"status": "ok"})
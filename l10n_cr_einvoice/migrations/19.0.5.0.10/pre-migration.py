@@ -0,0 +1,23 @@
+from odoo.tools.sql import column_exists
+
+
+def _init_queue_priority(cr):
+    # Se crea la columna antes de cargar el modelo para no recalcular todos los asientos.
+    if column_exists(cr, "account_move", "fp_queue_priority"):
+        return
+    cr.execute("ALTER TABLE account_move ADD COLUMN fp_queue_priority varchar")
+    cr.execute(
+        """
+        UPDATE account_move
+           SET fp_queue_priority = CASE fp_document_type
+                                       WHEN 'TE' THEN 'high'
+                                       WHEN 'FEC' THEN 'low'
+                                       ELSE 'normal'
+                                   END
+         WHERE fp_is_electronic_invoice
+        """
+    )
+
+
+def migrate(cr, version):
+    _init_queue_priority(cr)
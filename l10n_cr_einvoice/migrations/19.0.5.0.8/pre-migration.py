@@ -0,0 +1,20 @@
+from odoo.tools.sql import column_exists
+
+
+def _copy_api_timeout_to_read_timeout(cr):
+    table = "res_company"
+    if not column_exists(cr, table, "fp_api_timeout"):
+        return
+    if not column_exists(cr, table, "fp_api_read_timeout"):
+        cr.execute(f"ALTER TABLE {table} ADD COLUMN fp_api_read_timeout integer")
+    cr.execute(
+        f"""
+        UPDATE {table}
+           SET fp_api_read_timeout = fp_api_timeout
+         WHERE fp_api_read_timeout IS NULL
+        """
+    )
+
+
+def migrate(cr, version):
+    _copy_api_timeout_to_read_timeout(cr)
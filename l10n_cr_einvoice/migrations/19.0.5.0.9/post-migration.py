@@ -0,0 +1,29 @@
+def _backfill_pipeline_stage(cr):
+    # El orden importa: cada documento toma la primera etapa que le corresponde.
+    stage_conditions = [
+        ("notified", "fp_invoice_status = 'accepted' AND fp_email_sent"),
+        ("accepted", "fp_invoice_status = 'accepted'"),
+        ("rejected", "fp_invoice_status = 'rejected'"),
+        ("polling", "fp_invoice_status = 'sent'"),
+        ("queued", "fp_api_state = 'pending' AND fp_xml_attachment_id IS NOT NULL"),
+        ("signed", "fp_xml_attachment_id IS NOT NULL"),
+        ("to_sign", "fp_external_id IS NOT NULL"),
+    ]
+    for stage, condition in stage_conditions:
+        cr.execute(
+            f"""
+            UPDATE account_move
+               SET fp_pipeline_stage = %s,
+                   fp_pipeline_stage_date = COALESCE(write_date, create_date)
+             WHERE fp_pipeline_stage IS NULL
+               AND fp_is_electronic_invoice
+               AND state = 'posted'
+               AND move_type IN ('out_invoice', 'out_refund', 'in_invoice')
+               AND {condition}
+            """,
+            [stage],
+        )
+
+
+def migrate(cr, version):
+    _backfill_pipeline_stage(cr)
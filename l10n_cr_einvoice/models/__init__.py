@@ -1,5 +1,10 @@
 from . import fp_catalogs
 from . import fp_exoneration
+from . import fp_hacienda_token
+from . import fp_hacienda_transport_state
+from . import fp_cron_run
+from . import fp_pipeline_event
+from . import fp_hacienda_reconciliation
 from . import account_journal
 from . import account_move
 from . import account_tax
@@ -1,5 +1,7 @@
 from odoo import fields, models
 
+from .fp_pipeline_event import FP_QUEUE_PRIORITIES
+
 
 class AccountJournal(models.Model):
     _inherit = "account.journal"
@@ -8,3 +10,9 @@ class AccountJournal(models.Model):
         string="FE 4.4",
         help="Si está activo, las facturas de este diario mostrarán campos y acciones de FE.",
     )
+    fp_queue_priority = fields.Selection(
+        FP_QUEUE_PRIORITIES,
+        string="Prioridad de envío FE",
+        help="Carril en el que se envían a Hacienda los documentos de este diario. "
+        "Si se deja vacío se usa la prioridad del tipo de comprobante (tiquetes alta, compras baja).",
+    )
@@ -1,70 +1,75 @@
+import asyncio
 import base64
+import functools
 import hashlib
 import json
 import random
+import threading
+import time
 import uuid
+from collections import Counter, deque
 import logging
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from json import JSONDecodeError
 from urllib.parse import urlparse
 from xml.etree import ElementTree as ET
 
 import requests
+from psycopg2 import errors as pg_errors
 from markupsafe import Markup, escape
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import pkcs12
-from lxml import etree as LET
 
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError, ValidationError
 
+from ..tools import hacienda_transport
+from ..tools import fe_document
+from ..tools import xml_signer
+from ..tools.fe_document import XML_DOCUMENT_SPECS
+from .fp_pipeline_event import FP_DOCUMENT_TYPE_PRIORITIES, FP_PIPELINE_STAGES, FP_QUEUE_PRIORITIES
+
 _logger = logging.getLogger(__name__)
 
-XML_DOCUMENT_SPECS = {
-    "FE": {
-        "root": "FacturaElectronica",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronica",
-        "xsd": "facturaElectronica.xsd",
-    },
-    "NC": {
-        "root": "NotaCreditoElectronica",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/notaCreditoElectronica",
-        "xsd": "notaCreditoElectronica.xsd",
-    },
-    "ND": {
-        "root": "NotaDebitoElectronica",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/notaDebitoElectronica",
-        "xsd": "notaDebitoElectronica.xsd",
-    },
-    "FEE": {
-        "root": "FacturaElectronicaExportacion",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronicaExportacion",
-        "xsd": "facturaElectronicaExportacion.xsd",
-    },
-    "TE": {
-        "root": "TiqueteElectronico",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/tiqueteElectronico",
-        "xsd": "tiqueteElectronico.xsd",
-    },
-    "FEC": {
-        "root": "FacturaElectronicaCompra",
-        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronicaCompra",
-        "xsd": "facturaElectronicaCompra.xsd",
-    },
-}
-DS_XML_NS = "http://www.w3.org/2000/09/xmldsig#"
-XADES_XML_NS = "http://uri.etsi.org/01903/v1.3.2#"
-XADES_SIGNATURE_POLICY_IDENTIFIER = (
-    "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/"
-    "Resoluci%C3%B3n_General_sobre_disposiciones_t%C3%A9cnicas_comprobantes_electr%C3%B3nicos_para_efectos_tributarios.pdf"
-)
-XADES_SIGNATURE_POLICY_DESCRIPTION = "Política de firma para comprobantes electrónicos de Costa Rica"
-XADES_SIGNATURE_POLICY_HASH_ALGORITHM = "http://www.w3.org/2001/04/xmlenc#sha256"
-XADES_SIGNATURE_POLICY_HASH = "DWxin1xWOeI8OuWQXazh4VjLWAaCLAA954em7DMh0h8="
 CR_TIMEZONE = ZoneInfo("America/Costa_Rica")
 
+# Códigos HTTP de Hacienda que indican una falla transitoria y justifican reintentar.
+FP_RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Tope (segundos) del retraso entre reintentos automáticos.
+FP_RETRY_MAX_DELAY = 6 * 3600
+
+# Espera (segundos) antes de cada consulta de estado tras el envío; luego se consulta cada hora.
+FP_CONSULT_BACKOFF = (10, 30, 120, 600)
+FP_CONSULT_MAX_INTERVAL = 3600
+
+# Comprobantes por página al recorrer el listado de Hacienda.
+FP_LISTING_PAGE_SIZE = 50
+
+# Documentos procesados por los crons FE entre limpiezas de la caché del ORM.
+FP_CRON_CHUNK_SIZE = 25
+
+# Duración (segundos) del arriendo con el que un cron reclama un documento FE.
+FP_LEASE_SECONDS = 15 * 60
+
+# Caché de tokens OAuth de Hacienda por proceso, indexada por
+# (base de datos, URL de token, client_id, usuario). Respaldada por ``fp.hacienda.token``.
+_FP_TOKEN_CACHE = {}
+_FP_TOKEN_KEY_LOCKS = {}
+_FP_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+class FpHaciendaApiError(UserError):
+    """Failure talking to Hacienda, classified as retryable or terminal."""
+
+    def __init__(self, message, retryable=False, status_code=None, detail=None, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+        self.detail = detail
+        # Segundos que Hacienda pidió esperar (429 / Retry-After): se difiere sin contar intento.
+        self.retry_after = retry_after
+
+
 class AccountMove(models.Model):
     _inherit = "account.move"
 
@@ -188,8 +193,17 @@ class AccountMove(models.Model):
             and move.state == "posted"
             and not move.fp_xml_attachment_id
         )
-        for move in electronic_moves:
-            move._fp_generate_and_sign_xml_attachment()
+        # El campo es dependiente de la compañía: se lee en la compañía de cada documento, no en env.company.
+        deferred_moves = electronic_moves.filtered(
+            lambda move: move.company_id.with_company(move.company_id).fp_deferred_signing
+        )
+        for move in deferred_moves:
+            # Solo se reservan consecutivo y clave; el XML lo firma el cron en lotes.
+            move._fp_build_clave()
+        deferred_moves._fp_set_pipeline_stage("to_sign")
+        (electronic_moves - deferred_moves)._fp_generate_and_sign_xml_attachments()
+        if deferred_moves:
+            self.env.ref("l10n_cr_einvoice.ir_cron_fp_sign_pending_documents")._trigger()
         return moves
 
     def action_invoice_sent(self):
@@ -339,6 +353,7 @@ class AccountMove(models.Model):
                 mail.write({"attachment_ids": [(4, attachment_id) for attachment_id in attachment_ids]})
             mail.send()
         self.fp_email_sent = True
+        self._fp_set_pipeline_stage("notified")
         return True
 
     def _reverse_moves(self, default_values_list=None, cancel=False):
@@ -496,7 +511,7 @@ class AccountMove(models.Model):
         help="Detalle del motivo de referencia (Razon).",
         copy=False,
     )
-    fp_external_id = fields.Char(string="Clave Hacienda", copy=False)
+    fp_external_id = fields.Char(string="Clave Hacienda", copy=False, index=True)
     fp_consecutive_number = fields.Char(string="Consecutivo Hacienda", copy=False, readonly=True)
     fp_xml_attachment_id = fields.Many2one("ir.attachment", string="Factura XML", copy=False)
     fp_xml_signed_digest = fields.Char(string="Digest XML firmado", copy=False, readonly=True)
@@ -517,10 +532,81 @@ class AccountMove(models.Model):
             ("sent", "Enviado"),
             ("done", "Procesado"),
             ("error", "Error"),
+            ("dead", "Reintentos agotados"),
         ],
         default="pending",
         copy=False,
     )
+    fp_api_attempt_count = fields.Integer(
+        string="Intentos fallidos con Hacienda",
+        copy=False,
+        readonly=True,
+    )
+    fp_api_next_attempt_at = fields.Datetime(
+        string="Próximo reintento con Hacienda",
+        copy=False,
+        readonly=True,
+        index=True,
+    )
+    fp_next_consult_at = fields.Datetime(
+        string="Próxima consulta en Hacienda",
+        copy=False,
+        readonly=True,
+        index=True,
+    )
+    fp_consult_count = fields.Integer(
+        string="Consultas de estado realizadas",
+        copy=False,
+        readonly=True,
+    )
+    fp_api_last_error = fields.Text(
+        string="Último error con Hacienda",
+        copy=False,
+        readonly=True,
+    )
+    fp_lease_until = fields.Datetime(
+        string="Reservado para procesamiento hasta",
+        copy=False,
+        readonly=True,
+        help="Mientras esté vigente, un proceso en segundo plano está trabajando sobre el documento.",
+    )
+    fp_lease_token = fields.Char(copy=False, readonly=True)
+    fp_pipeline_stage = fields.Selection(FP_PIPELINE_STAGES, string="Etapa FE", copy=False, readonly=True)
+    fp_hacienda_unseen = fields.Boolean(
+        string="No registrado en Hacienda",
+        copy=False,
+        readonly=True,
+        help="La última conciliación no encontró este documento en el listado de comprobantes de Hacienda.",
+    )
+    fp_pipeline_stage_date = fields.Datetime(string="En la etapa desde", copy=False, readonly=True)
+    fp_pipeline_event_ids = fields.One2many("fp.pipeline.event", "move_id", string="Transiciones FE", readonly=True)
+    fp_queue_priority = fields.Selection(
+        FP_QUEUE_PRIORITIES,
+        string="Prioridad de envío FE",
+        compute="_compute_fp_queue_priority",
+        store=True,
+        readonly=False,
+        copy=False,
+        help="Carril de envío a Hacienda. Se toma del diario o del tipo de comprobante y puede cambiarse por documento.",
+    )
+
+    # Una cola indexada por etapa; los índices parciales no cargan los asientos que no son FE.
+    _fp_pipeline_stage_idx = models.Index("(fp_pipeline_stage, company_id) WHERE fp_pipeline_stage IS NOT NULL")
+    _fp_sign_queue_idx = models.Index("(company_id, id) WHERE fp_pipeline_stage = 'to_sign'")
+    _fp_send_queue_idx = models.Index(
+        "(fp_queue_priority, company_id, fp_api_next_attempt_at) WHERE fp_pipeline_stage = 'queued'"
+    )
+    _fp_consult_queue_idx = models.Index(
+        "(company_id, fp_next_consult_at) WHERE fp_pipeline_stage IN ('submitted', 'polling')"
+    )
+    _fp_notify_queue_idx = models.Index("(company_id, id) WHERE fp_pipeline_stage = 'accepted'")
+    fp_api_requested_by_id = fields.Many2one(
+        "res.users",
+        string="Solicitado por",
+        copy=False,
+        readonly=True,
+        help="Usuario que puso el documento en cola; recibe el aviso cuando cambia su estado en Hacienda.",
+    )
     fp_invoice_status = fields.Selection(
         [
             ("sent", "Enviada"),
@@ -536,6 +622,18 @@ class AccountMove(models.Model):
         default=False,
     )
 
+    @api.depends("fp_is_electronic_invoice", "journal_id.fp_queue_priority", "fp_document_type")
+    def _compute_fp_queue_priority(self):
+        for move in self:
+            if not move.fp_is_electronic_invoice:
+                move.fp_queue_priority = False
+                continue
+            move.fp_queue_priority = (
+                move.journal_id.fp_queue_priority
+                or FP_DOCUMENT_TYPE_PRIORITIES.get(move.fp_document_type)
+                or "normal"
+            )
+
     @api.depends("fp_response_xml_attachment_id", "fp_response_xml_attachment_id.datas")
     def _compute_fp_hacienda_detail_message(self):
         for move in self:
@@ -565,6 +663,7 @@ class AccountMove(models.Model):
             return False
 
     def action_fp_send_to_api(self):
+        self._fp_lock_for_processing()
         for move in self:
             if not move.fp_is_electronic_invoice:
                 raise UserError(_("El diario no está marcado como factura electrónica."))
@@ -576,41 +675,160 @@ class AccountMove(models.Model):
                 )
             if move.state != "posted":
                 raise UserError(_("La factura debe estar publicada antes de enviarse a Hacienda."))
-            move._fp_send_to_hacienda()
+        self._fp_enqueue_send()
+        return self._fp_queued_notification(_("Documento en cola de envío a Hacienda."))
+
+    def _fp_enqueue_send(self):
+        # El envío lo hace el cron en segundo plano; el formulario se actualiza por el bus.
+        self.write({"fp_api_next_attempt_at": False, "fp_api_requested_by_id": self.env.uid})
+        unsigned = self.filtered(lambda move: not move.fp_xml_attachment_id)
+        # Sin XML firmado pasan primero por el cron de firma, que los deja en cola de envío al adjuntarlo.
+        unsigned._fp_set_pipeline_stage("to_sign")
+        (self - unsigned)._fp_set_pipeline_stage("queued")
+        if unsigned:
+            self.env.ref("l10n_cr_einvoice.ir_cron_fp_sign_pending_documents")._trigger()
+        self.env.ref("l10n_cr_einvoice.ir_cron_fp_send_pending_documents")._trigger()
+
+    def _fp_enqueue_consult(self):
+        self.write(
+            {
+                "fp_next_consult_at": fields.Datetime.now(),
+                "fp_api_next_attempt_at": False,
+                "fp_api_requested_by_id": self.env.uid,
+            }
+        )
+        self.env.ref("l10n_cr_einvoice.ir_cron_fp_consult_pending_documents")._trigger()
 
     def action_fp_consult_api_document(self):
+        self._fp_lock_for_processing()
         for move in self:
-            if not move.fp_external_id:
-                raise UserError(_("La factura no tiene Clave para consultar estado en Hacienda."))
-            if move.fp_api_state in ("done", "error"):
-                raise UserError(_("La factura ya recibió una respuesta final de Hacienda."))
-
-            token = move._fp_get_hacienda_access_token()
-            response_data = move._fp_call_api(
-                endpoint=move._fp_get_hacienda_recepcion_endpoint(clave=move.fp_external_id),
-                payload=None,
-                timeout=move.company_id.fp_api_timeout,
-                token=token,
-                base_url=move.company_id.fp_hacienda_api_base_url,
-                method="GET",
-                params={"emisor": "".join(ch for ch in (move.company_id.vat or "") if ch.isdigit())},
+            move._fp_check_consultable()
+        # Nunca se consulta desde el worker web: todos los documentos pasan a la cola del cron de consulta.
+        self._fp_enqueue_consult()
+        return self._fp_queued_notification(_("Consulta de estado en cola."))
+
+    def _fp_queued_notification(self, message):
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "type": "info",
+                "message": message,
+                "sticky": False,
+                "next": {"type": "ir.actions.client", "tag": "soft_reload"},
+            },
+        }
+
+    def _fp_notify_status_change(self):
+        """Tell the user who queued the document (or its salesperson) that its FE status changed."""
+        for move in self:
+            user = move.fp_api_requested_by_id or move.invoice_user_id
+            if user:
+                user._bus_send(
+                    "l10n_cr_einvoice.fp_status",
+                    {
+                        "id": move.id,
+                        "fp_invoice_status": move.fp_invoice_status,
+                        "fp_api_state": move.fp_api_state,
+                    },
+                )
+
+    @api.model
+    def _fp_get_consult_blocking_rules(self):
+        """Return ``(reason, domain)`` pairs; a document matching any of them cannot be consulted.
+
+        Shared by the consult button and the mass action wizard so both accept the same documents.
+        """
+        return [
+            (_("La factura no tiene Clave para consultar estado en Hacienda."), [("fp_external_id", "=", False)]),
+            (
+                _("La factura ya recibió una respuesta final de Hacienda."),
+                [("fp_api_state", "in", ("done", "error", "dead"))],
+            ),
+        ]
+
+    def _fp_check_consultable(self):
+        self.ensure_one()
+        for reason, domain in self._fp_get_consult_blocking_rules():
+            if self.filtered_domain(domain):
+                raise UserError(reason)
+
+    def _fp_get_consult_params(self):
+        self.ensure_one()
+        return {"emisor": "".join(ch for ch in (self.company_id.vat or "") if ch.isdigit())}
+
+    def _fp_apply_hacienda_status(self, response_data):
+        self.ensure_one()
+        self._fp_reset_api_retry_state()
+        self._fp_store_hacienda_response_xml(response_data)
+        status = (response_data.get("ind-estado") or "").lower()
+        detail_message = self._fp_extract_hacienda_detail_message(response_data)
+        if status == "aceptado":
+            self.fp_invoice_status = "accepted"
+            self.fp_api_state = "done"
+            self._fp_post_hacienda_status_message(status_label=_("Aceptada"), detail_message=detail_message)
+            self._fp_set_pipeline_stage("accepted")
+            if self.with_company(self.company_id).company_id.fp_auto_send_email_when_accepted:
+                # El correo lo envía la etapa de notificación, fuera de la consulta.
+                self.env.ref("l10n_cr_einvoice.ir_cron_fp_notify_accepted_documents")._trigger()
+        elif status in ("rechazado", "error"):
+            self.fp_invoice_status = "rejected"
+            self.fp_api_state = "error"
+            self._fp_post_hacienda_status_message(status_label=_("Rechazada"), detail_message=detail_message)
+            self._fp_set_pipeline_stage("rejected")
+        elif status:
+            self.fp_invoice_status = "sent"
+            self._fp_post_hacienda_status_message(status_label=status.capitalize(), detail_message=detail_message)
+            self._fp_set_pipeline_stage("polling")
+        if self.fp_invoice_status == "sent":
+            self._fp_schedule_next_consult(self.fp_consult_count + 1)
+        else:
+            self.fp_next_consult_at = False
+
+    def _fp_schedule_next_consult(self, consult_count):
+        """Plan the next status consult following the backoff curve, capped at one hour."""
+        self.ensure_one()
+        delay = FP_CONSULT_BACKOFF[consult_count] if consult_count < len(FP_CONSULT_BACKOFF) else FP_CONSULT_MAX_INTERVAL
+        self.write(
+            {
+                "fp_consult_count": consult_count,
+                "fp_next_consult_at": fields.Datetime.now() + timedelta(seconds=delay),
+            }
+        )
+
+    @api.model
+    def _fp_trigger_consult_cron(self):
+        """Wake the consult cron when the earliest scheduled consult is due."""
+        next_move = self.search(
+            [*self._fp_get_consult_candidates_domain(), ("fp_next_consult_at", "!=", False)],
+            order="fp_next_consult_at",
+            limit=1,
+        )
+        if next_move:
+            self.env.ref("l10n_cr_einvoice.ir_cron_fp_consult_pending_documents")._trigger(
+                at=max(next_move.fp_next_consult_at, fields.Datetime.now())
             )
-            move._fp_store_hacienda_response_xml(response_data)
-            status = (response_data.get("ind-estado") or "").lower()
-            detail_message = move._fp_extract_hacienda_detail_message(response_data)
-            if status == "aceptado":
-                move.fp_invoice_status = "accepted"
-                move.fp_api_state = "done"
-                move._fp_post_hacienda_status_message(status_label=_("Aceptada"), detail_message=detail_message)
-                if move.company_id.fp_auto_send_email_when_accepted:
-                    move._fp_send_accepted_invoice_email()
-            elif status in ("rechazado", "error"):
-                move.fp_invoice_status = "rejected"
-                move.fp_api_state = "error"
-                move._fp_post_hacienda_status_message(status_label=_("Rechazada"), detail_message=detail_message)
-            elif status:
-                move.fp_invoice_status = "sent"
-                move._fp_post_hacienda_status_message(status_label=status.capitalize(), detail_message=detail_message)
+
+    @api.model
+    def _fp_process_hacienda_callback(self, company, response_data):
+        """Apply a status pushed by Hacienda to the move with that clave, if still awaiting it."""
+        move = self.search(
+            [("fp_external_id", "=", response_data["clave"]), ("company_id", "=", company.id)],
+            limit=1,
+        )
+        if not move:
+            return move
+        # Serializa con el cron de consulta: quien llegue segundo ve el documento ya resuelto.
+        self.env.cr.execute("SELECT id FROM account_move WHERE id = %s FOR UPDATE", [move.id])
+        move.invalidate_recordset()
+        if move._fp_is_awaiting_hacienda_status():
+            move._fp_apply_hacienda_status(response_data)
+            move._fp_notify_status_change()
+        return move
+
+    def _fp_is_awaiting_hacienda_status(self):
+        self.ensure_one()
+        return self.fp_invoice_status == "sent" and self.fp_api_state == "sent"
 
     def _fp_post_hacienda_status_message(self, status_label, detail_message=False):
         self.ensure_one()
@@ -664,21 +882,40 @@ class AccountMove(models.Model):
         token = self._fp_get_hacienda_access_token()
         self.fp_api_state = "sent"
 
-        self._fp_call_api(
-            endpoint=self._fp_get_hacienda_recepcion_endpoint(),
-            payload=payload,
-            timeout=company.fp_api_timeout,
-            token=token,
-            base_url=company.fp_hacienda_api_base_url,
-            method="POST",
-        )
+        try:
+            self._fp_call_api(
+                endpoint=self._fp_get_hacienda_recepcion_endpoint(),
+                payload=payload,
+                token=token,
+                base_url=company.fp_hacienda_api_base_url,
+                method="POST",
+            )
+        except FpHaciendaApiError as error:
+            # Si un envío anterior sí llegó (p. ej. se agotó el tiempo de lectura),
+            # Hacienda rechaza el duplicado: el documento ya está recibido.
+            if error.status_code != 400 or "ya fue recibido" not in (error.detail or "").lower():
+                raise
 
         self.fp_external_id = payload["clave"]
         self.fp_invoice_status = "sent"
         self.fp_email_sent = False
+        self.fp_hacienda_unseen = False
+        self._fp_reset_api_retry_state()
+        self._fp_set_pipeline_stage("submitted")
+        # Hacienda ya recibió el documento: en los crons se confirma de inmediato
+        # para que un error en la programación de la consulta o en el chatter no revierta el envío.
+        self._fp_commit_progress()
+        # La URL contiene el token secreto del callback: solo administradores pueden leerla.
+        if company.sudo().fp_hacienda_callback_url:
+            # Hacienda notificará el estado; la consulta queda solo como respaldo.
+            self._fp_schedule_next_consult(len(FP_CONSULT_BACKOFF) - 1)
+        elif company.fp_auto_consult_after_send:
+            # Hacienda casi nunca resuelve al instante: la primera consulta se agenda unos segundos después.
+            self._fp_schedule_next_consult(0)
+        else:
+            self.write({"fp_consult_count": 0, "fp_next_consult_at": False})
         self.message_post(body=_("Factura enviada directamente a Hacienda (Recepción v4.4)."))
-        if company.fp_auto_consult_after_send:
-            self.action_fp_consult_api_document()
+        self._fp_commit_progress()
 
     def _fp_refresh_signed_xml_if_outdated(self):
         self.ensure_one()
@@ -703,6 +940,16 @@ class AccountMove(models.Model):
             self.fp_external_id = False
             self._fp_generate_and_sign_xml_attachment()
 
+    def _fp_get_hacienda_token_cache_key(self):
+        self.ensure_one()
+        company = self.company_id
+        return (
+            self.env.cr.dbname,
+            (company.fp_hacienda_token_url or "").strip(),
+            company.fp_hacienda_client_id or self._fp_get_hacienda_client_id_default(),
+            company.fp_hacienda_username or "",
+        )
+
     def _fp_get_hacienda_access_token(self):
         self.ensure_one()
         company = self.company_id
@@ -718,39 +965,90 @@ class AccountMove(models.Model):
                 )
             )
 
-        data = {
-            "grant_type": "password",
-            "client_id": company.fp_hacienda_client_id or self._fp_get_hacienda_client_id_default(),
-            "username": company.fp_hacienda_username,
-            "password": company.fp_hacienda_password,
-        }
-        try:
-            response = requests.post(
-                token_url,
-                data=data,
-                timeout=company.fp_api_timeout,
+        cache_key = self._fp_get_hacienda_token_cache_key()
+        with _FP_TOKEN_CACHE_LOCK:
+            key_lock = _FP_TOKEN_KEY_LOCKS.setdefault(cache_key, threading.Lock())
+
+        # Un solo hilo por llave consulta el almacén compartido; el resto espera y
+        # reutiliza el valor recién guardado en la caché del proceso.
+        with key_lock:
+            entry = _FP_TOKEN_CACHE.get(cache_key)
+            if entry and entry["expires_at"] > time.time():
+                return entry["access_token"]
+
+            entry = self.env["fp.hacienda.token"]._fp_get_shared_token(
+                cache_key,
+                lambda refresh_token: self._fp_fetch_hacienda_token(token_url, cache_key[2], refresh_token),
             )
+            _FP_TOKEN_CACHE[cache_key] = entry
+            return entry["access_token"]
+
+    def _fp_fetch_hacienda_token(self, token_url, client_id, refresh_token=False):
+        self.ensure_one()
+        if refresh_token:
+            try:
+                return self._fp_request_hacienda_token(
+                    token_url,
+                    {
+                        "grant_type": "refresh_token",
+                        "client_id": client_id,
+                        "refresh_token": refresh_token,
+                    },
+                )
+            except UserError:
+                _logger.info("No se pudo renovar el token de Hacienda con refresh_token; se usará usuario y contraseña.")
+        return self._fp_request_hacienda_token(
+            token_url,
+            {
+                "grant_type": "password",
+                "client_id": client_id,
+                "username": self.company_id.fp_hacienda_username,
+                "password": self.company_id.fp_hacienda_password,
+            },
+        )
+
+    def _fp_request_hacienda_token(self, token_url, data):
+        self.ensure_one()
+        company = self.company_id
+        try:
+            response = company._fp_get_hacienda_transport().post(token_url, data=data, bucket="token")
+        except (hacienda_transport.HaciendaRateLimited, hacienda_transport.HaciendaCircuitOpen) as error:
+            self._fp_raise_api_connection_error(error)
         except requests.exceptions.Timeout as error:
-            raise UserError(_("Tiempo de espera agotado al autenticar con Hacienda.")) from error
+            raise FpHaciendaApiError(_("Tiempo de espera agotado al autenticar con Hacienda."), retryable=True) from error
         except requests.exceptions.RequestException as error:
             _logger.exception("Error de red autenticando contra Hacienda para la factura %s", self.name)
-            raise UserError(_("No fue posible conectar con Hacienda para autenticación OAuth.")) from error
+            raise FpHaciendaApiError(
+                _("No fue posible conectar con Hacienda para autenticación OAuth."), retryable=True
+            ) from error
 
         if response.status_code >= 400:
             preview = (response.text or "")[:200]
-            raise UserError(
+            raise FpHaciendaApiError(
                 _("Error autenticando contra Hacienda (%(status)s). Detalle: %(detail)s")
                 % {
                     "status": response.status_code,
                     "detail": preview or _("sin detalle"),
-                }
+                },
+                retryable=response.status_code in FP_RETRYABLE_STATUS_CODES,
+                status_code=response.status_code,
+                detail=preview,
+                retry_after=self._fp_get_response_retry_after(response),
             )
 
         response_data = self._fp_parse_json_response(response, response_context="autenticación")
-        access_token = response_data.get("access_token")
-        if not access_token:
+        if not response_data.get("access_token"):
             raise UserError(_("Hacienda no devolvió access_token."))
-        return access_token
+        return response_data
+
+    def _fp_invalidate_hacienda_access_token(self, token):
+        self.ensure_one()
+        cache_key = self._fp_get_hacienda_token_cache_key()
+        with _FP_TOKEN_CACHE_LOCK:
+            entry = _FP_TOKEN_CACHE.get(cache_key)
+            if entry and entry["access_token"] == token:
+                _FP_TOKEN_CACHE.pop(cache_key, None)
+        self.env["fp.hacienda.token"]._fp_invalidate_shared_token(cache_key, token)
 
     def _fp_get_hacienda_environment(self):
         self.ensure_one()
@@ -781,6 +1079,85 @@ class AccountMove(models.Model):
             return f"{endpoint}/{clave}" if endpoint else f"/{clave}"
         return endpoint or "/"
 
+    @api.model
+    def _fp_get_clave_issue_date(self, clave):
+        """Return the issue date (FechaEmision) encoded in ``clave``, or ``None`` if it is malformed."""
+        clave_date_token = (clave or "")[3:9]
+        if len(clave_date_token) != 6 or not clave_date_token.isdigit():
+            return None
+        try:
+            return datetime.strptime(clave_date_token, "%d%m%y").date()
+        except ValueError:
+            return None
+
+    def _fp_fetch_hacienda_listing(self, date_from, date_to):
+        """Return the claves Hacienda lists for the company between both dates.
+
+        Pages through ``/comprobantes`` once as emisor and once as receptor
+        (FEC purchases are listed under the company as receptor). The
+        endpoint has no date filter but lists the newest documents first, so
+        paging stops at the first page entirely older than ``date_from``.
+        """
+        self.ensure_one()
+        company = self.company_id
+        base_url = company._fp_get_hacienda_recepcion_root_url()
+        identification = self._fp_get_party_identification_payload(company.partner_id, company.vat)
+        if not identification:
+            raise UserError(_("Configure el tipo de identificación de la compañía para consultar el listado de Hacienda."))
+        taxpayer = f"{identification['tipoIdentificacion']}{identification['numeroIdentificacion']}"
+        claves = set()
+        for role in ("emisor", "receptor"):
+            offset = 0
+            while True:
+                # El token se toma del caché en cada página: si vence a mitad del listado,
+                # solo la página que recibió el 401 se repite.
+                entries = self._fp_call_api(
+                    endpoint="/comprobantes",
+                    payload=None,
+                    token=self._fp_get_hacienda_access_token(),
+                    base_url=base_url,
+                    method="GET",
+                    params={role: taxpayer, "offset": offset, "limit": FP_LISTING_PAGE_SIZE},
+                )
+                if not isinstance(entries, list):
+                    entries = []
+                page_dates = []
+                for entry in entries:
+                    try:
+                        issue_date = fields.Date.to_date((entry.get("fecha") or "")[:10] or None)
+                    except ValueError:
+                        issue_date = None
+                    if issue_date:
+                        page_dates.append(issue_date)
+                    if entry.get("clave") and (not issue_date or date_from <= issue_date <= date_to):
+                        claves.add(entry["clave"])
+                if len(entries) < FP_LISTING_PAGE_SIZE or (page_dates and max(page_dates) < date_from):
+                    break
+                offset += len(entries)
+        return claves
+
+    def _fp_mark_received_by_hacienda(self, message=None):
+        """Record in bulk that Hacienda holds these documents, so they move on to status polling."""
+        if not self:
+            return
+        self.write(
+            {
+                "fp_invoice_status": "sent",
+                "fp_api_state": "sent",
+                "fp_email_sent": False,
+                "fp_hacienda_unseen": False,
+                "fp_api_attempt_count": 0,
+                "fp_api_next_attempt_at": False,
+                "fp_api_last_error": False,
+                "fp_consult_count": 0,
+                "fp_next_consult_at": fields.Datetime.now(),
+            }
+        )
+        self._fp_set_pipeline_stage("submitted")
+        for move in self:
+            move.message_post(body=message or _("La conciliación con Hacienda confirmó que el documento fue recibido."))
+        self.env.ref("l10n_cr_einvoice.ir_cron_fp_consult_pending_documents")._trigger()
+
     def _fp_build_hacienda_payload(self):
         self.ensure_one()
         if not self.fp_xml_attachment_id or not self.fp_xml_attachment_id.datas:
@@ -815,16 +1192,85 @@ class AccountMove(models.Model):
         }
         if receptor_identificacion:
             payload["receptor"] = receptor_identificacion
+        callback_url = self.company_id.sudo().fp_hacienda_callback_url
+        if callback_url:
+            payload["callbackUrl"] = callback_url
         return payload
 
     def _fp_generate_and_sign_xml_attachment(self):
         self.ensure_one()
-        clave = self._fp_build_clave()
-        xml_text = self._fp_generate_invoice_xml(clave=clave)
-        signed_xml_text = self._fp_sign_xml(xml_text)
-        signed_xml_bytes = signed_xml_text.encode("utf-8")
+        self._fp_generate_and_sign_xml_attachments()
+
+    def _fp_generate_and_sign_xml_attachments(self):
+        """Generate, sign and attach the XML of every document, signing each company's documents as one batch."""
+        roots = self._fp_generate_xml_batch()
+        for company in self.company_id:
+            company_moves = self.filtered(lambda move: move.company_id == company)
+            company_roots = [root for move, root in zip(self, roots) if move.company_id == company]
+            for move, (signed_xml_bytes, digest) in zip(company_moves, company._fp_sign_xml_documents(company_roots)):
+                move._fp_attach_signed_xml(signed_xml_bytes, digest)
+
+    def _fp_generate_xml_batch(self):
+        """Build the unsigned XML trees of every document, in order, from data preloaded in batched reads."""
+        self._fp_prefetch_xml_data()
+        exonerations_by_move = self._fp_get_exonerations_by_move()
+        return [
+            move._fp_generate_invoice_xml(clave=move._fp_build_clave(), exonerations=exonerations_by_move[move.id])
+            for move in self
+        ]
+
+    def _fp_prefetch_xml_data(self):
+        """Load every field the XML builder reads for the whole recordset, one model at a time.
+
+        Without it each invoice, line, product, tax and partner is fetched
+        lazily as the tree is built; afterwards the builder only hits the cache.
+        """
+        self.fetch(
+            [
+                "company_id", "partner_id", "currency_id", "company_currency_id", "invoice_line_ids",
+                "invoice_date", "invoice_date_due", "invoice_currency_rate", "fp_document_type",
+                "fp_sale_condition", "fp_payment_method", "fp_economic_activity_code", "fp_external_id",
+                "fp_consecutive_number", "reversed_entry_id", "fp_reference_document_type",
+                "fp_reference_number", "fp_reference_issue_datetime", "fp_reference_code", "fp_reference_reason",
+            ]
+        )
+        lines = self.invoice_line_ids
+        lines.fetch(
+            [
+                "display_type", "name", "quantity", "price_unit", "price_subtotal", "price_total",
+                "product_id", "product_uom_id", "tax_ids",
+            ]
+        )
+        lines.product_id.fetch(["product_tmpl_id", "default_code"])
+        lines.product_id.product_tmpl_id.fetch(
+            [
+                "type", "default_code", "fp_cabys_code", "fp_cabys_code_id", "fp_commercial_code_type", "fp_health_registry_number",
+                "fp_medicine_presentation_code", "fp_tariff_heading", "fp_transport_vin_or_series",
+            ]
+        )
+        lines.product_uom_id.fetch(["name", "fp_unit_code"])
+        lines.tax_ids.fetch(
+            ["type_tax_use", "amount", "fp_tax_type", "fp_tax_code", "fp_tax_rate_code_iva", "fp_tax_rate"]
+        )
+        partners = self.partner_id | self.company_id.partner_id
+        partners.fetch(
+            [
+                "name", "vat", "phone", "email", "street", "city", "country_id", "state_id",
+                "fp_identification_type", "fp_economic_activity_id", "fp_use_exonerations",
+                "fp_province_id", "fp_canton_id", "fp_district_id", "fp_province_code", "fp_canton_code",
+                "fp_district_code", "fp_neighborhood_code",
+            ]
+        )
+        partners.country_id.fetch(["code", "phone_code"])
+        partners.state_id.fetch(["code"])
+        partners.fp_economic_activity_id.fetch(["code"])
+        for catalog in (partners.fp_province_id, partners.fp_canton_id, partners.fp_district_id):
+            catalog.fetch(["code"])
+
+    def _fp_attach_signed_xml(self, signed_xml_bytes, digest):
+        self.ensure_one()
         signed_xml_b64 = base64.b64encode(signed_xml_bytes)
-        xml_filename_prefix = self._fp_get_xml_filename_prefix(clave=clave)
+        xml_filename_prefix = self._fp_get_xml_filename_prefix(clave=self.fp_external_id)
         attachment = self.env["ir.attachment"].create(
             {
                 "name": f"{xml_filename_prefix}-firmado.xml",
@@ -835,8 +1281,37 @@ class AccountMove(models.Model):
                 "mimetype": "application/xml",
             }
         )
-        self.fp_xml_attachment_id = attachment
-        self.fp_xml_signed_digest = hashlib.sha256(signed_xml_bytes).hexdigest()
+        # Un error de firma anterior ya no aplica: se limpia junto con su espera y la reserva.
+        self.write(
+            {
+                "fp_xml_attachment_id": attachment.id,
+                "fp_xml_signed_digest": digest,
+                "fp_api_last_error": False,
+                "fp_api_next_attempt_at": False,
+                "fp_lease_until": False,
+                "fp_lease_token": False,
+            }
+        )
+        self._fp_set_pipeline_stage("signed")
+        if self.fp_api_state == "pending":
+            self._fp_set_pipeline_stage("queued")
+
+    def _fp_set_pipeline_stage(self, stage):
+        """Move the documents to ``stage``, stamping the transition in the stage log."""
+        moves = self.filtered(lambda move: move.fp_pipeline_stage != stage)
+        if not moves:
+            return
+        now = fields.Datetime.now()
+        self.env["fp.pipeline.event"].sudo().create(
+            [{"move_id": move.id, "previous_stage": move.fp_pipeline_stage, "stage": stage, "date": now} for move in moves]
+        )
+        moves.write({"fp_pipeline_stage": stage, "fp_pipeline_stage_date": now})
+
+    @api.model
+    def _fp_get_pipeline_queue_depth(self):
+        """Return the number of documents waiting in each pipeline stage."""
+        groups = self._read_group([("fp_pipeline_stage", "!=", False)], ["fp_pipeline_stage"], ["__count"])
+        return dict(groups)
 
     def _fp_ensure_signed_xml_integrity(self):
         self.ensure_one()
@@ -872,33 +1347,24 @@ class AccountMove(models.Model):
             raise UserError(_("Tipo de documento FE no soportado: %s") % (self.fp_document_type or ""))
         return spec
 
-    def _fp_generate_invoice_xml(self, clave=None):
+    def _fp_generate_invoice_xml(self, clave=None, exonerations=None):
+        """Build the unsigned document as an lxml tree; it is only serialized once signed."""
         self.ensure_one()
+        return fe_document.build_tree(self._fp_extract_document(clave=clave, exonerations=exonerations))
+
+    def _fp_extract_document(self, clave=None, exonerations=None):
+        """Read everything the v4.4 XML needs into an ORM-free ``FeDocument``.
+
+        ``exonerations`` are the candidate exonerations preloaded by
+        ``_fp_generate_xml_batch``; they are searched here when omitted.
+        """
+        self.ensure_one()
+        self._fp_get_xml_document_spec()
         issue_datetime = datetime.now(CR_TIMEZONE).replace(microsecond=0)
         clave = clave or self._fp_build_clave(issue_datetime=issue_datetime)
-        clave_date_token = (clave or "")[3:9]
-        if len(clave_date_token) == 6 and clave_date_token.isdigit():
-            try:
-                issue_date = datetime.strptime(clave_date_token, "%d%m%y").date()
-                issue_datetime = datetime.combine(issue_date, issue_datetime.time(), tzinfo=CR_TIMEZONE)
-            except ValueError:
-                pass
-        document_spec = self._fp_get_xml_document_spec()
-        namespace = document_spec["namespace"]
-        root = ET.Element(
-            document_spec["root"],
-            {
-                "xmlns": namespace,
-                "xmlns:ds": DS_XML_NS,
-                "xmlns:xsd": "http://www.w3.org/2001/XMLSchema",
-                "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-                "xsi:schemaLocation": f"{namespace} {namespace}/{document_spec['xsd']}",
-            },
-        )
-        ET.SubElement(root, "Clave").text = clave
-        if self.company_id.vat:
-            ET.SubElement(root, "ProveedorSistemas").text = "".join(ch for ch in self.company_id.vat if ch.isdigit())
-
+        issue_date = self._fp_get_clave_issue_date(clave)
+        if issue_date:
+            issue_datetime = datetime.combine(issue_date, issue_datetime.time(), tzinfo=CR_TIMEZONE)
         if self.fp_document_type == "FEC":
             emisor_partner = self.partner_id
             emisor_vat = self.partner_id.vat
@@ -918,71 +1384,26 @@ class AccountMove(models.Model):
             emisor_activity_code = self.fp_economic_activity_code
             receptor_activity_code = self.partner_id.fp_economic_activity_id.code if self.partner_id.fp_economic_activity_id else ""
 
-        if emisor_activity_code:
-            ET.SubElement(root, "CodigoActividadEmisor").text = emisor_activity_code
-        if receptor_activity_code:
-            ET.SubElement(root, "CodigoActividadReceptor").text = receptor_activity_code
-        ET.SubElement(root, "NumeroConsecutivo").text = self._fp_extract_consecutive_from_clave(clave)
-        ET.SubElement(root, "FechaEmision").text = issue_datetime.isoformat(timespec="seconds")
-
-        emisor = ET.SubElement(root, "Emisor")
-        ET.SubElement(emisor, "Nombre").text = emisor_name or ""
-        self._fp_append_identification_nodes(emisor, emisor_partner, emisor_vat, "emisor")
-        self._fp_append_location_nodes(emisor, emisor_partner, "emisor")
-        self._fp_append_contact_nodes(emisor, emisor_partner)
-
-        receptor = ET.SubElement(root, "Receptor")
-        ET.SubElement(receptor, "Nombre").text = receptor_name or ""
-        self._fp_append_identification_nodes(receptor, receptor_partner, receptor_vat, "receptor")
-        self._fp_append_location_nodes(receptor, receptor_partner, "receptor")
-        self._fp_append_contact_nodes(receptor, receptor_partner)
-
         sale_condition = self.fp_sale_condition or "01"
-        ET.SubElement(root, "CondicionVenta").text = sale_condition
-        if sale_condition in ("02", "10"):
-            ET.SubElement(root, "PlazoCredito").text = str(self._fp_get_credit_term_days())
-
-        lines = ET.SubElement(root, "DetalleServicio")
-        detalle_vals = self._fp_build_detail_lines(lines)
-        resumen = ET.SubElement(root, "ResumenFactura")
-        currency_node = ET.SubElement(resumen, "CodigoTipoMoneda")
-        ET.SubElement(currency_node, "CodigoMoneda").text = self.currency_id.name or "CRC"
-        ET.SubElement(currency_node, "TipoCambio").text = f"{self._fp_get_exchange_rate():.5f}"
-        ET.SubElement(resumen, "TotalServGravados").text = self._fp_format_decimal(detalle_vals["total_serv_gravados"])
-        ET.SubElement(resumen, "TotalServExentos").text = self._fp_format_decimal(detalle_vals["total_serv_exentos"])
-        ET.SubElement(resumen, "TotalServExonerado").text = self._fp_format_decimal(detalle_vals["total_serv_exonerado"])
-        ET.SubElement(resumen, "TotalServNoSujeto").text = self._fp_format_decimal(detalle_vals["total_serv_no_sujeto"])
-        ET.SubElement(resumen, "TotalMercanciasGravadas").text = self._fp_format_decimal(detalle_vals["total_mercancias_gravadas"])
-        ET.SubElement(resumen, "TotalMercanciasExentas").text = self._fp_format_decimal(detalle_vals["total_mercancias_exentas"])
-        ET.SubElement(resumen, "TotalMercExonerada").text = self._fp_format_decimal(detalle_vals["total_merc_exonerada"])
-        ET.SubElement(resumen, "TotalMercNoSujeta").text = self._fp_format_decimal(detalle_vals["total_merc_no_sujeta"])
-        ET.SubElement(resumen, "TotalGravado").text = self._fp_format_decimal(detalle_vals["total_gravado"])
-        ET.SubElement(resumen, "TotalExento").text = self._fp_format_decimal(detalle_vals["total_exento"])
-        ET.SubElement(resumen, "TotalExonerado").text = self._fp_format_decimal(detalle_vals["total_exonerado"])
-        ET.SubElement(resumen, "TotalNoSujeto").text = self._fp_format_decimal(detalle_vals["total_no_sujeto"])
-        ET.SubElement(resumen, "TotalVenta").text = self._fp_format_decimal(detalle_vals["total_venta"])
-        ET.SubElement(resumen, "TotalDescuentos").text = self._fp_format_decimal(detalle_vals["total_descuentos"])
-        ET.SubElement(resumen, "TotalVentaNeta").text = self._fp_format_decimal(detalle_vals["total_venta_neta"])
-        for (tax_code, tax_rate_code), tax_amount in sorted(detalle_vals["total_desglose_impuesto"].items()):
-            desglose = ET.SubElement(resumen, "TotalDesgloseImpuesto")
-            ET.SubElement(desglose, "Codigo").text = tax_code
-            ET.SubElement(desglose, "CodigoTarifaIVA").text = tax_rate_code
-            ET.SubElement(desglose, "TotalMontoImpuesto").text = self._fp_format_decimal(tax_amount)
-        ET.SubElement(resumen, "TotalImpuesto").text = self._fp_format_decimal(detalle_vals["total_impuesto"])
-        ET.SubElement(resumen, "TotalImpAsumEmisorFabrica").text = self._fp_format_decimal(
-            detalle_vals["total_imp_asum_emisor_fabrica"]
+        lines = self._fp_extract_lines(exonerations)
+        return fe_document.FeDocument(
+            document_type=self.fp_document_type,
+            clave=clave,
+            systems_provider="".join(ch for ch in self.company_id.vat if ch.isdigit()) if self.company_id.vat else None,
+            emisor_activity_code=emisor_activity_code,
+            receptor_activity_code=receptor_activity_code,
+            consecutive=self._fp_extract_consecutive_from_clave(clave),
+            issue_datetime=issue_datetime.isoformat(timespec="seconds"),
+            emisor=self._fp_extract_party(emisor_partner, emisor_vat, emisor_name, "emisor"),
+            receptor=self._fp_extract_party(receptor_partner, receptor_vat, receptor_name, "receptor"),
+            sale_condition=sale_condition,
+            credit_term_days=self._fp_get_credit_term_days() if sale_condition in ("02", "10") else None,
+            lines=lines,
+            currency_code=self.currency_id.name or "CRC",
+            exchange_rate=self._fp_get_exchange_rate(),
+            payment_method=self.fp_payment_method or "01",
+            reference=self._fp_extract_reference(),
         )
-        if self.fp_document_type != "FEC":
-            ET.SubElement(resumen, "TotalIVADevuelto").text = self._fp_format_decimal(detalle_vals["total_iva_devuelto"])
-        medio_pago = ET.SubElement(resumen, "MedioPago")
-        ET.SubElement(medio_pago, "TipoMedioPago").text = self.fp_payment_method or "01"
-        ET.SubElement(resumen, "TotalComprobante").text = self._fp_format_decimal(detalle_vals["total_comprobante"])
-
-        self._fp_append_reference_information(root)
-
-        ET.register_namespace("", namespace)
-        ET.register_namespace("ds", DS_XML_NS)
-        return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
 
     def _fp_get_exchange_rate(self):
         self.ensure_one()
@@ -998,10 +1419,10 @@ class AccountMove(models.Model):
 
         return 1.0
 
-    def _fp_append_reference_information(self, root_node):
+    def _fp_extract_reference(self):
         self.ensure_one()
         if self.fp_document_type not in ("NC", "ND", "FEC"):
-            return
+            return None
 
         self._fp_populate_reference_from_reversed_entry(force=False)
         self._fp_populate_reference_for_fec(force=False)
@@ -1019,13 +1440,14 @@ class AccountMove(models.Model):
                 message
             )
 
-        reference_node = ET.SubElement(root_node, "InformacionReferencia")
-        ET.SubElement(reference_node, "TipoDocIR").text = self.fp_reference_document_type
-        ET.SubElement(reference_node, "Numero").text = self.fp_reference_number
         reference_issue_datetime = fields.Datetime.context_timestamp(self, self.fp_reference_issue_datetime)
-        ET.SubElement(reference_node, "FechaEmisionIR").text = reference_issue_datetime.isoformat(timespec="seconds")
-        ET.SubElement(reference_node, "Codigo").text = self.fp_reference_code or "01"
-        ET.SubElement(reference_node, "Razon").text = self.fp_reference_reason or _("Documento de referencia")
+        return fe_document.FeReference(
+            document_type=self.fp_reference_document_type,
+            number=self.fp_reference_number,
+            issue_datetime=reference_issue_datetime.isoformat(timespec="seconds"),
+            code=self.fp_reference_code or "01",
+            reason=self.fp_reference_reason or _("Documento de referencia"),
+        )
 
     def _fp_populate_reference_from_reversed_entry(self, force=False):
         for move in self:
@@ -1104,186 +1526,124 @@ class AccountMove(models.Model):
         }
         return iva_rate_map.get((tax_rate_code or "").strip(), 0.0)
 
-    def _fp_build_detail_lines(self, lines_node):
-        totals = {
-            "total_serv_gravados": 0.0,
-            "total_serv_exentos": 0.0,
-            "total_serv_exonerado": 0.0,
-            "total_serv_no_sujeto": 0.0,
-            "total_mercancias_gravadas": 0.0,
-            "total_mercancias_exentas": 0.0,
-            "total_merc_exonerada": 0.0,
-            "total_merc_no_sujeta": 0.0,
-            "total_gravado": 0.0,
-            "total_exento": 0.0,
-            "total_exonerado": 0.0,
-            "total_no_sujeto": 0.0,
-            "total_venta": 0.0,
-            "total_descuentos": 0.0,
-            "total_venta_neta": 0.0,
-            "total_desglose_impuesto": {},
-            "total_impuesto": 0.0,
-            "total_imp_asum_emisor_fabrica": 0.0,
-            "total_iva_devuelto": 0.0,
-            "total_comprobante": 0.0,
-        }
-
+    def _fp_extract_lines(self, exonerations=None):
+        self.ensure_one()
+        if exonerations is None:
+            exonerations = self._fp_get_candidate_exonerations()
         detail_lines = self.invoice_line_ids.filtered(
             lambda l: not l.display_type or l.display_type == "product"
         )
         if not detail_lines:
             raise UserError(_("La factura debe tener al menos una línea de detalle para generar XML FE v4.4."))
 
+        expected_tax_use = "purchase" if self.fp_document_type == "FEC" else "sale"
+        fe_lines = []
         for idx, line in enumerate(detail_lines, start=1):
-            detail = ET.SubElement(lines_node, "LineaDetalle")
-            ET.SubElement(detail, "NumeroLinea").text = str(idx)
-            if line.product_id and line.product_id.fp_cabys_code:
-                ET.SubElement(detail, "CodigoCABYS").text = line.product_id.fp_cabys_code
-            self._fp_append_line_extra_nodes(detail, line)
-
             quantity = line.quantity or 0.0
-            ET.SubElement(detail, "Cantidad").text = self._fp_format_decimal(quantity)
-            unit_code = (line.product_uom_id.fp_unit_code or "").strip() if line.product_uom_id else ""
-            ET.SubElement(detail, "UnidadMedida").text = unit_code or "Unid"
-            if self.fp_document_type == "FEE" and line.product_uom_id and line.product_uom_id.name:
-                ET.SubElement(detail, "UnidadMedidaComercial").text = line.product_uom_id.name
-            ET.SubElement(detail, "Detalle").text = line.name or ""
-            ET.SubElement(detail, "PrecioUnitario").text = self._fp_format_decimal(line.price_unit)
-
             monto_total = quantity * line.price_unit
             subtotal = line.price_subtotal
-            discount_amount = max(monto_total - subtotal, 0.0)
-            total_impuesto_linea = max(line.price_total - line.price_subtotal, 0.0)
-            impuesto_neto_linea = total_impuesto_linea
-            monto_total_linea = subtotal + impuesto_neto_linea
+            impuesto_neto_linea = max(line.price_total - line.price_subtotal, 0.0)
 
             taxes = line.tax_ids
-            expected_tax_use = "purchase" if self.fp_document_type == "FEC" else "sale"
             tax = (taxes.filtered(lambda t: t.type_tax_use == expected_tax_use) or taxes.filtered(lambda t: t.type_tax_use == "none") or taxes)[:1]
-            tax_code = (tax.fp_tax_type or tax.fp_tax_code or "01") if tax else "01"
-            tax_rate_code = (tax.fp_tax_rate_code_iva or "08") if tax else "08"
-            configured_tax_rate = tax.fp_tax_rate if tax and tax.fp_tax_rate else 0.0
-            odoo_tax_rate = tax.amount if tax else 0.0
-            code_tax_rate = self._fp_get_tax_rate_from_code(tax_rate_code) if tax else 0.0
-            tax_rate = configured_tax_rate or odoo_tax_rate or code_tax_rate
-            total_impuesto_xml_linea = subtotal * (tax_rate / 100.0) if tax else 0.0
-            has_tax = bool(tax)
-
-            ET.SubElement(detail, "MontoTotal").text = self._fp_format_decimal(monto_total)
-            ET.SubElement(detail, "SubTotal").text = self._fp_format_decimal(subtotal)
-            exoneration = self.env["fp.client.exoneration"]
-            exoneration_amount = 0.0
-            has_exoneration = False
-            if has_tax:
-                if self.fp_document_type != "FEE":
-                    ET.SubElement(detail, "BaseImponible").text = self._fp_format_decimal(subtotal)
-                impuesto = ET.SubElement(detail, "Impuesto")
-                ET.SubElement(impuesto, "Codigo").text = tax_code
-                ET.SubElement(impuesto, "CodigoTarifaIVA").text = tax_rate_code
-                ET.SubElement(impuesto, "Tarifa").text = self._fp_format_decimal(tax_rate)
-                ET.SubElement(impuesto, "Monto").text = self._fp_format_decimal(total_impuesto_xml_linea)
-                exoneration = self._fp_get_line_exoneration(line)
-                exoneration_amount = self._fp_append_exoneracion_node(
-                    impuesto,
-                    exoneration,
+            fe_tax = None
+            if tax:
+                tax_code = tax.fp_tax_type or tax.fp_tax_code or "01"
+                tax_rate_code = tax.fp_tax_rate_code_iva or "08"
+                configured_tax_rate = tax.fp_tax_rate if tax.fp_tax_rate else 0.0
+                tax_rate = configured_tax_rate or tax.amount or self._fp_get_tax_rate_from_code(tax_rate_code)
+                total_impuesto_xml_linea = subtotal * (tax_rate / 100.0)
+                fe_exoneration = self._fp_extract_exoneration(
+                    self._fp_get_line_exoneration(line, exonerations),
                     subtotal,
                     tax_rate,
                 )
-                has_exoneration = bool(exoneration)
+                exoneration_amount = fe_exoneration.amount if fe_exoneration else 0.0
                 impuesto_neto_linea = max(total_impuesto_xml_linea - exoneration_amount, 0.0)
-                monto_total_linea = subtotal + impuesto_neto_linea
-                if self.fp_document_type != "FEE":
-                    if self.fp_document_type != "FEC":
-                        ET.SubElement(detail, "ImpuestoAsumidoEmisorFabrica").text = self._fp_format_decimal(0.0)
-                    ET.SubElement(detail, "ImpuestoNeto").text = self._fp_format_decimal(impuesto_neto_linea)
-                desglose_key = (tax_code, tax_rate_code)
-                totals["total_desglose_impuesto"][desglose_key] = (
-                    totals["total_desglose_impuesto"].get(desglose_key, 0.0) + impuesto_neto_linea
+                fe_tax = fe_document.FeTax(
+                    code=tax_code,
+                    rate_code=tax_rate_code,
+                    rate=tax_rate,
+                    amount=total_impuesto_xml_linea,
+                    exoneration=fe_exoneration,
                 )
-            ET.SubElement(detail, "MontoTotalLinea").text = self._fp_format_decimal(monto_total_linea)
-
-            product_type = line.product_id.product_tmpl_id.type if line.product_id else False
-            is_service = product_type == "service"
-            if has_tax and (total_impuesto_xml_linea > 0 or has_exoneration):
-                if has_exoneration:
-                    if is_service:
-                        totals["total_serv_exonerado"] += subtotal
-                    else:
-                        totals["total_merc_exonerada"] += subtotal
-                    totals["total_exonerado"] += subtotal
-                else:
-                    if is_service:
-                        totals["total_serv_gravados"] += subtotal
-                    else:
-                        totals["total_mercancias_gravadas"] += subtotal
-                    totals["total_gravado"] += subtotal
-            elif has_tax and tax_rate_code in ("01", "05", "11"):
-                if is_service:
-                    totals["total_serv_no_sujeto"] += subtotal
-                else:
-                    totals["total_merc_no_sujeta"] += subtotal
-                totals["total_no_sujeto"] += subtotal
-            elif has_tax and tax_rate_code == "10":
-                if is_service:
-                    totals["total_serv_exentos"] += subtotal
-                else:
-                    totals["total_mercancias_exentas"] += subtotal
-                totals["total_exento"] += subtotal
-            else:
-                if is_service:
-                    totals["total_serv_exentos"] += subtotal
-                else:
-                    totals["total_mercancias_exentas"] += subtotal
-                totals["total_exento"] += subtotal
 
-            totals["total_venta"] += monto_total
-            totals["total_descuentos"] += discount_amount
-            totals["total_venta_neta"] += subtotal
-            totals["total_impuesto"] += impuesto_neto_linea
-            totals["total_comprobante"] += monto_total_linea
-
-        return totals
+            product = line.product_id.product_tmpl_id if line.product_id else False
+            uom = line.product_uom_id
+            unit_code = (uom.fp_unit_code or "").strip() if uom else ""
+            commercial_code = (line.product_id.default_code or product.default_code) if product else False
+            fe_lines.append(
+                fe_document.FeLine(
+                    number=idx,
+                    cabys_code=line.product_id.fp_cabys_code if line.product_id else False,
+                    commercial_code_type=product.fp_commercial_code_type if product else False,
+                    commercial_code=commercial_code,
+                    health_registry_number=product.fp_health_registry_number if product else False,
+                    medicine_presentation_code=product.fp_medicine_presentation_code if product else False,
+                    tariff_heading=product.fp_tariff_heading if product and self._fp_is_export_invoice() else False,
+                    vin_or_series=product.fp_transport_vin_or_series if product else False,
+                    quantity=quantity,
+                    unit_code=unit_code or "Unid",
+                    commercial_unit=uom.name if self.fp_document_type == "FEE" and uom and uom.name else False,
+                    detail=line.name or "",
+                    unit_price=line.price_unit,
+                    total_amount=monto_total,
+                    subtotal=subtotal,
+                    discount=max(monto_total - subtotal, 0.0),
+                    tax=fe_tax,
+                    net_tax=impuesto_neto_linea,
+                    total_line=subtotal + impuesto_neto_linea,
+                    is_service=(product.type if product else False) == "service",
+                )
+            )
+        return fe_lines
 
     def _fp_get_report_summary_totals(self):
         self.ensure_one()
-        return self._fp_build_detail_lines(ET.Element("DetalleServicio"))
-
-    def _fp_append_line_extra_nodes(self, detail_node, line):
-        product = line.product_id.product_tmpl_id if line.product_id else False
-        if not product:
-            return
-        if product.fp_commercial_code_type and (line.product_id.default_code or product.default_code):
-            code_node = ET.SubElement(detail_node, "CodigoComercial")
-            ET.SubElement(code_node, "Tipo").text = product.fp_commercial_code_type
-            ET.SubElement(code_node, "Codigo").text = line.product_id.default_code or product.default_code
-        if product.fp_health_registry_number:
-            ET.SubElement(detail_node, "NumeroRegistroMS").text = product.fp_health_registry_number
-        if product.fp_medicine_presentation_code:
-            ET.SubElement(detail_node, "CodigoPresentacionMedicamento").text = product.fp_medicine_presentation_code
-        if product.fp_tariff_heading and self._fp_is_export_invoice():
-            ET.SubElement(detail_node, "PartidaArancelaria").text = product.fp_tariff_heading
-        if product.fp_transport_vin_or_series:
-            ET.SubElement(detail_node, "NumeroVINoSerie").text = product.fp_transport_vin_or_series
+        return fe_document.compute_totals(self._fp_extract_lines())
 
     def _fp_is_export_invoice(self):
         self.ensure_one()
         return (self.partner_id.country_id.code or "CR") != "CR"
 
-    def _fp_get_line_exoneration(self, line):
+    def _fp_get_candidate_exonerations(self):
+        """Return the partner exonerations in force on the invoice date, newest first."""
         self.ensure_one()
-        partner = self.partner_id
-        if not partner.fp_use_exonerations:
-            return self.env["fp.client.exoneration"]
-        invoice_date = self.invoice_date or fields.Date.context_today(self)
-        domain = [
-            ("partner_id", "=", partner.id),
-            ("active", "=", True),
-            ("issue_date", "<=", fields.Datetime.to_string(invoice_date)),
-            "|",
-            ("expiry_date", "=", False),
-            ("expiry_date", ">=", invoice_date),
-        ]
-        exonerations = self.env["fp.client.exoneration"].search(domain, order="issue_date desc")
+        return self._fp_get_exonerations_by_move()[self.id]
+
+    def _fp_get_exonerations_by_move(self):
+        """Map each move id to its candidate exonerations, loaded with a single search for the whole recordset."""
+        exonerations_by_move = {move.id: self.env["fp.client.exoneration"] for move in self}
+        moves = self.filtered(lambda move: move.partner_id.fp_use_exonerations)
+        if not moves:
+            return exonerations_by_move
+        invoice_dates = {move.id: move.invoice_date or fields.Date.context_today(move) for move in moves}
+        exonerations = self.env["fp.client.exoneration"].search(
+            [
+                ("partner_id", "in", moves.partner_id.ids),
+                ("active", "=", True),
+                ("issue_date", "<=", fields.Datetime.to_string(max(invoice_dates.values()))),
+                "|",
+                ("expiry_date", "=", False),
+                ("expiry_date", ">=", min(invoice_dates.values())),
+            ],
+            order="issue_date desc",
+        )
+        exonerations.line_ids.fetch(["product_id", "cabys_code_id"])
+        for move in moves:
+            invoice_date = invoice_dates[move.id]
+            issue_limit = fields.Datetime.to_datetime(invoice_date)
+            exonerations_by_move[move.id] = exonerations.filtered(
+                lambda exoneration: exoneration.partner_id == move.partner_id
+                and exoneration.issue_date <= issue_limit
+                and (not exoneration.expiry_date or exoneration.expiry_date >= invoice_date)
+            )
+        return exonerations_by_move
+
+    def _fp_get_line_exoneration(self, line, exonerations=None):
+        self.ensure_one()
+        if exonerations is None:
+            exonerations = self._fp_get_candidate_exonerations()
         if not exonerations:
             return self.env["fp.client.exoneration"]
         product_tmpl = line.product_id.product_tmpl_id if line.product_id else False
@@ -1298,17 +1658,13 @@ class AccountMove(models.Model):
                     return exoneration
         return self.env["fp.client.exoneration"]
 
-    def _fp_append_exoneracion_node(self, impuesto_node, exoneration, taxable_base, tax_rate):
+    def _fp_extract_exoneration(self, exoneration, taxable_base, tax_rate):
         if not exoneration:
-            return 0.0
-        exoneration_node = ET.SubElement(impuesto_node, "Exoneracion")
+            return None
         # En v4.4, el nodo de exoneración utiliza TipoDocumentoEX1 (no TipoDocumento).
         exoneration_type = exoneration.exoneration_type or "99"
-        ET.SubElement(exoneration_node, "TipoDocumentoEX1").text = exoneration_type
-        ET.SubElement(exoneration_node, "NumeroDocumento").text = (exoneration.exoneration_number or "")[:40]
 
         # Según la nota técnica v4.4 (nota 10.1), Articulo es obligatorio para tipos 02, 03, 06, 07 y 08.
-        # El orden de serialización también es relevante para el XSD: Articulo/Inciso van antes de NombreInstitucion.
         required_article_types = {"02", "03", "06", "07", "08"}
         article = (exoneration.article or "").strip()
         incise = (exoneration.incise or "").strip()
@@ -1324,38 +1680,37 @@ class AccountMove(models.Model):
                 }
             )
 
-        if article:
-            ET.SubElement(exoneration_node, "Articulo").text = article[:10]
-        if incise:
-            ET.SubElement(exoneration_node, "Inciso").text = incise[:3]
-
-        ET.SubElement(exoneration_node, "NombreInstitucion").text = (exoneration.institution_name or "")[:160]
         exoneration_issue_dt = fields.Datetime.to_datetime(exoneration.issue_date)
-        ET.SubElement(exoneration_node, "FechaEmisionEX").text = exoneration_issue_dt.strftime("%Y-%m-%dT%H:%M:%S") if exoneration_issue_dt else ""
-
         percentage = max(min(exoneration.exoneration_percentage or 0.0, 100.0), 0.0)
-        tax_discount = taxable_base * (percentage / 100.0)
-        ET.SubElement(exoneration_node, "TarifaExonerada").text = str(int(tax_rate or 0.0))
-        ET.SubElement(exoneration_node, "MontoExoneracion").text = self._fp_format_decimal(tax_discount)
-        return tax_discount
-
-    def _fp_format_decimal(self, value):
-        return f"{(value or 0.0):.5f}"
-
+        return fe_document.FeExoneration(
+            document_type=exoneration_type,
+            number=(exoneration.exoneration_number or "")[:40],
+            article=article[:10],
+            incise=incise[:3],
+            institution_name=(exoneration.institution_name or "")[:160],
+            issue_date=exoneration_issue_dt.strftime("%Y-%m-%dT%H:%M:%S") if exoneration_issue_dt else "",
+            rate=tax_rate,
+            amount=taxable_base * (percentage / 100.0),
+        )
 
-    def _fp_append_identification_nodes(self, parent_node, partner, vat_source, party_role):
+    def _fp_extract_party(self, partner, vat_source, name, party_role):
         identification_type = (partner.fp_identification_type or "02").strip()
         identification_number = self._fp_format_identification_number(
             vat_source,
             identification_type,
         )
-
         if self.fp_document_type == "TE" and party_role == "receptor" and not identification_number:
-            return
-
-        identification_node = ET.SubElement(parent_node, "Identificacion")
-        ET.SubElement(identification_node, "Tipo").text = identification_type
-        ET.SubElement(identification_node, "Numero").text = identification_number
+            identification_type = None
+        country_code, phone_number = self._fp_normalize_phone_payload(partner.phone, partner.country_id)
+        return fe_document.FeParty(
+            name=name or "",
+            identification_type=identification_type,
+            identification_number=identification_number,
+            location=self._fp_extract_location(partner, party_role),
+            phone_country_code=country_code,
+            phone_number=phone_number,
+            email=partner.email,
+        )
 
     def _fp_format_identification_number(self, value, identification_type):
         raw_value = (value or "").strip()
@@ -1375,16 +1730,16 @@ class AccountMove(models.Model):
             "numeroIdentificacion": identification_number,
         }
 
-    def _fp_append_location_nodes(self, parent_node, partner, party_role):
+    def _fp_extract_location(self, partner, party_role):
         if not partner:
-            return
+            return None
 
         province_code_from_catalog = partner.fp_province_id.code if partner.fp_province_id else ""
         canton_code_from_catalog = partner.fp_canton_id.code if partner.fp_canton_id else ""
         district_code_from_catalog = partner.fp_district_id.code if partner.fp_district_id else ""
 
         if self.fp_document_type == "FEE" and party_role == "receptor" and partner.country_id.code != "CR":
-            return
+            return None
 
         if self.fp_document_type == "TE" and party_role == "receptor":
             if partner.country_id.code == "CR":
@@ -1405,20 +1760,14 @@ class AccountMove(models.Model):
             other_signs = (partner.street or "")[:160]
 
             if not any((province, canton, district, neighborhood, other_signs)):
-                return
-
-            location_node = ET.SubElement(parent_node, "Ubicacion")
-            if province:
-                ET.SubElement(location_node, "Provincia").text = province
-            if canton:
-                ET.SubElement(location_node, "Canton").text = canton
-            if district:
-                ET.SubElement(location_node, "Distrito").text = district
-            if neighborhood:
-                ET.SubElement(location_node, "Barrio").text = neighborhood
-            if other_signs:
-                ET.SubElement(location_node, "OtrasSenas").text = other_signs
-            return
+                return None
+            return fe_document.FeLocation(
+                province=province,
+                canton=canton,
+                district=district,
+                neighborhood=neighborhood,
+                other_signs=other_signs,
+            )
 
         if partner.country_id.code == "CR":
             province_source = province_code_from_catalog or (partner.state_id.code if partner.state_id and partner.state_id.code else partner.fp_province_code)
@@ -1436,23 +1785,13 @@ class AccountMove(models.Model):
         district = self._fp_pad_numeric_code(district_source, 2, "01")
         neighborhood = self._fp_format_neighborhood_code(neighborhood_source) if neighborhood_source else ""
 
-        location_node = ET.SubElement(parent_node, "Ubicacion")
-        ET.SubElement(location_node, "Provincia").text = self._fp_pad_numeric_code(province, 1, "1")
-        ET.SubElement(location_node, "Canton").text = canton
-        ET.SubElement(location_node, "Distrito").text = district
-        if neighborhood:
-            ET.SubElement(location_node, "Barrio").text = neighborhood
-        if partner.street:
-            ET.SubElement(location_node, "OtrasSenas").text = partner.street[:160]
-
-    def _fp_append_contact_nodes(self, parent_node, partner):
-        country_code, phone_number = self._fp_normalize_phone_payload(partner.phone, partner.country_id)
-        if phone_number:
-            phone_node = ET.SubElement(parent_node, "Telefono")
-            ET.SubElement(phone_node, "CodigoPais").text = country_code
-            ET.SubElement(phone_node, "NumTelefono").text = phone_number
-        if partner.email:
-            ET.SubElement(parent_node, "CorreoElectronico").text = partner.email
+        return fe_document.FeLocation(
+            province=province,
+            canton=canton,
+            district=district,
+            neighborhood=neighborhood,
+            other_signs=(partner.street or "")[:160],
+        )
 
     def _fp_normalize_phone_payload(self, phone, country):
         phone_text = str(phone or "")
@@ -1500,215 +1839,6 @@ class AccountMove(models.Model):
                 return days
         return 1
 
-    def _fp_sign_xml(self, xml_text):
-        self.ensure_one()
-        company = self.company_id
-        cert_file = company.fp_signing_certificate_file
-        if not cert_file:
-            raise UserError(_("Configure el certificado FE (.p12/.pfx) para firmar XML en Ajustes > Contabilidad."))
-
-        cert_bytes = base64.b64decode(cert_file)
-        password = (company.fp_signing_certificate_password or "").encode("utf-8") or None
-
-        try:
-            private_key, certificate, _additional_certs = pkcs12.load_key_and_certificates(cert_bytes, password)
-        except Exception as error:
-            raise UserError(_("No fue posible abrir el certificado FE. Verifique archivo y contraseña. Detalle: %s") % error)
-
-        if not private_key or not certificate:
-            raise UserError(_("El certificado FE no contiene llave privada o certificado válido."))
-
-        parser = LET.XMLParser(remove_blank_text=True)
-        root = LET.fromstring(xml_text.encode("utf-8"), parser=parser)
-
-        signature_token = str(uuid.uuid4())
-        reference_token = str(uuid.uuid4())
-        object_token = str(uuid.uuid4())
-        qualifying_props_token = str(uuid.uuid4())
-
-        signature_id = f"Signature-{signature_token}"
-        reference_id = f"Reference-{reference_token}"
-        key_info_id = f"KeyInfoId-{signature_id}"
-        signed_properties_id = f"SignedProperties-{signature_id}"
-
-        canonical_document = LET.tostring(root, method="c14n", exclusive=False, with_comments=False)
-        root_digest = hashlib.sha256(canonical_document).digest()
-
-        signature_node = LET.SubElement(root, LET.QName(DS_XML_NS, "Signature"), nsmap={"ds": DS_XML_NS, "xades": XADES_XML_NS})
-        signature_node.set("Id", signature_id)
-
-        signed_info = LET.SubElement(signature_node, LET.QName(DS_XML_NS, "SignedInfo"))
-        LET.SubElement(
-            signed_info,
-            LET.QName(DS_XML_NS, "CanonicalizationMethod"),
-            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
-        )
-        LET.SubElement(
-            signed_info,
-            LET.QName(DS_XML_NS, "SignatureMethod"),
-            {"Algorithm": "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"},
-        )
-
-        reference_document = LET.SubElement(
-            signed_info,
-            LET.QName(DS_XML_NS, "Reference"),
-            {"Id": reference_id, "URI": ""},
-        )
-        transforms = LET.SubElement(reference_document, LET.QName(DS_XML_NS, "Transforms"))
-        LET.SubElement(
-            transforms,
-            LET.QName(DS_XML_NS, "Transform"),
-            {"Algorithm": "http://www.w3.org/2000/09/xmldsig#enveloped-signature"},
-        )
-        LET.SubElement(
-            transforms,
-            LET.QName(DS_XML_NS, "Transform"),
-            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
-        )
-        LET.SubElement(
-            reference_document,
-            LET.QName(DS_XML_NS, "DigestMethod"),
-            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
-        )
-        LET.SubElement(reference_document, LET.QName(DS_XML_NS, "DigestValue")).text = base64.b64encode(root_digest).decode("utf-8")
-
-        key_info = LET.SubElement(signature_node, LET.QName(DS_XML_NS, "KeyInfo"), {"Id": key_info_id})
-        x509_data = LET.SubElement(key_info, LET.QName(DS_XML_NS, "X509Data"))
-        cert_der = certificate.public_bytes(serialization.Encoding.DER)
-        LET.SubElement(x509_data, LET.QName(DS_XML_NS, "X509Certificate")).text = base64.b64encode(cert_der).decode("utf-8")
-
-        public_key = certificate.public_key()
-        key_value = LET.SubElement(key_info, LET.QName(DS_XML_NS, "KeyValue"))
-        rsa_key_value = LET.SubElement(key_value, LET.QName(DS_XML_NS, "RSAKeyValue"))
-        public_numbers = public_key.public_numbers()
-        modulus_size = max(1, (public_numbers.n.bit_length() + 7) // 8)
-        exponent_size = max(1, (public_numbers.e.bit_length() + 7) // 8)
-        LET.SubElement(rsa_key_value, LET.QName(DS_XML_NS, "Modulus")).text = base64.b64encode(
-            public_numbers.n.to_bytes(modulus_size, "big")
-        ).decode("utf-8")
-        LET.SubElement(rsa_key_value, LET.QName(DS_XML_NS, "Exponent")).text = base64.b64encode(
-            public_numbers.e.to_bytes(exponent_size, "big")
-        ).decode("utf-8")
-
-        reference_key_info = LET.SubElement(
-            signed_info,
-            LET.QName(DS_XML_NS, "Reference"),
-            {"Id": "ReferenceKeyInfo", "URI": f"#{key_info_id}"},
-        )
-        key_info_transforms = LET.SubElement(reference_key_info, LET.QName(DS_XML_NS, "Transforms"))
-        LET.SubElement(
-            key_info_transforms,
-            LET.QName(DS_XML_NS, "Transform"),
-            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
-        )
-        LET.SubElement(
-            reference_key_info,
-            LET.QName(DS_XML_NS, "DigestMethod"),
-            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
-        )
-        key_info_c14n = LET.tostring(key_info, method="c14n", exclusive=False, with_comments=False)
-        LET.SubElement(reference_key_info, LET.QName(DS_XML_NS, "DigestValue")).text = base64.b64encode(
-            hashlib.sha256(key_info_c14n).digest()
-        ).decode("utf-8")
-
-        reference_signed_properties = LET.SubElement(
-            signed_info,
-            LET.QName(DS_XML_NS, "Reference"),
-            {
-                "Type": "http://uri.etsi.org/01903#SignedProperties",
-                "URI": f"#{signed_properties_id}",
-            },
-        )
-        signed_properties_transforms = LET.SubElement(reference_signed_properties, LET.QName(DS_XML_NS, "Transforms"))
-        LET.SubElement(
-            signed_properties_transforms,
-            LET.QName(DS_XML_NS, "Transform"),
-            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
-        )
-        LET.SubElement(
-            reference_signed_properties,
-            LET.QName(DS_XML_NS, "DigestMethod"),
-            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
-        )
-        reference_signed_properties_digest = LET.SubElement(reference_signed_properties, LET.QName(DS_XML_NS, "DigestValue"))
-
-        object_node = LET.SubElement(signature_node, LET.QName(DS_XML_NS, "Object"), {"Id": f"XadesObjectId-{object_token}"})
-        qualifying_properties = LET.SubElement(
-            object_node,
-            LET.QName(XADES_XML_NS, "QualifyingProperties"),
-            {
-                "Id": f"QualifyingProperties-{qualifying_props_token}",
-                "Target": f"#{signature_id}",
-            },
-        )
-        signed_properties = LET.SubElement(
-            qualifying_properties,
-            LET.QName(XADES_XML_NS, "SignedProperties"),
-            {"Id": signed_properties_id},
-        )
-        signed_signature_properties = LET.SubElement(signed_properties, LET.QName(XADES_XML_NS, "SignedSignatureProperties"))
-        LET.SubElement(signed_signature_properties, LET.QName(XADES_XML_NS, "SigningTime")).text = datetime.now().astimezone().replace(microsecond=0).isoformat()
-
-        signing_certificate = LET.SubElement(signed_signature_properties, LET.QName(XADES_XML_NS, "SigningCertificate"))
-        cert_node = LET.SubElement(signing_certificate, LET.QName(XADES_XML_NS, "Cert"))
-        cert_digest_node = LET.SubElement(cert_node, LET.QName(XADES_XML_NS, "CertDigest"))
-        LET.SubElement(
-            cert_digest_node,
-            LET.QName(DS_XML_NS, "DigestMethod"),
-            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
-        )
-        LET.SubElement(cert_digest_node, LET.QName(DS_XML_NS, "DigestValue")).text = base64.b64encode(
-            hashlib.sha256(cert_der).digest()
-        ).decode("utf-8")
-        issuer_serial = LET.SubElement(cert_node, LET.QName(XADES_XML_NS, "IssuerSerial"))
-        LET.SubElement(issuer_serial, LET.QName(DS_XML_NS, "X509IssuerName")).text = certificate.issuer.rfc4514_string()
-        LET.SubElement(issuer_serial, LET.QName(DS_XML_NS, "X509SerialNumber")).text = str(certificate.serial_number)
-
-        signature_policy_identifier = LET.SubElement(
-            signed_signature_properties,
-            LET.QName(XADES_XML_NS, "SignaturePolicyIdentifier"),
-        )
-        signature_policy_id = LET.SubElement(signature_policy_identifier, LET.QName(XADES_XML_NS, "SignaturePolicyId"))
-        sig_policy_id = LET.SubElement(signature_policy_id, LET.QName(XADES_XML_NS, "SigPolicyId"))
-        LET.SubElement(sig_policy_id, LET.QName(XADES_XML_NS, "Identifier")).text = XADES_SIGNATURE_POLICY_IDENTIFIER
-        LET.SubElement(sig_policy_id, LET.QName(XADES_XML_NS, "Description")).text = ""
-
-        sig_policy_hash = LET.SubElement(signature_policy_id, LET.QName(XADES_XML_NS, "SigPolicyHash"))
-        LET.SubElement(
-            sig_policy_hash,
-            LET.QName(DS_XML_NS, "DigestMethod"),
-            {"Algorithm": XADES_SIGNATURE_POLICY_HASH_ALGORITHM},
-        )
-        LET.SubElement(sig_policy_hash, LET.QName(DS_XML_NS, "DigestValue")).text = XADES_SIGNATURE_POLICY_HASH
-
-        signer_role = LET.SubElement(signed_signature_properties, LET.QName(XADES_XML_NS, "SignerRole"))
-        claimed_roles = LET.SubElement(signer_role, LET.QName(XADES_XML_NS, "ClaimedRoles"))
-        LET.SubElement(claimed_roles, LET.QName(XADES_XML_NS, "ClaimedRole")).text = "ObligadoTributario"
-
-        signed_data_object_properties = LET.SubElement(signed_properties, LET.QName(XADES_XML_NS, "SignedDataObjectProperties"))
-        data_object_format = LET.SubElement(
-            signed_data_object_properties,
-            LET.QName(XADES_XML_NS, "DataObjectFormat"),
-            {"ObjectReference": f"#{reference_id}"},
-        )
-        LET.SubElement(data_object_format, LET.QName(XADES_XML_NS, "MimeType")).text = "text/xml"
-        LET.SubElement(data_object_format, LET.QName(XADES_XML_NS, "Encoding")).text = "UTF-8"
-
-        signed_properties_c14n = LET.tostring(signed_properties, method="c14n", exclusive=False, with_comments=False)
-        reference_signed_properties_digest.text = base64.b64encode(hashlib.sha256(signed_properties_c14n).digest()).decode("utf-8")
-
-        signed_info_c14n = LET.tostring(signed_info, method="c14n", exclusive=False, with_comments=False)
-        signature = private_key.sign(signed_info_c14n, padding.PKCS1v15(), hashes.SHA256())
-        signature_value_node = LET.SubElement(
-            signature_node,
-            LET.QName(DS_XML_NS, "SignatureValue"),
-            {"Id": f"SignatureValue-{signature_token}"},
-        )
-        signature_value_node.text = base64.b64encode(signature).decode("utf-8")
-        signature_node.insert(1, signature_value_node)
-
-        return LET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
-
     def _fp_store_hacienda_response_xml(self, response_data):
         self.ensure_one()
         xml_keys = ["respuesta-xml", "respuestaXml", "xmlRespuesta", "xml"]
@@ -1905,39 +2035,174 @@ class AccountMove(models.Model):
         self.fp_external_id = clave
         return clave
 
-    def _fp_call_api(self, endpoint, payload, timeout, token, base_url, method="POST", params=None):
+    def _fp_call_api(self, endpoint, payload, token, base_url, method="POST", params=None, retry_on_unauthorized=True):
         url = f"{base_url.rstrip('/')}{endpoint}"
         headers = {
             "Authorization": self._fp_build_authorization_header(token),
             "Content-Type": "application/json",
         }
+        transport = self.company_id._fp_get_hacienda_transport()
         try:
             if method == "GET":
-                response = requests.get(url, headers=headers, timeout=timeout, params=params)
+                response = transport.get(url, headers=headers, params=params, bucket="recepcion_get")
             else:
-                response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=timeout)
-        except requests.exceptions.Timeout as error:
-            self.fp_api_state = "error"
-            raise UserError(_("Tiempo de espera agotado comunicando con Hacienda.")) from error
+                response = transport.post(url, data=json.dumps(payload), headers=headers, bucket="recepcion_post")
         except requests.exceptions.RequestException as error:
-            self.fp_api_state = "error"
-            _logger.exception("Error de red llamando API de Hacienda para factura %s", self.name)
-            raise UserError(_("No fue posible conectar con la API de Hacienda.")) from error
-
+            self._fp_raise_api_connection_error(error)
+
+        if response.status_code == 401 and retry_on_unauthorized:
+            # El token pudo ser revocado o vencer antes de lo anunciado: se descarta
+            # de la caché y se reintenta una única vez con uno nuevo.
+            self._fp_invalidate_hacienda_access_token(token)
+            return self._fp_call_api(
+                endpoint=endpoint,
+                payload=payload,
+                token=self._fp_get_hacienda_access_token(),
+                base_url=base_url,
+                method=method,
+                params=params,
+                retry_on_unauthorized=False,
+            )
+        return self._fp_process_api_response(response)
+
+    def _fp_raise_api_connection_error(self, error):
+        if isinstance(error, hacienda_transport.HaciendaRateLimited):
+            raise FpHaciendaApiError(
+                _("Se alcanzó el límite de solicitudes a Hacienda; el documento se procesará más tarde."),
+                retryable=True,
+                retry_after=error.retry_after,
+            ) from error
+        if isinstance(error, hacienda_transport.HaciendaCircuitOpen):
+            raise FpHaciendaApiError(
+                _("Hacienda no está respondiendo (%(host)s); el documento se procesará cuando se restablezca.")
+                % {"host": error.host},
+                retryable=True,
+                retry_after=error.retry_after,
+            ) from error
+        if isinstance(error, requests.exceptions.Timeout):
+            raise FpHaciendaApiError(_("Tiempo de espera agotado comunicando con Hacienda."), retryable=True) from error
+        _logger.error("Error de red llamando API de Hacienda para factura %s: %s", self.name, error)
+        raise FpHaciendaApiError(_("No fue posible conectar con la API de Hacienda."), retryable=True) from error
+
+    def _fp_process_api_response(self, response):
         if response.status_code >= 400:
-            self.fp_api_state = "error"
-            preview = (response.text or "")[:200]
-            raise UserError(
+            detail = response.headers.get("X-Error-Cause") or (response.text or "")[:200]
+            raise FpHaciendaApiError(
                 _("Error API Hacienda (%(status)s). Detalle: %(detail)s")
                 % {
                     "status": response.status_code,
-                    "detail": preview or _("sin detalle"),
-                }
+                    "detail": detail or _("sin detalle"),
+                },
+                retryable=response.status_code in FP_RETRYABLE_STATUS_CODES,
+                status_code=response.status_code,
+                detail=detail,
+                retry_after=self._fp_get_response_retry_after(response),
             )
         if not response.text:
             return {}
         return self._fp_parse_json_response(response, response_context="API")
 
+    def _fp_get_response_retry_after(self, response):
+        if response.status_code != 429:
+            return None
+        return (
+            hacienda_transport.parse_retry_after(response.headers.get("Retry-After"))
+            or hacienda_transport.DEFAULT_RETRY_AFTER
+        )
+
+    def _fp_reset_api_retry_state(self):
+        self.ensure_one()
+        if self.fp_api_attempt_count or self.fp_api_next_attempt_at or self.fp_api_last_error:
+            self.write(
+                {
+                    "fp_api_attempt_count": 0,
+                    "fp_api_next_attempt_at": False,
+                    "fp_api_last_error": False,
+                }
+            )
+
+    def _fp_compute_retry_delay(self, attempt):
+        self.ensure_one()
+        base_delay = max(self.company_id.fp_api_retry_base_delay or 1, 1)
+        delay = min(base_delay * (2 ** max(attempt - 1, 0)), FP_RETRY_MAX_DELAY)
+        # Jitter para que los documentos que fallaron juntos no reintenten en bloque.
+        return random.uniform(delay / 2, delay)
+
+    def _fp_register_api_failure(self, error, stage):
+        """Schedule a retry for a transient failure or park the document.
+
+        ``stage`` is ``"send"`` or ``"consult"``. Terminal errors move the
+        document to ``error``; retryable ones are rescheduled with exponential
+        backoff until ``fp_api_max_attempts`` is reached, then to ``dead``.
+        """
+        self.ensure_one()
+        if isinstance(error, FpHaciendaApiError) and error.retry_after:
+            # Hacienda limitó el ritmo: se difiere el documento sin consumir un intento.
+            self.write(
+                {
+                    "fp_api_state": "pending" if stage == "send" else self.fp_api_state,
+                    "fp_api_next_attempt_at": fields.Datetime.now() + timedelta(seconds=error.retry_after),
+                    "fp_api_last_error": str(error),
+                }
+            )
+            return
+
+        attempts = self.fp_api_attempt_count + 1
+        vals = {
+            "fp_api_attempt_count": attempts,
+            "fp_api_last_error": str(error),
+            "fp_api_next_attempt_at": False,
+        }
+        stage_label = _("envío") if stage == "send" else _("consulta")
+        retryable = isinstance(error, FpHaciendaApiError) and error.retryable
+        if not retryable:
+            vals["fp_api_state"] = "error"
+            body = _("Error en %(stage)s automático a Hacienda: %(error)s") % {"stage": stage_label, "error": error}
+        elif attempts >= max(self.company_id.fp_api_max_attempts, 1):
+            vals["fp_api_state"] = "dead"
+            body = _(
+                "Se agotaron los %(attempts)s intentos de %(stage)s a Hacienda. Último error: %(error)s"
+            ) % {"attempts": attempts, "stage": stage_label, "error": error}
+        else:
+            next_attempt_at = fields.Datetime.now() + timedelta(seconds=self._fp_compute_retry_delay(attempts))
+            vals["fp_api_next_attempt_at"] = next_attempt_at
+            if stage == "send":
+                vals["fp_api_state"] = "pending"
+            body = _(
+                "Falla transitoria en %(stage)s a Hacienda (intento %(attempt)s). "
+                "Se reintentará a partir de %(next)s. Detalle: %(error)s"
+            ) % {
+                "stage": stage_label,
+                "attempt": attempts,
+                "next": fields.Datetime.to_string(next_attempt_at),
+                "error": error,
+            }
+        self.write(vals)
+        if stage == "send" and self.fp_api_state in ("error", "dead"):
+            # Sale de la cola de envío; vuelve a ella al reintentar manualmente.
+            self._fp_set_pipeline_stage("signed")
+        self.message_post(body=body)
+
+    def action_fp_retry_api(self):
+        # También reactiva los documentos en "error": antes de los reintentos automáticos
+        # cualquier falla transitoria los dejaba en ese estado.
+        moves = self.filtered(
+            lambda m: m.fp_api_state in ("error", "dead") and m.fp_invoice_status not in ("accepted", "rejected")
+        )
+        if not moves:
+            return
+        to_consult = moves.filtered(lambda m: m.fp_invoice_status == "sent")
+        to_send = moves - to_consult
+        moves.write({"fp_api_attempt_count": 0, "fp_api_next_attempt_at": False})
+        if to_consult:
+            to_consult.write({"fp_api_state": "sent"})
+            to_consult._fp_enqueue_consult()
+        if to_send:
+            to_send.write({"fp_api_state": "pending"})
+            to_send._fp_enqueue_send()
+        for move in moves:
+            move.message_post(body=_("Reintentos con Hacienda reactivados manualmente."))
+
     def _fp_parse_json_response(self, response, response_context="API"):
         self.ensure_one()
         try:
@@ -1970,37 +2235,615 @@ class AccountMove(models.Model):
         return f"Bearer {token}"
 
     def _fp_cron_consult_pending_documents(self):
-        moves = self.search(
+        self._fp_run_cron_batches(
+            "consult",
             [
-                ("fp_is_electronic_invoice", "=", True),
-                ("fp_external_id", "!=", False),
-                ("fp_invoice_status", "=", "sent"),
-                ("state", "=", "posted"),
+                *self._fp_get_consult_candidates_domain(),
+                "|",
+                ("fp_next_consult_at", "=", False),
+                ("fp_next_consult_at", "<=", fields.Datetime.now()),
             ],
-            limit=200,
+            "_fp_cron_consult_batch",
+            "l10n_cr_einvoice.ir_cron_fp_consult_pending_documents",
+            select_method="_fp_select_consult_batch",
         )
+        self._fp_trigger_consult_cron()
+
+    @api.model
+    def _fp_get_consult_candidates_domain(self):
+        """Documents awaiting a Hacienda status, plus unsent ones whose consult a user requested."""
+        return [
+            ("fp_is_electronic_invoice", "=", True),
+            ("fp_external_id", "!=", False),
+            ("state", "=", "posted"),
+            "|",
+            "&",
+            "&",
+            ("fp_pipeline_stage", "in", ("submitted", "polling")),
+            ("fp_invoice_status", "=", "sent"),
+            ("fp_api_state", "=", "sent"),
+            "&",
+            ("fp_api_state", "=", "pending"),
+            ("fp_next_consult_at", "!=", False),
+        ]
+
+    def _fp_cron_consult_batch(self):
+        moves = self.with_context(fp_commit_per_document=True)
+        consult_requests = {}
         for move in moves:
             try:
-                move.action_fp_consult_api_document()
+                consult_requests[move] = move._fp_prepare_consult_request()
             except Exception as error:
-                _logger.exception("Error en cron FE consultando documento %s", move.name)
-                move.fp_api_state = "error"
-                move.message_post(body=_("Error en consulta automática a Hacienda: %s") % error)
+                move._fp_handle_consult_error(error)
+                move._fp_release_lease()
+                self.env.cr.commit()
 
-    def _fp_cron_send_pending_documents(self):
-        moves = self.search(
+        concurrency = int(self.env["ir.config_parameter"].sudo().get_param("l10n_cr_einvoice.consult_concurrency", 20) or 1)
+        results = self._fp_fetch_consult_responses(consult_requests, concurrency)
+
+        # Las transiciones se aplican y confirman documento por documento, ya con todas las respuestas en memoria.
+        for index, (move, (response, error)) in enumerate(results.items(), 1):
+            try:
+                if error:
+                    move._fp_raise_api_connection_error(error)
+                if response.status_code == 401:
+                    # Token revocado: se descarta y el documento vuelve a la cola; la próxima consulta usa uno nuevo.
+                    move._fp_invalidate_hacienda_access_token(consult_requests[move]["token"])
+                    response_data = None
+                else:
+                    response_data = move._fp_process_api_response(response)
+                self.env.cr.execute("SELECT id FROM account_move WHERE id = %s FOR UPDATE", [move.id])
+                move.invalidate_recordset()
+                # La notificación de Hacienda pudo resolverlo mientras se consultaba.
+                if response_data is None:
+                    if move._fp_is_awaiting_hacienda_status() or move.fp_api_state == "pending":
+                        move._fp_schedule_next_consult(move.fp_consult_count)
+                elif move._fp_is_awaiting_hacienda_status():
+                    move._fp_apply_hacienda_status(response_data)
+                elif move.fp_api_state == "pending":
+                    move._fp_apply_requested_consult(response_data)
+            except Exception as error:
+                move._fp_handle_consult_error(error)
+            move._fp_release_lease()
+            move._fp_notify_status_change()
+            # Cada documento se confirma por separado: un fallo no revierte a los demás.
+            self.env.cr.commit()
+            if index % FP_CRON_CHUNK_SIZE == 0:
+                self.env.invalidate_all()
+
+    @api.model
+    def _fp_get_retry_due_domain(self):
+        return [
+            "|",
+            ("fp_api_next_attempt_at", "=", False),
+            ("fp_api_next_attempt_at", "<=", fields.Datetime.now()),
+        ]
+
+    def _fp_filter_circuit_closed(self):
+        """Drop documents whose Hacienda host is failing fast, without touching them."""
+        store = self.env["fp.hacienda.transport.state"]._fp_get_store()
+        open_urls = {
+            url for url in set(self.company_id.mapped(lambda company: company.fp_hacienda_api_base_url or ""))
+            if hacienda_transport.is_circuit_open(url, store)
+        }
+        open_moves = self.filtered(lambda move: (move.company_id.fp_hacienda_api_base_url or "") in open_urls)
+        if open_moves:
+            _logger.info("Circuito de Hacienda abierto: se omiten %s documentos FE en este ciclo.", len(open_moves))
+        return self - open_moves
+
+    def _fp_prepare_consult_request(self):
+        self.ensure_one()
+        self._fp_check_consultable()
+        company = self.company_id
+        token = self._fp_get_hacienda_access_token()
+        return {
+            "transport": company._fp_get_hacienda_transport(),
+            "url": f"{(company.fp_hacienda_api_base_url or '').rstrip('/')}"
+            f"{self._fp_get_hacienda_recepcion_endpoint(clave=self.fp_external_id)}",
+            "headers": {
+                "Authorization": self._fp_build_authorization_header(token),
+                "Content-Type": "application/json",
+            },
+            "token": token,
+            "params": self._fp_get_consult_params(),
+            "company_id": company.id,
+            "max_concurrency": company.fp_api_max_concurrency,
+        }
+
+    @api.model
+    def _fp_fetch_consult_responses(self, consult_requests, concurrency):
+        """Issue the prepared status GETs concurrently, at most ``concurrency`` at a time.
+
+        Each company is further capped at its own ``max_concurrency``. Returns
+        ``{move: (response, error)}``. Nothing here touches the ORM, so the
+        requests can safely run on executor threads.
+        """
+        if not consult_requests:
+            return {}
+
+        async def _fetch_all(executor):
+            loop = asyncio.get_running_loop()
+            semaphore = asyncio.Semaphore(concurrency)
+            company_semaphores = {
+                request["company_id"]: asyncio.Semaphore(max(1, request["max_concurrency"] or concurrency))
+                for request in consult_requests.values()
+            }
+
+            async def _fetch(move, request):
+                async with company_semaphores[request["company_id"]], semaphore:
+                    try:
+                        response = await loop.run_in_executor(
+                            executor,
+                            functools.partial(
+                                request["transport"].get,
+                                request["url"],
+                                headers=request["headers"],
+                                params=request["params"],
+                                bucket="recepcion_get",
+                            ),
+                        )
+                    except requests.exceptions.RequestException as error:
+                        return move, (None, error)
+                    return move, (response, None)
+
+            return dict(await asyncio.gather(*(_fetch(move, request) for move, request in consult_requests.items())))
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(consult_requests)), thread_name_prefix="fp_poll") as executor:
+            return asyncio.run(_fetch_all(executor))
+
+    def _fp_handle_consult_error(self, error):
+        self.ensure_one()
+        # Una consulta solicitada sobre un documento aún no enviado no consume sus reintentos de envío.
+        if self.fp_api_state == "pending":
+            self._fp_handle_requested_consult_error(error)
+        else:
+            self._fp_handle_cron_consult_error(error)
+
+    def _fp_handle_cron_consult_error(self, error):
+        self.ensure_one()
+        _logger.exception("Error en cron FE consultando documento %s", self.name)
+        # Se descarta solo el trabajo pendiente de este documento; lo demás ya está confirmado.
+        self.env.cr.rollback()
+        self._fp_register_api_failure(error, "consult")
+
+    def _fp_apply_requested_consult(self, response_data):
+        """Resolve a consult requested for a document without a confirmed send."""
+        self.ensure_one()
+        if not response_data.get("ind-estado"):
+            self.fp_next_consult_at = False
+            return
+        # Hacienda sí tiene el documento (p. ej. el envío se confirmó tras un timeout).
+        self._fp_mark_received_by_hacienda(_("La consulta en Hacienda confirmó que el documento fue recibido."))
+        self._fp_apply_hacienda_status(response_data)
+
+    def _fp_handle_requested_consult_error(self, error):
+        self.ensure_one()
+        _logger.info("Consulta solicitada para el documento FE %s sin respuesta de Hacienda: %s", self.name, error)
+        self.env.cr.rollback()
+        # El documento sigue pendiente de envío: la consulta no consume sus reintentos.
+        self.fp_next_consult_at = False
+        if isinstance(error, FpHaciendaApiError) and error.status_code == 404:
+            body = _("Hacienda aún no registra el documento; envíelo para obtener su estado.")
+        else:
+            body = _("No fue posible consultar el estado en Hacienda: %s") % error
+        self.message_post(body=body)
+
+    def _fp_cron_sign_pending_documents(self):
+        try:
+            self._fp_run_cron_batches(
+                "sign",
+                [
+                    ("fp_pipeline_stage", "=", "to_sign"),
+                    ("state", "=", "posted"),
+                    ("fp_xml_attachment_id", "=", False),
+                ],
+                "_fp_cron_sign_batch",
+                "l10n_cr_einvoice.ir_cron_fp_sign_pending_documents",
+                filter_circuit=False,
+            )
+        finally:
+            # Los procesos de firma viven lo que dura la ejecución del cron; no quedan con la llave cargada.
+            xml_signer.shutdown_pools()
+
+    def _fp_cron_sign_batch(self):
+        built = self.browse()
+        roots = []
+        self._fp_prefetch_xml_data()
+        exonerations_by_move = self._fp_get_exonerations_by_move()
+        for move in self:
+            try:
+                with self.env.cr.savepoint():
+                    roots.append(
+                        move._fp_generate_invoice_xml(
+                            clave=move._fp_build_clave(), exonerations=exonerations_by_move[move.id]
+                        )
+                    )
+                built |= move
+            except Exception as error:
+                _logger.exception("Error en cron FE generando el XML del documento %s", move.name)
+                move._fp_register_sign_failure(error)
+                move._fp_release_lease()
+                self.env.cr.commit()
+
+        # La firma de cada compañía va en un solo lote para repartirla entre los procesos de firma.
+        signed = self.browse()
+        for company in built.company_id:
+            company_moves = built.filtered(lambda move: move.company_id == company)
+            company_roots = [root for move, root in zip(built, roots) if move.company_id == company]
+            try:
+                with self.env.cr.savepoint():
+                    results = company._fp_sign_xml_documents(company_roots, parallel=True)
+            except Exception as error:
+                _logger.exception("Error en cron FE firmando los documentos de %s", company.name)
+                for move in company_moves:
+                    move._fp_register_sign_failure(error)
+                    move._fp_release_lease()
+                self.env.cr.commit()
+                continue
+            for index, (move, (signed_xml_bytes, digest)) in enumerate(zip(company_moves, results), 1):
+                move._fp_attach_signed_xml(signed_xml_bytes, digest)
+                self.env.cr.commit()
+                signed |= move
+                if index % FP_CRON_CHUNK_SIZE == 0:
+                    self.env.invalidate_all()
+        if signed:
+            self.env.ref("l10n_cr_einvoice.ir_cron_fp_send_pending_documents")._trigger()
+
+    def _fp_register_sign_failure(self, error):
+        self.ensure_one()
+        # Un certificado o dato inválido no se corrige solo: se reintenta en una hora.
+        self.write(
+            {
+                "fp_api_last_error": str(error),
+                "fp_api_next_attempt_at": fields.Datetime.now() + timedelta(hours=1),
+            }
+        )
+        self.message_post(body=_("No se pudo generar y firmar el XML: %s") % error)
+
+    def _fp_cron_notify_accepted_documents(self):
+        companies = self.env["res.company"].search([])
+        auto_email_companies = companies.filtered(
+            lambda company: company.with_company(company).fp_auto_send_email_when_accepted
+        )
+        self._fp_run_cron_batches(
+            "notify",
             [
-                ("fp_is_electronic_invoice", "=", True),
-                ("fp_api_state", "=", "pending"),
-                ("state", "=", "posted"),
-                ("fp_xml_attachment_id", "!=", False),
+                ("fp_pipeline_stage", "=", "accepted"),
+                ("move_type", "in", ("out_invoice", "out_refund")),
+                ("company_id", "in", auto_email_companies.ids),
             ],
-            limit=200,
+            "_fp_cron_notify_batch",
+            "l10n_cr_einvoice.ir_cron_fp_notify_accepted_documents",
+            filter_circuit=False,
         )
-        for move in moves:
+
+    def _fp_cron_notify_batch(self):
+        for index, move in enumerate(self, 1):
             try:
-                move._fp_send_to_hacienda()
+                if move.fp_email_sent:
+                    move._fp_set_pipeline_stage("notified")
+                elif not move._fp_send_accepted_invoice_email():
+                    # Sin plantilla de correo disponible: se reintenta más tarde.
+                    move.fp_api_next_attempt_at = fields.Datetime.now() + timedelta(hours=1)
             except Exception as error:
-                _logger.exception("Error en cron FE enviando documento %s", move.name)
-                move.fp_api_state = "error"
-                move.message_post(body=_("Error en envío automático a Hacienda: %s") % error)
+                _logger.exception("Error en cron FE enviando el correo del documento %s", move.name)
+                self.env.cr.rollback()
+                move.write(
+                    {
+                        "fp_api_last_error": str(error),
+                        "fp_api_next_attempt_at": fields.Datetime.now() + timedelta(hours=1),
+                    }
+                )
+            move._fp_release_lease()
+            self.env.cr.commit()
+            if index % FP_CRON_CHUNK_SIZE == 0:
+                self.env.invalidate_all()
+
+    def _fp_cron_send_pending_documents(self):
+        self._fp_run_cron_batches(
+            "send",
+            self._fp_get_send_candidates_domain(),
+            "_fp_cron_send_batch",
+            "l10n_cr_einvoice.ir_cron_fp_send_pending_documents",
+            select_method="_fp_select_send_batch",
+        )
+        self._fp_trigger_consult_cron()
+
+    @api.model
+    def _fp_get_send_candidates_domain(self):
+        return [
+            ("fp_pipeline_stage", "=", "queued"),
+            ("fp_is_electronic_invoice", "=", True),
+            ("fp_api_state", "=", "pending"),
+            ("state", "=", "posted"),
+            ("fp_xml_attachment_id", "!=", False),
+        ]
+
+    @api.model
+    def _fp_select_send_batch(self, domain, limit):
+        return self._fp_select_fair_batch(domain, limit, self._fp_select_lane_batch)
+
+    @api.model
+    def _fp_select_lane_batch(self, domain, limit):
+        """Pick the next send batch across priority lanes.
+
+        Lower lanes are first guaranteed their configured minimum share of the
+        batch; the rest goes to the highest lanes with work, so interactive
+        documents stay fast without starving bulk runs.
+        """
+        params = self.env["ir.config_parameter"].sudo()
+        min_shares = {
+            "normal": int(params.get_param("l10n_cr_einvoice.lane_min_share_normal", 20) or 0),
+            "low": int(params.get_param("l10n_cr_einvoice.lane_min_share_low", 10) or 0),
+        }
+        lanes = [lane for lane, _label in FP_QUEUE_PRIORITIES]
+        selected = self.browse()
+        for lane, share in min_shares.items():
+            quota = limit * share // 100
+            if quota:
+                selected |= self.search([*domain, ("fp_queue_priority", "=", lane)], limit=quota, order="id")
+        for lane in lanes:
+            if len(selected) >= limit:
+                break
+            selected |= self.search(
+                [*domain, ("fp_queue_priority", "=", lane), ("id", "not in", selected.ids)],
+                limit=limit - len(selected),
+                order="id",
+            )
+        if len(selected) < limit:
+            # Documentos sin carril asignado (anteriores a los carriles) van al final.
+            selected |= self.search(
+                [*domain, ("fp_queue_priority", "=", False)], limit=limit - len(selected), order="id"
+            )
+        # Se despachan en orden de carril: primero los de mayor prioridad.
+        return selected.sorted(lambda move: (lanes.index(move.fp_queue_priority or "normal"), move.id))
+
+    @api.model
+    def _fp_select_consult_batch(self, domain, limit):
+        return self._fp_select_fair_batch(
+            domain,
+            limit,
+            lambda company_domain, quota: self.search(company_domain, limit=quota, order="fp_next_consult_at, id"),
+        )
+
+    @api.model
+    def _fp_select_fair_batch(self, domain, limit, select):
+        """Share a batch of ``limit`` documents between the companies with work due.
+
+        Slots are handed out by weighted round-robin on ``fp_queue_weight`` so a
+        company with a large backlog cannot starve the others, then each
+        company's documents are picked with ``select(domain, quota)`` and the
+        result is interleaved company by company.
+        """
+        backlog = dict(self._read_group(domain, ["company_id"], ["__count"]))
+        if not backlog:
+            return self.browse()
+        companies = sorted(backlog, key=lambda company: company.id)
+        quotas = Counter()
+        free_slots = limit
+        while free_slots:
+            assigned = 0
+            for company in companies:
+                take = min(max(company.fp_queue_weight, 1), backlog[company] - quotas[company], free_slots)
+                if take > 0:
+                    quotas[company] += take
+                    free_slots -= take
+                    assigned += take
+            if not assigned:
+                break
+
+        per_company = [
+            deque(select([*domain, ("company_id", "=", company.id)], quotas[company]).ids)
+            for company in companies
+            if quotas[company]
+        ]
+        move_ids = []
+        while per_company:
+            for queue in list(per_company):
+                move_ids.append(queue.popleft())
+                if not queue:
+                    per_company.remove(queue)
+        return self.browse(move_ids)
+
+    def _fp_cron_send_batch(self):
+        moves = self.with_context(fp_commit_per_document=True)
+        workers = int(self.env["ir.config_parameter"].sudo().get_param("l10n_cr_einvoice.send_workers", 4) or 1)
+        if workers > 1 and len(moves) > 1:
+            moves._fp_run_in_worker_cursors(moves.ids, "_fp_cron_send_document", workers)
+            return
+        for index, move in enumerate(moves, 1):
+            move._fp_cron_send_document()
+            if index % FP_CRON_CHUNK_SIZE == 0:
+                self.env.invalidate_all()
+
+    @api.model
+    def _fp_run_cron_batches(self, kind, domain, batch_method, cron_xmlid, filter_circuit=True, select_method=None):
+        """Process due documents matching ``domain`` in batches until the time budget is spent.
+
+        Each batch is chosen by ``select_method`` (oldest first by default),
+        claimed and handed to ``batch_method``. Documents handled
+        in this run are not picked again, and when the budget runs out with
+        work still due the cron re-triggers itself right away instead of
+        waiting for its next interval.
+        """
+        params = self.env["ir.config_parameter"].sudo()
+        batch_size = max(int(params.get_param("l10n_cr_einvoice.cron_batch_size", 200) or 200), 1)
+        time_budget = int(params.get_param("l10n_cr_einvoice.cron_time_budget", 240) or 0)
+        deadline = time.monotonic() + time_budget
+        due_domain = [*domain, *self._fp_get_retry_due_domain(), *self._fp_get_lease_free_domain()]
+        processed_ids = []
+        budget_exhausted = False
+        while True:
+            batch_domain = [*due_domain, ("id", "not in", processed_ids)]
+            if select_method:
+                candidates = getattr(self, select_method)(batch_domain, batch_size)
+            else:
+                candidates = self.search(batch_domain, limit=batch_size, order="id")
+            if filter_circuit:
+                candidates = candidates._fp_filter_circuit_closed()
+            moves = candidates._fp_claim()
+            if not moves:
+                break
+            processed_ids += moves.ids
+            getattr(moves, batch_method)()
+            self.env.invalidate_all()
+            if time.monotonic() >= deadline:
+                budget_exhausted = True
+                break
+
+        remaining = self.search_count([*due_domain, ("id", "not in", processed_ids)]) if budget_exhausted else 0
+        _logger.info("Cron FE (%s): %s documentos procesados, %s pendientes.", kind, len(processed_ids), remaining)
+        self.env["fp.cron.run"]._fp_record(kind, len(processed_ids), remaining)
+        if remaining:
+            self.env.ref(cron_xmlid)._trigger()
+        self.env.cr.commit()
+
+    def _fp_cron_send_document(self):
+        self.ensure_one()
+        # Otro proceso pudo enviarlo entre la búsqueda y el reclamo.
+        if self.fp_api_state == "pending":
+            try:
+                self._fp_send_to_hacienda()
+            except Exception as error:
+                _logger.exception("Error en cron FE enviando documento %s", self.name)
+                # Si el POST llegó a Hacienda ya quedó confirmado; solo se revierte lo posterior.
+                self.env.cr.rollback()
+                self.invalidate_recordset(["fp_invoice_status"])
+                if self.fp_invoice_status == "sent":
+                    # Hacienda ya recibió el documento: no es un fallo de envío, solo se
+                    # vuelve a agendar la consulta que no se llegó a programar.
+                    self._fp_schedule_next_consult(0)
+                else:
+                    self._fp_register_api_failure(error, "send")
+        self._fp_release_lease()
+        self._fp_notify_status_change()
+        self.env.cr.commit()
+
+    def _fp_commit_progress(self):
+        """Commit the work done so far when running from a FE cron (one transaction per document)."""
+        if self.env.context.get("fp_commit_per_document"):
+            self.env.cr.commit()
+
+    @api.model
+    def _fp_get_lease_free_domain(self):
+        return [
+            "|",
+            ("fp_lease_until", "=", False),
+            ("fp_lease_until", "<", fields.Datetime.now()),
+        ]
+
+    def _fp_claim(self, lease_seconds=FP_LEASE_SECONDS):
+        """Lease the moves in ``self`` that no other worker holds and return them.
+
+        Rows are selected with ``FOR UPDATE SKIP LOCKED`` so concurrent crons
+        (or an interactive action holding the row) never pick the same
+        document, then stamped with a lease and committed right away: the
+        lease keeps the claim visible to other workers once the row lock is
+        released, and expires on its own if this worker dies.
+        """
+        if not self:
+            return self
+        lease_token = uuid.uuid4().hex
+        self.env.cr.execute(
+            """
+            SELECT id
+              FROM account_move
+             WHERE id = ANY(%s)
+               AND (fp_lease_until IS NULL OR fp_lease_until < (now() AT TIME ZONE 'UTC'))
+             ORDER BY array_position(%s, id)
+               FOR UPDATE SKIP LOCKED
+            """,
+            [self.ids, self.ids],
+        )
+        claimed_ids = [row[0] for row in self.env.cr.fetchall()]
+        if claimed_ids:
+            self.env.cr.execute(
+                """
+                UPDATE account_move
+                   SET fp_lease_until = (now() AT TIME ZONE 'UTC') + %s * interval '1 second',
+                       fp_lease_token = %s
+                 WHERE id = ANY(%s)
+                """,
+                [lease_seconds, lease_token, claimed_ids],
+            )
+        # Se confirma el reclamo antes de llamar a Hacienda para que otros workers lo vean.
+        self.env.cr.commit()
+        claimed = self.browse(claimed_ids)
+        claimed.invalidate_recordset()
+        return claimed
+
+    def _fp_release_lease(self):
+        if self:
+            self.write({"fp_lease_until": False, "fp_lease_token": False})
+
+    def _fp_lock_for_processing(self):
+        """Row-lock the moves for an interactive action, refusing if a worker holds them."""
+        if not self:
+            return
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute(
+                    """
+                    SELECT id, fp_lease_until > (now() AT TIME ZONE 'UTC')
+                      FROM account_move
+                     WHERE id IN %s
+                       FOR UPDATE NOWAIT
+                    """,
+                    [tuple(self.ids)],
+                )
+                leased_ids = [move_id for move_id, leased in self.env.cr.fetchall() if leased]
+        except pg_errors.LockNotAvailable:
+            leased_ids = self.ids
+        if leased_ids:
+            raise UserError(
+                _("Los documentos %(documents)s se están procesando en segundo plano. Intente de nuevo en unos minutos.")
+                % {"documents": ", ".join(self.browse(leased_ids).mapped("name"))}
+            )
+
+    @api.model
+    def _fp_run_in_worker_cursors(self, move_ids, method_name, max_workers):
+        """Call ``method_name`` on each move from a pool of threads.
+
+        Every document runs on its own cursor and environment and is committed
+        independently, so a failure or rollback never affects the others.
+        Moves are dispatched in the given order, but never more than the
+        company's ``fp_api_max_concurrency`` at once for the same company.
+        """
+        move_companies = {move.id: move.company_id for move in self.browse(move_ids)}
+        company_caps = {
+            company.id: max(1, company.fp_api_max_concurrency or max_workers) for company in move_companies.values()
+        }
+        dbname = self.env.cr.dbname
+        registry = self.env.registry
+        uid = self.env.uid
+        context = dict(self.env.context)
+
+        def _run(move_id):
+            threading.current_thread().dbname = dbname
+            try:
+                with registry.cursor() as cr:
+                    env = api.Environment(cr, uid, context)
+                    getattr(env["account.move"].browse(move_id), method_name)()
+            except Exception:
+                _logger.exception("Error procesando documento FE %s en segundo plano", move_id)
+
+        pending = deque(move_ids)
+        running = Counter()
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fp_worker") as executor:
+            while pending or in_flight:
+                # Se despacha en orden, saltando las compañías que ya usan todo su cupo.
+                waiting = deque()
+                while pending and len(in_flight) < max_workers:
+                    move_id = pending.popleft()
+                    company_id = move_companies[move_id].id
+                    if running[company_id] >= company_caps[company_id]:
+                        waiting.append(move_id)
+                        continue
+                    running[company_id] += 1
+                    in_flight[executor.submit(_run, move_id)] = company_id
+                waiting.extend(pending)
+                pending = waiting
+                done, _not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running[in_flight.pop(future)] -= 1
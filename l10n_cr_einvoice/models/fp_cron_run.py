@@ -0,0 +1,31 @@
+from odoo import api, fields, models
+
+FP_CRON_KINDS = [
+    ("sign", "Firma"),
+    ("send", "Envío"),
+    ("consult", "Consulta"),
+    ("notify", "Notificación"),
+]
+
+
+class FpCronRun(models.Model):
+    _name = "fp.cron.run"
+    _description = "Última ejecución de un cron FE"
+    _order = "kind"
+
+    kind = fields.Selection(FP_CRON_KINDS, string="Cron", required=True)
+    date = fields.Datetime(string="Fecha", required=True, default=fields.Datetime.now)
+    processed = fields.Integer(string="Procesados")
+    remaining = fields.Integer(string="Pendientes")
+
+    _fp_cron_run_kind_unique = models.Constraint("UNIQUE(kind)", "Solo se guarda la última ejecución de cada cron FE.")
+
+    @api.model
+    def _fp_record(self, kind, processed, remaining):
+        # Una fila por cron en lugar de ir.config_parameter: escribir parámetros invalida la caché de todos los workers.
+        vals = {"date": fields.Datetime.now(), "processed": processed, "remaining": remaining}
+        run = self.sudo().search([("kind", "=", kind)], limit=1)
+        if run:
+            run.write(vals)
+        else:
+            self.sudo().create({"kind": kind, **vals})
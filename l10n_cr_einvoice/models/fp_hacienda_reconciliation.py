@@ -0,0 +1,148 @@
+import logging
+from datetime import timedelta
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError, ValidationError
+
+_logger = logging.getLogger(__name__)
+
+# Días de holgura sobre invoice_date al buscar los documentos locales: Hacienda lista por
+# fecha de emisión, que puede diferir de la fecha contable (facturas con fecha anterior).
+FP_RECONCILIATION_DATE_MARGIN = 31
+
+
+class FpHaciendaReconciliation(models.Model):
+    _name = "fp.hacienda.reconciliation"
+    _description = "Conciliación de comprobantes con Hacienda"
+    _order = "id desc"
+
+    name = fields.Char(string="Nombre", compute="_compute_name", store=True)
+    company_id = fields.Many2one("res.company", string="Compañía", required=True, default=lambda self: self.env.company)
+    date_from = fields.Date(string="Desde", required=True)
+    date_to = fields.Date(string="Hasta", required=True)
+    state = fields.Selection(
+        [
+            ("draft", "Borrador"),
+            ("queued", "En cola"),
+            ("running", "En proceso"),
+            ("done", "Terminada"),
+            ("failed", "Fallida"),
+        ],
+        string="Estado",
+        default="draft",
+        required=True,
+        readonly=True,
+    )
+    listed_count = fields.Integer(string="Comprobantes listados por Hacienda", readonly=True)
+    local_count = fields.Integer(string="Documentos locales en el rango", readonly=True)
+    matched_count = fields.Integer(string="Documentos encontrados en Hacienda", readonly=True)
+    recovered_move_ids = fields.Many2many(
+        "account.move",
+        "fp_reconciliation_recovered_move_rel",
+        string="Recibidos sin confirmar",
+        readonly=True,
+        help="Documentos que Hacienda sí recibió aunque localmente no constaba el envío (p. ej. por un timeout).",
+    )
+    unseen_move_ids = fields.Many2many(
+        "account.move",
+        "fp_reconciliation_unseen_move_rel",
+        string="No registrados en Hacienda",
+        readonly=True,
+        help="Documentos enviados o intentados que no aparecen en el listado de Hacienda.",
+    )
+    error = fields.Text(string="Error", readonly=True)
+    date_done = fields.Datetime(string="Terminada el", readonly=True)
+
+    @api.depends("date_from", "date_to")
+    def _compute_name(self):
+        for reconciliation in self:
+            reconciliation.name = _("Conciliación %(date_from)s - %(date_to)s") % {
+                "date_from": reconciliation.date_from or "",
+                "date_to": reconciliation.date_to or "",
+            }
+
+    @api.constrains("date_from", "date_to")
+    def _check_dates(self):
+        for reconciliation in self:
+            if reconciliation.date_from > reconciliation.date_to:
+                raise ValidationError(_("La fecha inicial no puede ser posterior a la final."))
+
+    def action_queue(self):
+        self.write({"state": "queued", "error": False})
+        self.env.ref("l10n_cr_einvoice.ir_cron_fp_run_reconciliations")._trigger()
+
+    def action_resend_unseen(self):
+        self.ensure_one()
+        moves = self.unseen_move_ids.filtered(
+            lambda move: move.fp_hacienda_unseen and move.fp_invoice_status in (False, "sent")
+        )
+        if not moves:
+            raise UserError(_("No hay documentos pendientes de reenviar."))
+        moves.write(
+            {
+                "fp_invoice_status": False,
+                "fp_api_state": "pending",
+                "fp_api_attempt_count": 0,
+                "fp_next_consult_at": False,
+            }
+        )
+        moves._fp_enqueue_send()
+        for move in moves:
+            move.message_post(body=_("Reenvío solicitado: el documento no aparece en el listado de Hacienda."))
+
+    @api.model
+    def _cron_run_queued(self):
+        for reconciliation in self.search([("state", "=", "queued")], order="id"):
+            reconciliation.state = "running"
+            self.env.cr.commit()
+            try:
+                reconciliation._run()
+            except Exception as error:
+                _logger.exception("Error conciliando comprobantes con Hacienda (%s)", reconciliation.name)
+                self.env.cr.rollback()
+                reconciliation.write({"state": "failed", "error": str(error)})
+            self.env.cr.commit()
+
+    def _run(self):
+        """Match the local documents of the period against Hacienda's listing in one pass."""
+        self.ensure_one()
+        now = fields.Datetime.now()
+        candidates = self.env["account.move"].with_company(self.company_id).search(
+            [
+                ("company_id", "=", self.company_id.id),
+                ("fp_is_electronic_invoice", "=", True),
+                ("state", "=", "posted"),
+                ("fp_external_id", "!=", False),
+                ("invoice_date", ">=", self.date_from - timedelta(days=FP_RECONCILIATION_DATE_MARGIN)),
+                ("invoice_date", "<=", self.date_to + timedelta(days=FP_RECONCILIATION_DATE_MARGIN)),
+            ]
+        )
+        # Se compara con la misma fecha que filtra el listado: la de emisión codificada en la clave.
+        candidates = candidates.filtered(
+            lambda move: self.date_from
+            <= (move._fp_get_clave_issue_date(move.fp_external_id) or move.invoice_date)
+            <= self.date_to
+        )
+        listed_claves = candidates[:1]._fp_fetch_hacienda_listing(self.date_from, self.date_to) if candidates else set()
+        # Los documentos que un worker tiene reservados se dejan para la próxima conciliación.
+        available = candidates.filtered(lambda move: not move.fp_lease_until or move.fp_lease_until < now)
+        matched = available.filtered(lambda move: move.fp_external_id in listed_claves)
+        recovered = matched.filtered(lambda move: move.fp_invoice_status not in ("sent", "accepted", "rejected"))
+        unseen = (available - matched).filtered(
+            lambda move: move.fp_invoice_status == "sent" or move.fp_api_attempt_count or move.fp_api_state == "dead"
+        )
+
+        recovered._fp_mark_received_by_hacienda()
+        matched.filtered("fp_hacienda_unseen").fp_hacienda_unseen = False
+        unseen.fp_hacienda_unseen = True
+        self.write(
+            {
+                "state": "done",
+                "listed_count": len(listed_claves),
+                "local_count": len(candidates),
+                "matched_count": len(matched),
+                "recovered_move_ids": [(6, 0, recovered.ids)],
+                "unseen_move_ids": [(6, 0, unseen.ids)],
+                "date_done": fields.Datetime.now(),
+            }
+        )
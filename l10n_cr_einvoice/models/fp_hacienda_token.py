@@ -0,0 +1,97 @@
+import hashlib
+from datetime import timedelta, timezone
+
+from odoo import api, fields, models
+
+
+class FpHaciendaToken(models.Model):
+    _name = "fp.hacienda.token"
+    _description = "Token OAuth compartido de Hacienda"
+
+    # Margen (segundos) con el que un token se considera vencido antes de su expiración real.
+    _FP_EXPIRY_MARGIN = 30
+
+    key = fields.Char(string="Llave", required=True, index=True)
+    access_token = fields.Text(string="Access token")
+    expires_at = fields.Datetime(string="Vence")
+    refresh_token = fields.Text(string="Refresh token")
+    refresh_expires_at = fields.Datetime(string="Vence refresh token")
+
+    _fp_hacienda_token_key_unique = models.Constraint(
+        "UNIQUE(key)", "Solo puede existir un token compartido por credencial de Hacienda."
+    )
+
+    @api.model
+    def _fp_build_key(self, cache_key):
+        return hashlib.sha256("|".join(cache_key).encode("utf-8")).hexdigest()
+
+    @api.model
+    def _fp_lock(self, key):
+        # Bloqueo transaccional: se libera solo al confirmar o revertir el cursor dedicado.
+        self.env.cr.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"{self._name}:{key}"])
+
+    def _fp_is_valid(self, expiry_field, now):
+        self.ensure_one()
+        expires_at = self[expiry_field]
+        return bool(expires_at and expires_at - timedelta(seconds=self._FP_EXPIRY_MARGIN) > now)
+
+    def _fp_to_cache_entry(self):
+        self.ensure_one()
+        expires_at = self.expires_at.replace(tzinfo=timezone.utc).timestamp()
+        return {
+            "access_token": self.access_token,
+            "expires_at": expires_at - self._FP_EXPIRY_MARGIN,
+        }
+
+    @api.model
+    def _fp_get_shared_token(self, cache_key, fetch_token):
+        """Return a valid token for ``cache_key``, refreshing the shared row if needed.
+
+        The row is read and refreshed on a dedicated cursor holding a Postgres
+        advisory lock, so exactly one process talks to the IDP while the
+        others wait on the lock and then reuse the freshly committed token.
+        ``fetch_token(refresh_token)`` performs the OAuth request and returns
+        the decoded JSON response.
+        """
+        key = self._fp_build_key(cache_key)
+        with self.env.registry.cursor() as cr:
+            token_model = self.env(cr=cr, su=True)[self._name]
+            token_model._fp_lock(key)
+            record = token_model.search([("key", "=", key)], limit=1)
+            now = fields.Datetime.now()
+            if record.access_token and record._fp_is_valid("expires_at", now):
+                return record._fp_to_cache_entry()
+
+            refresh_token = record.refresh_token if record and record._fp_is_valid("refresh_expires_at", now) else False
+            token_data = fetch_token(refresh_token)
+            vals = {
+                "key": key,
+                "access_token": token_data["access_token"],
+                "expires_at": now + timedelta(seconds=self._fp_parse_lifetime(token_data.get("expires_in"), 300)),
+                "refresh_token": token_data.get("refresh_token") or False,
+                "refresh_expires_at": now
+                + timedelta(seconds=self._fp_parse_lifetime(token_data.get("refresh_expires_in"), 0)),
+            }
+            if record:
+                record.write(vals)
+            else:
+                record = token_model.create(vals)
+            return record._fp_to_cache_entry()
+
+    @api.model
+    def _fp_invalidate_shared_token(self, cache_key, access_token):
+        key = self._fp_build_key(cache_key)
+        with self.env.registry.cursor() as cr:
+            token_model = self.env(cr=cr, su=True)[self._name]
+            token_model._fp_lock(key)
+            record = token_model.search([("key", "=", key), ("access_token", "=", access_token)], limit=1)
+            if record:
+                # Se conserva el refresh_token para renovar sin volver a enviar la contraseña.
+                record.expires_at = fields.Datetime.now()
+
+    @api.model
+    def _fp_parse_lifetime(self, value, default):
+        try:
+            return int(value or default)
+        except (TypeError, ValueError):
+            return default
@@ -0,0 +1,88 @@
+import json
+from contextlib import contextmanager
+
+from odoo import api, fields, models, sql_db
+
+from ..tools import hacienda_transport
+
+# Un almacén por base de datos; lo comparten todos los transportes del proceso.
+_STORES = {}
+
+
+class FpDatabaseStateSession:
+    """Reads and writes ``fp_hacienda_transport_state`` rows on the cursor of one store transaction."""
+
+    def __init__(self, cr, now):
+        self.cr = cr
+        self.now = now
+        self.states = {}
+        self.loaded = {}
+        self.locked_keys = set()
+
+    def get(self, key, lock=True):
+        if key in self.states and (key in self.locked_keys or not lock):
+            return self.states[key]
+        if lock:
+            self.cr.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"fp.hacienda.transport.state:{key}"])
+            self.locked_keys.add(key)
+        self.cr.execute("SELECT data FROM fp_hacienda_transport_state WHERE key = %s", [key])
+        row = self.cr.fetchone()
+        self.loaded[key] = (row and row[0]) or {}
+        self.states[key] = dict(self.loaded[key])
+        return self.states[key]
+
+    def flush(self):
+        # Solo se escriben las llaves bloqueadas cuyo estado cambió.
+        for key in self.locked_keys:
+            if self.states[key] != self.loaded[key]:
+                self.cr.execute(
+                    """
+                    INSERT INTO fp_hacienda_transport_state (key, data, create_date, write_date)
+                    VALUES (%s, %s, now() AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC')
+                    ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, write_date = EXCLUDED.write_date
+                    """,
+                    [key, json.dumps(self.states[key])],
+                )
+
+
+class FpDatabaseStateStore(hacienda_transport.StateStore):
+    """``hacienda_transport`` state store backed by ``fp_hacienda_transport_state`` rows.
+
+    Each transaction runs on one dedicated cursor; keys are locked with a
+    Postgres advisory lock only when they may be updated, so every worker
+    and node of the database reads and updates the same state while
+    unrelated companies never wait on each other.
+    """
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+
+    @contextmanager
+    def transaction(self):
+        with sql_db.db_connect(self.dbname).cursor() as cr:
+            # El reloj de la base de datos es común a todos los nodos.
+            cr.execute("SELECT extract(epoch FROM clock_timestamp())")
+            session = FpDatabaseStateSession(cr, float(cr.fetchone()[0]))
+            yield session
+            session.flush()
+
+
+class FpHaciendaTransportState(models.Model):
+    _name = "fp.hacienda.transport.state"
+    _description = "Estado compartido de la conexión con Hacienda"
+
+    key = fields.Char(string="Llave", required=True, index=True)
+    data = fields.Json(string="Estado")
+
+    _fp_hacienda_transport_state_key_unique = models.Constraint(
+        "UNIQUE(key)", "Solo puede existir un estado compartido por llave."
+    )
+
+    @api.model
+    def _fp_get_store(self):
+        """Return the store shared by every process of this database (rate limits and circuit breakers)."""
+        dbname = self.env.cr.dbname
+        store = _STORES.get(dbname)
+        if store is None:
+            store = _STORES[dbname] = FpDatabaseStateStore(dbname)
+        return store
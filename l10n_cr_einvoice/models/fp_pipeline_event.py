@@ -0,0 +1,38 @@
+from odoo import fields, models
+
+# Etapas del ciclo de vida FE, en orden. Cada una tiene su propia cola indexada en account.move.
+FP_PIPELINE_STAGES = [
+    ("to_sign", "Por firmar"),
+    ("signed", "Firmado"),
+    ("queued", "En cola de envío"),
+    ("submitted", "Enviado"),
+    ("polling", "Consultando estado"),
+    ("accepted", "Aceptado"),
+    ("rejected", "Rechazado"),
+    ("notified", "Notificado al cliente"),
+]
+
+# Carriles de prioridad del envío, de mayor a menor.
+FP_QUEUE_PRIORITIES = [
+    ("high", "Alta"),
+    ("normal", "Normal"),
+    ("low", "Baja"),
+]
+
+# Prioridad por defecto según el tipo de comprobante cuando el diario no define una.
+FP_DOCUMENT_TYPE_PRIORITIES = {
+    "TE": "high",
+    "FEC": "low",
+}
+
+
+class FpPipelineEvent(models.Model):
+    _name = "fp.pipeline.event"
+    _description = "Transición de etapa FE"
+    _order = "date desc, id desc"
+
+    move_id = fields.Many2one("account.move", string="Documento", required=True, index=True, ondelete="cascade")
+    company_id = fields.Many2one(related="move_id.company_id", store=True)
+    previous_stage = fields.Selection(FP_PIPELINE_STAGES, string="Etapa anterior")
+    stage = fields.Selection(FP_PIPELINE_STAGES, string="Etapa", required=True)
+    date = fields.Datetime(string="Fecha", required=True, default=fields.Datetime.now)
@@ -2,8 +2,10 @@ import base64
 import binascii
 
 from cryptography.hazmat.primitives.serialization import pkcs12
-from odoo import api, fields, models
-from odoo.exceptions import ValidationError
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import hacienda_transport, xml_signer
 
 
 
@@ -58,8 +60,48 @@ class ResCompany(models.Model):
     )
     fp_hacienda_username = fields.Char(string="Hacienda Username", company_dependent=True)
     fp_hacienda_password = fields.Char(string="Hacienda Password", company_dependent=True)
-    fp_api_timeout = fields.Integer(
-        string="Hacienda API Timeout (s)", default=30
+    fp_api_connect_timeout = fields.Integer(
+        string="Hacienda API Connect Timeout (s)", default=10
+    )
+    fp_api_read_timeout = fields.Integer(
+        string="Hacienda API Read Timeout (s)", default=30
+    )
+    fp_api_pool_size = fields.Integer(
+        string="Conexiones simultáneas con Hacienda",
+        default=10,
+        help="Tamaño del pool de conexiones keep-alive reutilizadas en las llamadas a Hacienda.",
+    )
+    fp_api_rate_limit = fields.Float(
+        string="Solicitudes por segundo a Hacienda",
+        default=5.0,
+        help="Ritmo máximo sostenido por endpoint (token, envío, consulta) para esta compañía, sumando todos los procesos de Odoo. Use 0 para no limitar.",
+    )
+    fp_api_rate_burst = fields.Integer(
+        string="Ráfaga máxima de solicitudes",
+        default=10,
+        help="Solicitudes que pueden enviarse de inmediato antes de aplicar el ritmo máximo.",
+    )
+    fp_api_max_attempts = fields.Integer(
+        string="Máximo de intentos con Hacienda",
+        default=8,
+        help="Intentos automáticos ante fallas transitorias antes de marcar el documento como 'Reintentos agotados'.",
+    )
+    fp_api_retry_base_delay = fields.Integer(
+        string="Retraso base entre reintentos (s)",
+        default=60,
+        help="El retraso se duplica en cada intento fallido (con variación aleatoria) hasta un máximo de 6 horas.",
+    )
+    fp_api_max_concurrency = fields.Integer(
+        string="Solicitudes simultáneas a Hacienda",
+        default=4,
+        help="Máximo de envíos o consultas de esta compañía en vuelo al mismo tiempo, "
+        "según las cuotas de sus credenciales. 0 usa el límite global.",
+    )
+    fp_queue_weight = fields.Integer(
+        string="Peso en el reparto entre compañías",
+        default=1,
+        help="Cada lote de los crons FE se reparte por turnos entre compañías; una compañía con peso 2 "
+        "recibe el doble de cupos que una con peso 1.",
     )
     fp_economic_activity_id = fields.Many2one(
         "fp.economic.activity",
@@ -99,11 +141,27 @@ class ResCompany(models.Model):
         company_dependent=True,
         help="Selecciona el estilo del PDF FE. Usa 'Estándar Odoo' para el formato original; el resto aplica plantillas personalizadas.",
     )
+    fp_deferred_signing = fields.Boolean(
+        string="Firmar XML en segundo plano",
+        company_dependent=True,
+        default=False,
+        help="Al confirmar solo se reservan consecutivo y clave; un cron genera y firma los XML por lotes "
+        "y el envío a Hacienda toma únicamente los documentos ya firmados.",
+    )
     fp_auto_consult_after_send = fields.Boolean(
         string="Consultar estado automáticamente después de enviar",
         company_dependent=True,
         default=True,
+        help="La primera consulta se agenda segundos después del envío y las siguientes se espacian "
+        "progresivamente (30 s, 2 min, 10 min y luego cada hora) hasta que Hacienda resuelva.",
+    )
+    fp_hacienda_callback_url = fields.Char(
+        string="URL de notificación de Hacienda",
+        help="Se envía como callbackUrl en cada comprobante para que Hacienda notifique el estado. "
+        "Si está vacía el estado solo se obtiene consultando.",
+        groups="base.group_system",
     )
+    fp_hacienda_callback_token = fields.Char(copy=False, groups="base.group_system")
     fp_auto_send_email_when_accepted = fields.Boolean(
         string="Enviar correo automáticamente al aceptar en Hacienda",
         company_dependent=True,
@@ -175,6 +233,10 @@ class ResCompany(models.Model):
         compute="_compute_fp_certificate_info",
     )
 
+    _fp_api_max_concurrency_positive = models.Constraint(
+        "CHECK (fp_api_max_concurrency >= 0)", "Las solicitudes simultáneas a Hacienda no pueden ser negativas."
+    )
+
 
     @api.model
     def _fp_get_hacienda_config_values(self, sandbox_mode):
@@ -199,6 +261,9 @@ class ResCompany(models.Model):
 
     def write(self, vals):
         result = super().write(vals)
+        if {"fp_signing_certificate_file", "fp_signing_certificate_password"} & vals.keys():
+            for company in self:
+                xml_signer.invalidate_signer((self.env.cr.dbname, company.id))
         if not self.env.context.get("fp_skip_hacienda_sync"):
             self._fp_sync_hacienda_environment_values()
         return result
@@ -218,6 +283,64 @@ class ResCompany(models.Model):
                     "La URL OAuth de Hacienda debe apuntar al endpoint '/protocol/openid-connect/token'."
                 )
 
+    def _fp_get_hacienda_recepcion_root_url(self):
+        """Return the ``.../recepcion/v1`` root of the configured API base URL."""
+        self.ensure_one()
+        base_url = (self.fp_hacienda_api_base_url or "").rstrip("/")
+        for root in ("/recepcion/v1", "/recepcion-sandbox/v1"):
+            if base_url.endswith(f"{root}/recepcion"):
+                return base_url[: -len("/recepcion")]
+            if base_url.endswith(root):
+                return base_url
+        return f"{base_url}/recepcion/v1"
+
+    def _fp_get_hacienda_transport(self):
+        self.ensure_one()
+        return hacienda_transport.get_transport(
+            (self.env.cr.dbname, self.id),
+            pool_size=self.fp_api_pool_size,
+            connect_timeout=self.fp_api_connect_timeout,
+            read_timeout=self.fp_api_read_timeout,
+            rate_limit=self.fp_api_rate_limit,
+            rate_burst=self.fp_api_rate_burst,
+            store=self.env["fp.hacienda.transport.state"]._fp_get_store(),
+        )
+
+    def _fp_get_signer_source(self):
+        """Return ``(cache key, fingerprint, loader)`` identifying the company certificate for ``xml_signer``."""
+        self.ensure_one()
+        attachment = self.env["ir.attachment"].sudo().search(
+            [
+                ("res_model", "=", self._name),
+                ("res_id", "=", self.id),
+                ("res_field", "=", "fp_signing_certificate_file"),
+            ],
+            limit=1,
+        )
+        if not attachment:
+            raise UserError(_("Configure el certificado FE (.p12/.pfx) para firmar XML en Ajustes > Contabilidad."))
+        password = (self.fp_signing_certificate_password or "").encode("utf-8") or None
+        fingerprint = (attachment.checksum, xml_signer.password_fingerprint(password))
+        return (self.env.cr.dbname, self.id), fingerprint, lambda: (attachment.raw, password)
+
+    def _fp_sign_xml_documents(self, roots, parallel=False):
+        """Sign the document trees ``roots`` as one batch and return ``(signed_bytes, sha256 hex)`` pairs in order.
+
+        Only the sign cron passes ``parallel``: the signing pool is never
+        started from an HTTP worker.
+        """
+        processes = 0
+        if parallel:
+            processes = int(
+                self.env["ir.config_parameter"].sudo().get_param("l10n_cr_einvoice.signing_processes", 0) or 0
+            )
+        try:
+            return xml_signer.sign_batch(*self._fp_get_signer_source(), roots, processes=processes)
+        except xml_signer.SignerLoadError as error:
+            raise UserError(
+                _("No fue posible abrir el certificado FE. Verifique archivo y contraseña. Detalle: %s") % error
+            ) from error
+
     def action_fp_refresh_certificate_info(self):
         for company in self:
             company._compute_fp_certificate_info()
@@ -1,4 +1,9 @@
-from odoo import fields, models
+import secrets
+
+from odoo import _, api, fields, models
+
+from ..controllers.main import FP_CALLBACK_ROUTE
+from ..tools import hacienda_transport
 
 
 class ResConfigSettings(models.TransientModel):
@@ -10,7 +15,67 @@ class ResConfigSettings(models.TransientModel):
     fp_hacienda_sandbox_mode = fields.Boolean(related="company_id.fp_hacienda_sandbox_mode", readonly=False)
     fp_hacienda_username = fields.Char(related="company_id.fp_hacienda_username", readonly=False)
     fp_hacienda_password = fields.Char(related="company_id.fp_hacienda_password", readonly=False)
-    fp_api_timeout = fields.Integer(related="company_id.fp_api_timeout", readonly=False)
+    fp_api_connect_timeout = fields.Integer(related="company_id.fp_api_connect_timeout", readonly=False)
+    fp_api_read_timeout = fields.Integer(related="company_id.fp_api_read_timeout", readonly=False)
+    fp_api_pool_size = fields.Integer(related="company_id.fp_api_pool_size", readonly=False)
+    fp_api_circuit_state = fields.Text(
+        string="Estado de conexión con Hacienda",
+        compute="_compute_fp_api_circuit_state",
+    )
+    fp_api_rate_limit = fields.Float(related="company_id.fp_api_rate_limit", readonly=False)
+    fp_api_rate_burst = fields.Integer(related="company_id.fp_api_rate_burst", readonly=False)
+    fp_api_max_attempts = fields.Integer(related="company_id.fp_api_max_attempts", readonly=False)
+    fp_api_retry_base_delay = fields.Integer(related="company_id.fp_api_retry_base_delay", readonly=False)
+    fp_api_max_concurrency = fields.Integer(related="company_id.fp_api_max_concurrency", readonly=False)
+    fp_queue_weight = fields.Integer(related="company_id.fp_queue_weight", readonly=False)
+    fp_send_workers = fields.Integer(
+        string="Envíos simultáneos a Hacienda",
+        config_parameter="l10n_cr_einvoice.send_workers",
+        default=4,
+        help="Cantidad de documentos que el cron de envío procesa en paralelo, cada uno en su propia transacción.",
+    )
+    fp_consult_concurrency = fields.Integer(
+        string="Consultas simultáneas a Hacienda",
+        config_parameter="l10n_cr_einvoice.consult_concurrency",
+        default=20,
+        help="Máximo de consultas de estado que el cron de consulta mantiene en vuelo al mismo tiempo.",
+    )
+    fp_lane_min_share_normal = fields.Integer(
+        string="Cupo mínimo prioridad normal (%)",
+        config_parameter="l10n_cr_einvoice.lane_min_share_normal",
+        default=20,
+        help="Porcentaje de cada lote de envío reservado para documentos de prioridad normal.",
+    )
+    fp_lane_min_share_low = fields.Integer(
+        string="Cupo mínimo prioridad baja (%)",
+        config_parameter="l10n_cr_einvoice.lane_min_share_low",
+        default=10,
+        help="Porcentaje de cada lote de envío reservado para documentos de prioridad baja.",
+    )
+    fp_signing_processes = fields.Integer(
+        string="Procesos de firma",
+        config_parameter="l10n_cr_einvoice.signing_processes",
+        default=0,
+        help="Procesos que firman en paralelo los lotes grandes de XML del cron de firma. "
+        "Con 0 o 1 se firma en el mismo proceso de Odoo.",
+    )
+    fp_cron_batch_size = fields.Integer(
+        string="Documentos por lote",
+        config_parameter="l10n_cr_einvoice.cron_batch_size",
+        default=200,
+        help="Cantidad de documentos que los crons FE reservan y procesan en cada lote.",
+    )
+    fp_cron_time_budget = fields.Integer(
+        string="Tiempo por ejecución (s)",
+        config_parameter="l10n_cr_einvoice.cron_time_budget",
+        default=240,
+        help="Los crons FE procesan lotes hasta agotar este tiempo; si queda trabajo pendiente se vuelven a ejecutar de inmediato. "
+        "Debe ser menor al límite de tiempo de los crons del servidor.",
+    )
+    fp_cron_last_runs = fields.Text(
+        string="Última ejecución de los crons FE",
+        compute="_compute_fp_cron_last_runs",
+    )
 
     fp_economic_activity_id = fields.Many2one(related="company_id.fp_economic_activity_id", readonly=False)
     fp_signing_certificate_file = fields.Binary(
@@ -25,10 +90,14 @@ class ResConfigSettings(models.TransientModel):
         related="company_id.fp_signing_certificate_password",
         readonly=False,
     )
+    fp_deferred_signing = fields.Boolean(related="company_id.fp_deferred_signing", readonly=False)
     fp_auto_consult_after_send = fields.Boolean(
         related="company_id.fp_auto_consult_after_send",
         readonly=False,
     )
+    fp_hacienda_callback_url = fields.Char(
+        related="company_id.fp_hacienda_callback_url", readonly=False, groups="base.group_system"
+    )
     fp_auto_send_email_when_accepted = fields.Boolean(
         related="company_id.fp_auto_send_email_when_accepted",
         readonly=False,
@@ -57,6 +126,62 @@ class ResConfigSettings(models.TransientModel):
     fp_consecutive_others = fields.Char(related="company_id.fp_consecutive_others", readonly=False)
 
 
+    def _fp_get_hacienda_urls(self):
+        self.ensure_one()
+        company = self.company_id
+        return [url for url in (company.fp_hacienda_api_base_url, company.fp_hacienda_token_url) if url]
+
+    @api.depends("company_id")
+    def _compute_fp_api_circuit_state(self):
+        labels = {
+            hacienda_transport.CircuitBreaker.CLOSED: _("Cerrado (operando normal)"),
+            hacienda_transport.CircuitBreaker.OPEN: _("Abierto"),
+            hacienda_transport.CircuitBreaker.HALF_OPEN: _("Semiabierto (probando)"),
+        }
+        store = self.env["fp.hacienda.transport.state"]._fp_get_store()
+        for settings in self:
+            lines = []
+            for url in settings._fp_get_hacienda_urls():
+                breaker = hacienda_transport.get_circuit_breaker(url, store)
+                state, retry_after = breaker.snapshot()
+                label = labels[state]
+                if state == hacienda_transport.CircuitBreaker.OPEN:
+                    label = _("%(label)s, próxima prueba en %(seconds)s s") % {
+                        "label": label,
+                        "seconds": int(retry_after),
+                    }
+                lines.append(f"{breaker.host}: {label}")
+            settings.fp_api_circuit_state = "\n".join(lines)
+
+    def _compute_fp_cron_last_runs(self):
+        lines = []
+        for run in self.env["fp.cron.run"].sudo().search([]):
+            lines.append(
+                _("%(label)s: %(processed)s procesados, %(remaining)s pendientes (%(at)s UTC)")
+                % {
+                    "label": dict(run._fields["kind"]._description_selection(self.env))[run.kind],
+                    "processed": run.processed,
+                    "remaining": run.remaining,
+                    "at": fields.Datetime.to_string(run.date),
+                }
+            )
+        self.fp_cron_last_runs = "\n".join(lines)
+
+    def action_fp_reset_circuit_breakers(self):
+        self.ensure_one()
+        store = self.env["fp.hacienda.transport.state"]._fp_get_store()
+        for url in self._fp_get_hacienda_urls():
+            hacienda_transport.get_circuit_breaker(url, store).reset()
+
+    def action_fp_generate_callback_url(self):
+        self.ensure_one()
+        company = self.company_id.sudo()
+        if not company.fp_hacienda_callback_token:
+            company.fp_hacienda_callback_token = secrets.token_urlsafe(32)
+        company.fp_hacienda_callback_url = (
+            f"{company.get_base_url()}{FP_CALLBACK_ROUTE}/{company.fp_hacienda_callback_token}"
+        )
+
     def action_fp_refresh_certificate_info(self):
         self.ensure_one()
         self.company_id.action_fp_refresh_certificate_info()
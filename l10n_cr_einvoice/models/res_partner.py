@@ -234,9 +234,10 @@ class ResPartner(models.Model):
                 f"https://api.hacienda.go.cr/fe/cep?identificacion={vat}",
             ]
             data = None
+            transport = self.env.company._fp_get_hacienda_transport()
             for endpoint in endpoints:
                 try:
-                    response = requests.get(endpoint, timeout=15)
+                    response = transport.get(endpoint, bucket="contribuyente")
                 except requests.exceptions.Timeout:
                     _logger.warning("Timeout consultando endpoint Hacienda de partner: %s", endpoint)
                     continue
@@ -0,0 +1,40 @@
+import { onWillUnmount } from "@odoo/owl";
+import { useService } from "@web/core/utils/hooks";
+import { patch } from "@web/core/utils/patch";
+import { debounce } from "@web/core/utils/timing";
+import { FormController } from "@web/views/form/form_controller";
+
+const FP_STATUS_NOTIFICATION = "l10n_cr_einvoice.fp_status";
+const FP_MASS_ACTION_MODEL = "fp.mass.action.wizard";
+
+// Recarga la factura abierta (o el avance del asistente masivo) cuando el
+// envío o la consulta en segundo plano cambian el estado FE de un documento.
+patch(FormController.prototype, {
+    setup() {
+        super.setup(...arguments);
+        if (!["account.move", FP_MASS_ACTION_MODEL].includes(this.props.resModel)) {
+            return;
+        }
+        const busService = useService("bus_service");
+        const reload = async () => {
+            const record = this.model.root;
+            if (record.resId && !(await record.isDirty())) {
+                await record.load();
+            }
+        };
+        // El asistente masivo recibe un aviso por documento: se agrupan las recargas.
+        const reloadProgress = debounce(reload, 2000);
+        const onFpStatus = (payload) => {
+            if (this.props.resModel === FP_MASS_ACTION_MODEL) {
+                reloadProgress();
+            } else if (payload.id === this.model.root.resId) {
+                reload();
+            }
+        };
+        busService.subscribe(FP_STATUS_NOTIFICATION, onFpStatus);
+        onWillUnmount(() => {
+            reloadProgress.cancel();
+            busService.unsubscribe(FP_STATUS_NOTIFICATION, onFpStatus);
+        });
+    },
+});
@@ -0,0 +1,192 @@
+"""Tests for :mod:`tools.fe_document`; they build documents in plain Python, without records.
+
+The expected XML under ``data/`` is the output of the ORM-based generator the
+serializer replaced, for the same FE and NC.
+"""
+
+import pathlib
+import pickle
+
+from lxml import etree as LET
+
+from odoo.tests.common import BaseCase, tagged
+
+from ..tools import fe_document
+
+TESTS_DIR = pathlib.Path(__file__).resolve().parent
+
+FE_CLAVE = "50614032500310112345600100001010000000042100000042"
+NC_CLAVE = "50615032500310112345600100003010000000007100000007"
+
+
+def _canonical(xml_bytes):
+    parser = LET.XMLParser(remove_blank_text=True)
+    return LET.tostring(LET.fromstring(xml_bytes, parser), method="c14n")
+
+
+def _parties():
+    emisor = fe_document.FeParty(
+        name="Empresa Demo S.A.",
+        identification_type="02",
+        identification_number="3101123456",
+        location=fe_document.FeLocation(
+            province="1", canton="01", district="08", other_signs="Avenida Central, calle 5"
+        ),
+        phone_country_code="506",
+        phone_number="22223333",
+        email="fe@empresa.cr",
+    )
+    receptor = fe_document.FeParty(
+        name="Cliente Demo",
+        identification_type="01",
+        identification_number="102340567",
+        location=fe_document.FeLocation(province="2", canton="03", district="04"),
+        email="cliente@example.com",
+    )
+    return emisor, receptor
+
+
+def _build_fe():
+    emisor, receptor = _parties()
+    return fe_document.FeDocument(
+        document_type="FE",
+        clave=FE_CLAVE,
+        systems_provider="3101123456",
+        emisor_activity_code="620100",
+        consecutive=FE_CLAVE[21:41],
+        issue_datetime="2025-03-14T09:26:53-06:00",
+        emisor=emisor,
+        receptor=receptor,
+        sale_condition="02",
+        credit_term_days=30,
+        lines=[
+            fe_document.FeLine(
+                number=1,
+                cabys_code="4321000000100",
+                quantity=2.0,
+                unit_code="Unid",
+                detail="Teclado USB",
+                unit_price=1000.0,
+                total_amount=2000.0,
+                subtotal=1800.0,
+                discount=200.0,
+                tax=fe_document.FeTax(code="01", rate_code="08", rate=13.0, amount=234.0),
+                net_tax=234.0,
+                total_line=2034.0,
+                is_service=False,
+            ),
+            fe_document.FeLine(
+                number=2,
+                cabys_code="8311100000000",
+                quantity=1.0,
+                unit_code="Sp",
+                detail="Instalación",
+                unit_price=500.0,
+                total_amount=500.0,
+                subtotal=500.0,
+                discount=0.0,
+                net_tax=0.0,
+                total_line=500.0,
+                is_service=True,
+            ),
+        ],
+        currency_code="CRC",
+        exchange_rate=1.0,
+        payment_method="04",
+    )
+
+
+def _build_nc():
+    emisor, receptor = _parties()
+    exoneration = fe_document.FeExoneration(
+        document_type="04",
+        number="AL-00012345-24",
+        institution_name="Ministerio de Hacienda",
+        issue_date="2024-06-01T08:00:00",
+        rate=13.0,
+        amount=1000.0,
+    )
+    return fe_document.FeDocument(
+        document_type="NC",
+        clave=NC_CLAVE,
+        systems_provider="3101123456",
+        emisor_activity_code="620100",
+        consecutive=NC_CLAVE[21:41],
+        issue_datetime="2025-03-15T09:26:53-06:00",
+        emisor=emisor,
+        receptor=receptor,
+        sale_condition="01",
+        lines=[
+            fe_document.FeLine(
+                number=1,
+                cabys_code="4321000000100",
+                quantity=1.0,
+                unit_code="Unid",
+                detail="Teclado USB",
+                unit_price=1000.0,
+                total_amount=1000.0,
+                subtotal=1000.0,
+                discount=0.0,
+                tax=fe_document.FeTax(code="01", rate_code="08", rate=13.0, amount=130.0, exoneration=exoneration),
+                net_tax=0.0,
+                total_line=1000.0,
+                is_service=False,
+            ),
+        ],
+        currency_code="CRC",
+        exchange_rate=1.0,
+        payment_method="01",
+        reference=fe_document.FeReference(
+            document_type="01",
+            number=FE_CLAVE,
+            issue_datetime="2025-03-14T09:26:53-06:00",
+            code="01",
+            reason="Devolución de mercadería",
+        ),
+    )
+
+
+@tagged("l10n_cr_einvoice")
+class TestFeDocument(BaseCase):
+    def assertMatchesBaseline(self, document, filename):
+        expected = (TESTS_DIR / "data" / filename).read_bytes()
+        self.assertEqual(_canonical(fe_document.serialize(document)), _canonical(expected))
+
+    def test_fe_serialize_matches_baseline(self):
+        self.assertMatchesBaseline(_build_fe(), "fe_document_fe.xml")
+
+    def test_nc_serialize_matches_baseline(self):
+        self.assertMatchesBaseline(_build_nc(), "fe_document_nc.xml")
+
+    def test_fe_compute_totals(self):
+        totals = fe_document.compute_totals(_build_fe().lines)
+        self.assertEqual(totals["total_mercancias_gravadas"], 1800.0)
+        self.assertEqual(totals["total_serv_exentos"], 500.0)
+        self.assertEqual(totals["total_gravado"], 1800.0)
+        self.assertEqual(totals["total_exento"], 500.0)
+        self.assertEqual(totals["total_venta"], 2500.0)
+        self.assertEqual(totals["total_descuentos"], 200.0)
+        self.assertEqual(totals["total_venta_neta"], 2300.0)
+        self.assertEqual(totals["total_desglose_impuesto"], {("01", "08"): 234.0})
+        self.assertEqual(totals["total_impuesto"], 234.0)
+        self.assertEqual(totals["total_comprobante"], 2534.0)
+
+    def test_nc_compute_totals(self):
+        totals = fe_document.compute_totals(_build_nc().lines)
+        self.assertEqual(totals["total_merc_exonerada"], 1000.0)
+        self.assertEqual(totals["total_exonerado"], 1000.0)
+        self.assertEqual(totals["total_gravado"], 0.0)
+        self.assertEqual(totals["total_desglose_impuesto"], {("01", "08"): 0.0})
+        self.assertEqual(totals["total_impuesto"], 0.0)
+        self.assertEqual(totals["total_comprobante"], 1000.0)
+
+    def test_build_tree_is_unserialized_root(self):
+        root = fe_document.build_tree(_build_nc())
+        tags = fe_document.XML_DOCUMENT_TAGS["NC"]
+        self.assertEqual(root.tag, tags["NotaCreditoElectronica"])
+        self.assertEqual(root.findtext(tags["Clave"]), NC_CLAVE)
+        self.assertEqual(root.findtext(f"{tags['InformacionReferencia']}/{tags['Numero']}"), FE_CLAVE)
+
+    def test_document_survives_pickle(self):
+        document = _build_nc()
+        self.assertEqual(pickle.loads(pickle.dumps(document)), document)
@@ -0,0 +1,3 @@
+from . import hacienda_transport
+from . import xml_signer
+from . import fe_document
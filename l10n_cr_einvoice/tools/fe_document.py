@@ -0,0 +1,366 @@
+"""ORM-free model of an FE v4.4 document and its XML serializer.
+
+``account.move`` extracts a :class:`FeDocument` in one step; everything in
+this module is plain Python on top of lxml, so documents can be pickled to
+another process, built in benchmarks or tests without a database, and
+serialized for any type in :data:`XML_DOCUMENT_SPECS`.
+"""
+
+from lxml import etree as LET
+
+from .xml_signer import DS_XML_NS, FpXmlTags
+
+XML_DOCUMENT_SPECS = {
+    "FE": {
+        "root": "FacturaElectronica",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronica",
+        "xsd": "facturaElectronica.xsd",
+    },
+    "NC": {
+        "root": "NotaCreditoElectronica",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/notaCreditoElectronica",
+        "xsd": "notaCreditoElectronica.xsd",
+    },
+    "ND": {
+        "root": "NotaDebitoElectronica",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/notaDebitoElectronica",
+        "xsd": "notaDebitoElectronica.xsd",
+    },
+    "FEE": {
+        "root": "FacturaElectronicaExportacion",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronicaExportacion",
+        "xsd": "facturaElectronicaExportacion.xsd",
+    },
+    "TE": {
+        "root": "TiqueteElectronico",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/tiqueteElectronico",
+        "xsd": "tiqueteElectronico.xsd",
+    },
+    "FEC": {
+        "root": "FacturaElectronicaCompra",
+        "namespace": "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/v4.4/facturaElectronicaCompra",
+        "xsd": "facturaElectronicaCompra.xsd",
+    },
+}
+XSD_XML_NS = "http://www.w3.org/2001/XMLSchema"
+XSI_XML_NS = "http://www.w3.org/2001/XMLSchema-instance"
+# Los documentos se construyen directamente en lxml con sus etiquetas ya calificadas.
+XML_DOCUMENT_TAGS = {code: FpXmlTags(spec["namespace"]) for code, spec in XML_DOCUMENT_SPECS.items()}
+_SCHEMA_LOCATION = LET.QName(XSI_XML_NS, "schemaLocation").text
+
+# Orden de los totales en ResumenFactura (antes del desglose de impuestos).
+SUMMARY_TOTALS = (
+    ("TotalServGravados", "total_serv_gravados"),
+    ("TotalServExentos", "total_serv_exentos"),
+    ("TotalServExonerado", "total_serv_exonerado"),
+    ("TotalServNoSujeto", "total_serv_no_sujeto"),
+    ("TotalMercanciasGravadas", "total_mercancias_gravadas"),
+    ("TotalMercanciasExentas", "total_mercancias_exentas"),
+    ("TotalMercExonerada", "total_merc_exonerada"),
+    ("TotalMercNoSujeta", "total_merc_no_sujeta"),
+    ("TotalGravado", "total_gravado"),
+    ("TotalExento", "total_exento"),
+    ("TotalExonerado", "total_exonerado"),
+    ("TotalNoSujeto", "total_no_sujeto"),
+    ("TotalVenta", "total_venta"),
+    ("TotalDescuentos", "total_descuentos"),
+    ("TotalVentaNeta", "total_venta_neta"),
+)
+
+
+class FeRecord:
+    """Slotted value object: every slot is set from keyword arguments and defaults to ``None``."""
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.pop(name, None))
+        if values:
+            raise TypeError(f"{type(self).__name__} has no field(s) {', '.join(values)}")
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class FeLocation(FeRecord):
+    __slots__ = ("province", "canton", "district", "neighborhood", "other_signs")
+
+
+class FeParty(FeRecord):
+    """Emisor or receptor; ``identification_type`` is ``None`` when the node is omitted."""
+
+    __slots__ = (
+        "name",
+        "identification_type",
+        "identification_number",
+        "location",
+        "phone_country_code",
+        "phone_number",
+        "email",
+    )
+
+
+class FeExoneration(FeRecord):
+    __slots__ = ("document_type", "number", "article", "incise", "institution_name", "issue_date", "rate", "amount")
+
+
+class FeTax(FeRecord):
+    __slots__ = ("code", "rate_code", "rate", "amount", "exoneration")
+
+
+class FeLine(FeRecord):
+    """Detail line with its amounts already computed; ``tax`` is ``None`` for untaxed lines."""
+
+    __slots__ = (
+        "number",
+        "cabys_code",
+        "commercial_code_type",
+        "commercial_code",
+        "health_registry_number",
+        "medicine_presentation_code",
+        "tariff_heading",
+        "vin_or_series",
+        "quantity",
+        "unit_code",
+        "commercial_unit",
+        "detail",
+        "unit_price",
+        "total_amount",
+        "subtotal",
+        "discount",
+        "tax",
+        "net_tax",
+        "total_line",
+        "is_service",
+    )
+
+
+class FeReference(FeRecord):
+    __slots__ = ("document_type", "number", "issue_datetime", "code", "reason")
+
+
+class FeDocument(FeRecord):
+    __slots__ = (
+        "document_type",
+        "clave",
+        "systems_provider",
+        "emisor_activity_code",
+        "receptor_activity_code",
+        "consecutive",
+        "issue_datetime",
+        "emisor",
+        "receptor",
+        "sale_condition",
+        "credit_term_days",
+        "lines",
+        "currency_code",
+        "exchange_rate",
+        "payment_method",
+        "reference",
+    )
+
+
+def format_decimal(value):
+    return f"{(value or 0.0):.5f}"
+
+
+def compute_totals(lines):
+    """Return the ResumenFactura totals of ``lines`` as a dict keyed like :data:`SUMMARY_TOTALS`."""
+    totals = dict.fromkeys((key for _tag, key in SUMMARY_TOTALS), 0.0)
+    totals.update(
+        total_desglose_impuesto={},
+        total_impuesto=0.0,
+        total_imp_asum_emisor_fabrica=0.0,
+        total_iva_devuelto=0.0,
+        total_comprobante=0.0,
+    )
+    for line in lines:
+        tax = line.tax
+        subtotal = line.subtotal
+        if tax:
+            desglose_key = (tax.code, tax.rate_code)
+            totals["total_desglose_impuesto"][desglose_key] = (
+                totals["total_desglose_impuesto"].get(desglose_key, 0.0) + line.net_tax
+            )
+        if tax and (tax.amount > 0 or tax.exoneration):
+            if tax.exoneration:
+                totals["total_serv_exonerado" if line.is_service else "total_merc_exonerada"] += subtotal
+                totals["total_exonerado"] += subtotal
+            else:
+                totals["total_serv_gravados" if line.is_service else "total_mercancias_gravadas"] += subtotal
+                totals["total_gravado"] += subtotal
+        elif tax and tax.rate_code in ("01", "05", "11"):
+            totals["total_serv_no_sujeto" if line.is_service else "total_merc_no_sujeta"] += subtotal
+            totals["total_no_sujeto"] += subtotal
+        else:
+            totals["total_serv_exentos" if line.is_service else "total_mercancias_exentas"] += subtotal
+            totals["total_exento"] += subtotal
+
+        totals["total_venta"] += line.total_amount
+        totals["total_descuentos"] += line.discount
+        totals["total_venta_neta"] += subtotal
+        totals["total_impuesto"] += line.net_tax
+        totals["total_comprobante"] += line.total_line
+    return totals
+
+
+def _append(parent, tag, text):
+    LET.SubElement(parent, tag).text = text
+
+
+def _append_party(parent, tags, party):
+    _append(parent, tags["Nombre"], party.name or "")
+    if party.identification_type is not None:
+        identification = LET.SubElement(parent, tags["Identificacion"])
+        _append(identification, tags["Tipo"], party.identification_type)
+        _append(identification, tags["Numero"], party.identification_number)
+    location = party.location
+    if location:
+        location_node = LET.SubElement(parent, tags["Ubicacion"])
+        for tag, value in (
+            ("Provincia", location.province),
+            ("Canton", location.canton),
+            ("Distrito", location.district),
+            ("Barrio", location.neighborhood),
+            ("OtrasSenas", location.other_signs),
+        ):
+            if value:
+                _append(location_node, tags[tag], value)
+    if party.phone_number:
+        phone = LET.SubElement(parent, tags["Telefono"])
+        _append(phone, tags["CodigoPais"], party.phone_country_code)
+        _append(phone, tags["NumTelefono"], party.phone_number)
+    if party.email:
+        _append(parent, tags["CorreoElectronico"], party.email)
+
+
+def _append_exoneration(parent, tags, exoneration):
+    node = LET.SubElement(parent, tags["Exoneracion"])
+    # En v4.4, el nodo de exoneración utiliza TipoDocumentoEX1 (no TipoDocumento) y
+    # Articulo/Inciso van antes de NombreInstitucion.
+    _append(node, tags["TipoDocumentoEX1"], exoneration.document_type)
+    _append(node, tags["NumeroDocumento"], exoneration.number)
+    if exoneration.article:
+        _append(node, tags["Articulo"], exoneration.article)
+    if exoneration.incise:
+        _append(node, tags["Inciso"], exoneration.incise)
+    _append(node, tags["NombreInstitucion"], exoneration.institution_name)
+    _append(node, tags["FechaEmisionEX"], exoneration.issue_date)
+    _append(node, tags["TarifaExonerada"], str(int(exoneration.rate or 0.0)))
+    _append(node, tags["MontoExoneracion"], format_decimal(exoneration.amount))
+
+
+def _append_line(parent, tags, document_type, line):
+    detail = LET.SubElement(parent, tags["LineaDetalle"])
+    _append(detail, tags["NumeroLinea"], str(line.number))
+    if line.cabys_code:
+        _append(detail, tags["CodigoCABYS"], line.cabys_code)
+    if line.commercial_code_type and line.commercial_code:
+        code_node = LET.SubElement(detail, tags["CodigoComercial"])
+        _append(code_node, tags["Tipo"], line.commercial_code_type)
+        _append(code_node, tags["Codigo"], line.commercial_code)
+    for tag, value in (
+        ("NumeroRegistroMS", line.health_registry_number),
+        ("CodigoPresentacionMedicamento", line.medicine_presentation_code),
+        ("PartidaArancelaria", line.tariff_heading),
+        ("NumeroVINoSerie", line.vin_or_series),
+    ):
+        if value:
+            _append(detail, tags[tag], value)
+    _append(detail, tags["Cantidad"], format_decimal(line.quantity))
+    _append(detail, tags["UnidadMedida"], line.unit_code)
+    if line.commercial_unit:
+        _append(detail, tags["UnidadMedidaComercial"], line.commercial_unit)
+    _append(detail, tags["Detalle"], line.detail or "")
+    _append(detail, tags["PrecioUnitario"], format_decimal(line.unit_price))
+    _append(detail, tags["MontoTotal"], format_decimal(line.total_amount))
+    _append(detail, tags["SubTotal"], format_decimal(line.subtotal))
+    tax = line.tax
+    if tax:
+        if document_type != "FEE":
+            _append(detail, tags["BaseImponible"], format_decimal(line.subtotal))
+        tax_node = LET.SubElement(detail, tags["Impuesto"])
+        _append(tax_node, tags["Codigo"], tax.code)
+        _append(tax_node, tags["CodigoTarifaIVA"], tax.rate_code)
+        _append(tax_node, tags["Tarifa"], format_decimal(tax.rate))
+        _append(tax_node, tags["Monto"], format_decimal(tax.amount))
+        if tax.exoneration:
+            _append_exoneration(tax_node, tags, tax.exoneration)
+        if document_type != "FEE":
+            if document_type != "FEC":
+                _append(detail, tags["ImpuestoAsumidoEmisorFabrica"], format_decimal(0.0))
+            _append(detail, tags["ImpuestoNeto"], format_decimal(line.net_tax))
+    _append(detail, tags["MontoTotalLinea"], format_decimal(line.total_line))
+
+
+def build_tree(document):
+    """Build the unsigned lxml tree of ``document``; it is serialized only once signed."""
+    document_type = document.document_type
+    spec = XML_DOCUMENT_SPECS[document_type]
+    namespace = spec["namespace"]
+    tags = XML_DOCUMENT_TAGS[document_type]
+    root = LET.Element(
+        tags[spec["root"]],
+        {_SCHEMA_LOCATION: f"{namespace} {namespace}/{spec['xsd']}"},
+        nsmap={None: namespace, "ds": DS_XML_NS, "xsd": XSD_XML_NS, "xsi": XSI_XML_NS},
+    )
+    _append(root, tags["Clave"], document.clave)
+    if document.systems_provider is not None:
+        _append(root, tags["ProveedorSistemas"], document.systems_provider)
+    if document.emisor_activity_code:
+        _append(root, tags["CodigoActividadEmisor"], document.emisor_activity_code)
+    if document.receptor_activity_code:
+        _append(root, tags["CodigoActividadReceptor"], document.receptor_activity_code)
+    _append(root, tags["NumeroConsecutivo"], document.consecutive)
+    _append(root, tags["FechaEmision"], document.issue_datetime)
+    _append_party(LET.SubElement(root, tags["Emisor"]), tags, document.emisor)
+    _append_party(LET.SubElement(root, tags["Receptor"]), tags, document.receptor)
+    _append(root, tags["CondicionVenta"], document.sale_condition)
+    if document.credit_term_days is not None:
+        _append(root, tags["PlazoCredito"], str(document.credit_term_days))
+
+    lines_node = LET.SubElement(root, tags["DetalleServicio"])
+    for line in document.lines:
+        _append_line(lines_node, tags, document_type, line)
+
+    totals = compute_totals(document.lines)
+    summary = LET.SubElement(root, tags["ResumenFactura"])
+    currency_node = LET.SubElement(summary, tags["CodigoTipoMoneda"])
+    _append(currency_node, tags["CodigoMoneda"], document.currency_code)
+    _append(currency_node, tags["TipoCambio"], f"{document.exchange_rate:.5f}")
+    for tag, key in SUMMARY_TOTALS:
+        _append(summary, tags[tag], format_decimal(totals[key]))
+    for (tax_code, tax_rate_code), tax_amount in sorted(totals["total_desglose_impuesto"].items()):
+        breakdown = LET.SubElement(summary, tags["TotalDesgloseImpuesto"])
+        _append(breakdown, tags["Codigo"], tax_code)
+        _append(breakdown, tags["CodigoTarifaIVA"], tax_rate_code)
+        _append(breakdown, tags["TotalMontoImpuesto"], format_decimal(tax_amount))
+    _append(summary, tags["TotalImpuesto"], format_decimal(totals["total_impuesto"]))
+    _append(summary, tags["TotalImpAsumEmisorFabrica"], format_decimal(totals["total_imp_asum_emisor_fabrica"]))
+    if document_type != "FEC":
+        _append(summary, tags["TotalIVADevuelto"], format_decimal(totals["total_iva_devuelto"]))
+    payment_node = LET.SubElement(summary, tags["MedioPago"])
+    _append(payment_node, tags["TipoMedioPago"], document.payment_method)
+    _append(summary, tags["TotalComprobante"], format_decimal(totals["total_comprobante"]))
+
+    reference = document.reference
+    if reference:
+        reference_node = LET.SubElement(root, tags["InformacionReferencia"])
+        _append(reference_node, tags["TipoDocIR"], reference.document_type)
+        _append(reference_node, tags["Numero"], reference.number)
+        _append(reference_node, tags["FechaEmisionIR"], reference.issue_datetime)
+        _append(reference_node, tags["Codigo"], reference.code)
+        _append(reference_node, tags["Razon"], reference.reason)
+    return root
+
+
+def serialize(document):
+    """Return the unsigned XML bytes of ``document``."""
+    return LET.tostring(build_tree(document), encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,357 @@
+"""Shared HTTP transport for every outbound call to Hacienda.
+
+Each company gets a pooled keep-alive ``requests.Session`` so token,
+recepcion and consult requests reuse open TLS connections instead of
+negotiating a new one per call.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_TRANSPORTS = {}
+_TRANSPORTS_LOCK = threading.Lock()
+_BACKEND_FACTORY = None
+
+# Espera (segundos) aplicada ante un 429 sin encabezado Retry-After.
+DEFAULT_RETRY_AFTER = 30
+# Espera máxima (segundos) que una solicitud bloquea el hilo aguardando cupo;
+# por encima de eso se difiere el documento.
+MAX_THROTTLE_WAIT = 2
+# Fallas consecutivas (red o 5xx) que abren el circuito de un host.
+CIRCUIT_FAILURE_THRESHOLD = 5
+# Segundos que el circuito permanece abierto antes de permitir una solicitud de prueba.
+CIRCUIT_RESET_TIMEOUT = 60
+
+
+class HaciendaRateLimited(requests.exceptions.RequestException):
+    """Raised instead of sending a request while the endpoint quota is exhausted."""
+
+    def __init__(self, retry_after, *args, **kwargs):
+        super().__init__(f"Límite de solicitudes a Hacienda alcanzado; reintentar en {retry_after:.0f}s", *args, **kwargs)
+        self.retry_after = retry_after
+
+
+class HaciendaCircuitOpen(requests.exceptions.RequestException):
+    """Raised without touching the network while the host circuit is open."""
+
+    def __init__(self, host, retry_after, *args, **kwargs):
+        super().__init__(f"Circuito abierto para {host}; reintentar en {retry_after:.0f}s", *args, **kwargs)
+        self.host = host
+        self.retry_after = retry_after
+
+
+class StateStore:
+    """Base of the state stores: ``transaction()`` yields a session, ``locked(key)`` is built on top of it.
+
+    A session exposes ``now`` (wall-clock epoch seconds, common to every
+    process sharing the store) and ``get(key, lock=True)``, which returns the
+    mutable state dict of ``key``. Keys read with ``lock=False`` are only
+    inspected; changes to locked keys are kept when the transaction ends.
+    """
+
+    @contextmanager
+    def transaction(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def locked(self, key):
+        """Yield ``(state, now)`` for ``key`` under an exclusive lock; changes made to ``state`` are kept."""
+        with self.transaction() as session:
+            yield session.get(key), session.now
+
+
+class LocalStateSession:
+    def __init__(self, states, now):
+        self.states = states
+        self.now = now
+
+    def get(self, key, lock=True):
+        return self.states.setdefault(key, {})
+
+
+class LocalStateStore(StateStore):
+    """Default state store: the state lives in this process and is shared by its threads only."""
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield LocalStateSession(self.states, time.time())
+
+
+_LOCAL_STORE = LocalStateStore()
+
+
+class CircuitBreaker:
+    """Closed / open / half-open circuit breaker for a single endpoint host.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    every call fails fast. Once ``reset_timeout`` elapses a single probe is
+    let through (half-open): success closes the circuit, failure reopens it.
+    The state is kept in ``store`` so every process sharing the store sees,
+    and resets, the same circuit; an empty state means closed.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host, store=None, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.host = host
+        self.store = store or _LOCAL_STORE
+        self.key = f"circuit:{host}"
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def _retry_after(self, state, now):
+        status = state.get("state", self.CLOSED)
+        if status == self.OPEN:
+            return max(state["opened_at"] + self.reset_timeout - now, 0.0)
+        if status == self.HALF_OPEN and state.get("probe_at"):
+            # Si el proceso que probaba murió, la prueba vence y se permite otra.
+            return max(state["probe_at"] + self.reset_timeout - now, 0.0)
+        return 0.0
+
+    def snapshot(self):
+        """Return ``(state, retry_after)`` where ``retry_after`` is 0 when calls may go through."""
+        with self.store.transaction() as session:
+            state = session.get(self.key, lock=False)
+            return state.get("state", self.CLOSED), self._retry_after(state, session.now)
+
+    def retry_after(self):
+        """Seconds until a probe is allowed, or 0 when calls may go through."""
+        return self.snapshot()[1]
+
+    def _claim(self, session):
+        """Let one call through a non-closed circuit; return whether it may go on."""
+        state = session.get(self.key)
+        status = state.get("state", self.CLOSED)
+        if status == self.CLOSED:
+            return True
+        if status == self.OPEN and session.now - state["opened_at"] >= self.reset_timeout:
+            state.update(state=self.HALF_OPEN, probe_at=0.0)
+        if state["state"] == self.HALF_OPEN and not self._retry_after(state, session.now):
+            state["probe_at"] = session.now
+            return True
+        return False
+
+    def before_request(self):
+        """Raise :class:`HaciendaCircuitOpen` unless a call may go through; return whether the circuit was clean."""
+        return admit(self)
+
+    def record_success(self):
+        with self.store.locked(self.key) as (state, now):
+            state.clear()
+
+    def record_failure(self):
+        with self.store.locked(self.key) as (state, now):
+            failures = state.get("failures", 0) + 1
+            state.update(failures=failures, probe_at=0.0)
+            if state.get("state") == self.HALF_OPEN or failures >= self.failure_threshold:
+                state.update(state=self.OPEN, opened_at=now)
+
+    def reset(self):
+        self.record_success()
+
+
+def get_circuit_breaker(url, store=None):
+    return CircuitBreaker(urlparse(url).netloc or url, store)
+
+
+def is_circuit_open(url, store=None):
+    """Return whether calls to the host of ``url`` would currently fail fast."""
+    return get_circuit_breaker(url, store).retry_after() > 0
+
+
+class TokenBucket:
+    """Token bucket with an optional hard block (``Retry-After``).
+
+    The bucket lives in ``store`` under ``key``, so every process sharing
+    the store draws from the same quota.
+    """
+
+    def __init__(self, key, rate, burst, store=None):
+        self.key = f"bucket:{key}"
+        self.rate = rate
+        self.capacity = max(burst or 1, 1)
+        self.store = store or _LOCAL_STORE
+
+    def _reserve(self, session):
+        """Take a token if possible; otherwise return the seconds until one is available."""
+        state = session.get(self.key)
+        now = session.now
+        blocked_until = state.get("blocked_until", 0.0)
+        if blocked_until > now:
+            return blocked_until - now
+        if self.rate <= 0:
+            return 0.0
+        tokens = min(self.capacity, state.get("tokens", self.capacity) + (now - state.get("updated", now)) * self.rate)
+        if tokens >= 1:
+            state.update(tokens=tokens - 1, updated=now)
+            return 0.0
+        state.update(tokens=tokens, updated=now)
+        return (1 - tokens) / self.rate
+
+    def _refund(self, session):
+        if self.rate > 0:
+            state = session.get(self.key)
+            state["tokens"] = min(self.capacity, state.get("tokens", 0.0) + 1)
+
+    def acquire(self, max_wait=MAX_THROTTLE_WAIT):
+        admit(bucket=self, max_wait=max_wait)
+
+    def block(self, seconds):
+        with self.store.locked(self.key) as (state, now):
+            blocked_until = max(state.get("blocked_until", 0.0), now + seconds)
+            state.update(blocked_until=blocked_until, tokens=0.0, updated=blocked_until)
+
+
+def admit(breaker=None, bucket=None, max_wait=MAX_THROTTLE_WAIT):
+    """Check the circuit, then take a rate-limit token, in one store transaction per attempt.
+
+    An open circuit fails fast without spending quota, and a closed circuit
+    is only read, so the hot path locks the bucket alone. Returns whether
+    the circuit was clean (no failures recorded), in which case a success
+    does not need to be recorded. Raises :class:`HaciendaCircuitOpen` or
+    :class:`HaciendaRateLimited`.
+    """
+    store = (breaker or bucket).store
+    deadline = time.monotonic() + max_wait
+    while True:
+        with store.transaction() as session:
+            circuit = session.get(breaker.key, lock=False) if breaker else {}
+            retry_after = breaker._retry_after(circuit, session.now) if circuit else 0.0
+            wait = 0.0
+            if not retry_after:
+                wait = bucket._reserve(session) if bucket else 0.0
+                # Circuito no cerrado: se reclama el paso bajo su bloqueo y, si otro
+                # proceso se adelantó con la prueba, se devuelve el token.
+                if not wait and circuit and not breaker._claim(session):
+                    retry_after = breaker._retry_after(session.get(breaker.key), session.now)
+                    if bucket:
+                        bucket._refund(session)
+        if retry_after:
+            raise HaciendaCircuitOpen(breaker.host, max(retry_after, 1.0))
+        if not wait:
+            return not circuit
+        if time.monotonic() + wait > deadline:
+            raise HaciendaRateLimited(wait)
+        time.sleep(wait)
+
+
+def parse_retry_after(value):
+    """Return the ``Retry-After`` header (delta-seconds or HTTP-date) in seconds, or ``None``."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class HaciendaTransport:
+    """Pooled keep-alive HTTP client with separate connect/read timeouts.
+
+    ``backend`` is any object exposing ``request(method, url, **kwargs)`` with
+    the ``requests.Session`` semantics; by default a pooled session is built.
+    Requests tagged with a ``bucket`` name (token, recepcion POST, recepcion
+    GET...) share one token bucket per transport ``key``, so every caller of
+    the same company draws from the same quota. Token buckets and circuit
+    breakers are kept in ``store`` (see ``LocalStateStore``); with a store
+    shared between processes the quota holds across all of them.
+    """
+
+    def __init__(
+        self, pool_size=10, connect_timeout=10, read_timeout=30, rate_limit=0, rate_burst=1, backend=None, store=None, key=None
+    ):
+        self.pool_size = max(pool_size or 1, 1)
+        self.timeout = (connect_timeout or None, read_timeout or None)
+        self.rate_limit = rate_limit or 0
+        self.rate_burst = rate_burst
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.backend = backend or self._build_session(self.pool_size)
+        self.store = store
+        self.key = ":".join(str(part) for part in key) if isinstance(key, tuple) else str(key or id(self))
+
+    @staticmethod
+    def _build_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def _get_bucket(self, name):
+        with self.buckets_lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = TokenBucket(f"{self.key}:{name}", self.rate_limit, self.rate_burst, self.store)
+            return bucket
+
+    def request(self, method, url, bucket=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        breaker = get_circuit_breaker(url, self.store)
+        circuit_clean = admit(breaker, self._get_bucket(bucket) if bucket else None)
+        try:
+            response = self.backend.request(method, url, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        elif not circuit_clean:
+            breaker.record_success()
+        if response.status_code == 429 and bucket:
+            # Hacienda pidió bajar el ritmo: todos los procesos que comparten el cupo esperan.
+            retry_after = parse_retry_after(response.headers.get("Retry-After")) or DEFAULT_RETRY_AFTER
+            self._get_bucket(bucket).block(retry_after)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+def set_backend_factory(factory):
+    """Install ``factory(pool_size, connect_timeout, read_timeout, rate_limit, rate_burst)`` as backend builder.
+
+    Used to inject a local stand-in instead of the network (``None`` restores
+    the default pooled session). Already built transports are discarded.
+    """
+    global _BACKEND_FACTORY
+    with _TRANSPORTS_LOCK:
+        _BACKEND_FACTORY = factory
+        _TRANSPORTS.clear()
+
+
+def get_transport(key, pool_size=10, connect_timeout=10, read_timeout=30, rate_limit=0, rate_burst=1, store=None):
+    """Return the transport cached under ``key``, rebuilding it if its settings changed."""
+    config = (pool_size, connect_timeout, read_timeout, rate_limit, rate_burst)
+    with _TRANSPORTS_LOCK:
+        cached = _TRANSPORTS.get(key)
+        if cached and cached[0] == config and cached[1].store is store:
+            return cached[1]
+        backend = _BACKEND_FACTORY(*config) if _BACKEND_FACTORY else None
+        transport = HaciendaTransport(*config, backend=backend, store=store, key=key)
+        _TRANSPORTS[key] = (config, transport)
+        return transport
@@ -0,0 +1,408 @@
+"""XAdES-EPES signing of FE documents with per-company cached signers.
+
+Opening a PKCS#12 bundle runs its password KDF, which costs far more than
+signing one document. Each company keeps a :class:`XmlSigner` with the
+private key and every certificate-derived XAdES value already computed, and
+it is rebuilt only when the certificate file or its password change.
+
+Large batches signed by the FE cron can use a per-company process pool
+whose workers load the key once at start-up, so the RSA and c14n work of a
+billing run spreads over several cores instead of one worker under the GIL.
+The workers are spawned (never forked from the multi-threaded Odoo worker)
+and only load this file, not Odoo; the pools are shut down explicitly with
+:func:`shutdown_pools`, and at interpreter exit at the latest.
+"""
+
+import atexit
+import base64
+import hashlib
+import logging
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import pkcs12
+from lxml import etree as LET
+
+_logger = logging.getLogger(__name__)
+
+DS_XML_NS = "http://www.w3.org/2000/09/xmldsig#"
+XADES_XML_NS = "http://uri.etsi.org/01903/v1.3.2#"
+XADES_SIGNATURE_POLICY_IDENTIFIER = (
+    "https://cdn.comprobanteselectronicos.go.cr/xml-schemas/"
+    "Resoluci%C3%B3n_General_sobre_disposiciones_t%C3%A9cnicas_comprobantes_electr%C3%B3nicos_para_efectos_tributarios.pdf"
+)
+XADES_SIGNATURE_POLICY_DESCRIPTION = "Política de firma para comprobantes electrónicos de Costa Rica"
+XADES_SIGNATURE_POLICY_HASH_ALGORITHM = "http://www.w3.org/2001/04/xmlenc#sha256"
+XADES_SIGNATURE_POLICY_HASH = "DWxin1xWOeI8OuWQXazh4VjLWAaCLAA954em7DMh0h8="
+
+# Por debajo de este tamaño de lote se firma en el mismo proceso: no compensa serializar.
+POOL_MIN_BATCH = 8
+
+_SIGNERS = {}
+_SIGNERS_LOCK = threading.Lock()
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+# Los procesos de firma se crean con spawn: un fork del worker de Odoo heredaría
+# candados tomados por otros hilos y los sockets de psycopg.
+_SPAWN_CONTEXT = multiprocessing.get_context("spawn")
+# Arranque de cada proceso de firma: carga este archivo con su nombre completo de módulo
+# (sin importar Odoo ni el addon) para que las tareas enviadas por el pool se resuelvan aquí.
+_WORKER_BOOTSTRAP = """
+import importlib.util
+import sys
+
+spec = importlib.util.spec_from_file_location(module_name, module_path)
+module = importlib.util.module_from_spec(spec)
+sys.modules[module_name] = module
+spec.loader.exec_module(module)
+module._init_worker(cert_bytes, password)
+"""
+_WORKER_SIGNER = None
+
+
+class FpXmlTags(dict):
+    """Clark-notation (``{namespace}Tag``) lxml tags of one namespace, each built once per process."""
+
+    def __init__(self, namespace):
+        super().__init__()
+        self.namespace = namespace
+
+    def __missing__(self, tag):
+        qualified = self[tag] = LET.QName(self.namespace, tag).text
+        return qualified
+
+
+DS_TAGS = FpXmlTags(DS_XML_NS)
+XADES_TAGS = FpXmlTags(XADES_XML_NS)
+
+
+class SignerLoadError(Exception):
+    """Raised when the PKCS#12 bundle cannot be opened or lacks a key or certificate."""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("utf-8")
+
+
+def _int_to_b64(value):
+    return _b64(value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+class XmlSigner:
+    """Loaded private key plus the certificate values the XAdES signature repeats on every document."""
+
+    __slots__ = (
+        "private_key",
+        "certificate_b64",
+        "certificate_digest_b64",
+        "modulus_b64",
+        "exponent_b64",
+        "issuer_name",
+        "serial_number",
+    )
+
+    def __init__(self, cert_bytes, password):
+        try:
+            private_key, certificate, _additional_certs = pkcs12.load_key_and_certificates(cert_bytes, password)
+        except Exception as error:
+            raise SignerLoadError(str(error)) from error
+        if not private_key or not certificate:
+            raise SignerLoadError("missing key or certificate")
+
+        cert_der = certificate.public_bytes(serialization.Encoding.DER)
+        public_numbers = certificate.public_key().public_numbers()
+        self.private_key = private_key
+        self.certificate_b64 = _b64(cert_der)
+        self.certificate_digest_b64 = _b64(hashlib.sha256(cert_der).digest())
+        self.modulus_b64 = _int_to_b64(public_numbers.n)
+        self.exponent_b64 = _int_to_b64(public_numbers.e)
+        self.issuer_name = certificate.issuer.rfc4514_string()
+        self.serial_number = str(certificate.serial_number)
+
+    def sign(self, data):
+        return self.private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+    def sign_tree(self, root):
+        """Append the XAdES-EPES signature to the document tree ``root`` in place."""
+        signature_token = str(uuid.uuid4())
+        reference_token = str(uuid.uuid4())
+        object_token = str(uuid.uuid4())
+        qualifying_props_token = str(uuid.uuid4())
+
+        signature_id = f"Signature-{signature_token}"
+        reference_id = f"Reference-{reference_token}"
+        key_info_id = f"KeyInfoId-{signature_id}"
+        signed_properties_id = f"SignedProperties-{signature_id}"
+
+        canonical_document = LET.tostring(root, method="c14n", exclusive=False, with_comments=False)
+        root_digest = hashlib.sha256(canonical_document).digest()
+
+        signature_node = LET.SubElement(root, DS_TAGS["Signature"], nsmap={"ds": DS_XML_NS, "xades": XADES_XML_NS})
+        signature_node.set("Id", signature_id)
+
+        signed_info = LET.SubElement(signature_node, DS_TAGS["SignedInfo"])
+        LET.SubElement(
+            signed_info,
+            DS_TAGS["CanonicalizationMethod"],
+            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
+        )
+        LET.SubElement(
+            signed_info,
+            DS_TAGS["SignatureMethod"],
+            {"Algorithm": "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"},
+        )
+
+        reference_document = LET.SubElement(
+            signed_info,
+            DS_TAGS["Reference"],
+            {"Id": reference_id, "URI": ""},
+        )
+        transforms = LET.SubElement(reference_document, DS_TAGS["Transforms"])
+        LET.SubElement(
+            transforms,
+            DS_TAGS["Transform"],
+            {"Algorithm": "http://www.w3.org/2000/09/xmldsig#enveloped-signature"},
+        )
+        LET.SubElement(
+            transforms,
+            DS_TAGS["Transform"],
+            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
+        )
+        LET.SubElement(
+            reference_document,
+            DS_TAGS["DigestMethod"],
+            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
+        )
+        LET.SubElement(reference_document, DS_TAGS["DigestValue"]).text = base64.b64encode(root_digest).decode("utf-8")
+
+        key_info = LET.SubElement(signature_node, DS_TAGS["KeyInfo"], {"Id": key_info_id})
+        x509_data = LET.SubElement(key_info, DS_TAGS["X509Data"])
+        LET.SubElement(x509_data, DS_TAGS["X509Certificate"]).text = self.certificate_b64
+
+        key_value = LET.SubElement(key_info, DS_TAGS["KeyValue"])
+        rsa_key_value = LET.SubElement(key_value, DS_TAGS["RSAKeyValue"])
+        LET.SubElement(rsa_key_value, DS_TAGS["Modulus"]).text = self.modulus_b64
+        LET.SubElement(rsa_key_value, DS_TAGS["Exponent"]).text = self.exponent_b64
+
+        reference_key_info = LET.SubElement(
+            signed_info,
+            DS_TAGS["Reference"],
+            {"Id": "ReferenceKeyInfo", "URI": f"#{key_info_id}"},
+        )
+        key_info_transforms = LET.SubElement(reference_key_info, DS_TAGS["Transforms"])
+        LET.SubElement(
+            key_info_transforms,
+            DS_TAGS["Transform"],
+            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
+        )
+        LET.SubElement(
+            reference_key_info,
+            DS_TAGS["DigestMethod"],
+            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
+        )
+        key_info_c14n = LET.tostring(key_info, method="c14n", exclusive=False, with_comments=False)
+        LET.SubElement(reference_key_info, DS_TAGS["DigestValue"]).text = base64.b64encode(
+            hashlib.sha256(key_info_c14n).digest()
+        ).decode("utf-8")
+
+        reference_signed_properties = LET.SubElement(
+            signed_info,
+            DS_TAGS["Reference"],
+            {
+                "Type": "http://uri.etsi.org/01903#SignedProperties",
+                "URI": f"#{signed_properties_id}",
+            },
+        )
+        signed_properties_transforms = LET.SubElement(reference_signed_properties, DS_TAGS["Transforms"])
+        LET.SubElement(
+            signed_properties_transforms,
+            DS_TAGS["Transform"],
+            {"Algorithm": "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"},
+        )
+        LET.SubElement(
+            reference_signed_properties,
+            DS_TAGS["DigestMethod"],
+            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
+        )
+        reference_signed_properties_digest = LET.SubElement(reference_signed_properties, DS_TAGS["DigestValue"])
+
+        object_node = LET.SubElement(signature_node, DS_TAGS["Object"], {"Id": f"XadesObjectId-{object_token}"})
+        qualifying_properties = LET.SubElement(
+            object_node,
+            XADES_TAGS["QualifyingProperties"],
+            {
+                "Id": f"QualifyingProperties-{qualifying_props_token}",
+                "Target": f"#{signature_id}",
+            },
+        )
+        signed_properties = LET.SubElement(
+            qualifying_properties,
+            XADES_TAGS["SignedProperties"],
+            {"Id": signed_properties_id},
+        )
+        signed_signature_properties = LET.SubElement(signed_properties, XADES_TAGS["SignedSignatureProperties"])
+        LET.SubElement(signed_signature_properties, XADES_TAGS["SigningTime"]).text = datetime.now().astimezone().replace(microsecond=0).isoformat()
+
+        signing_certificate = LET.SubElement(signed_signature_properties, XADES_TAGS["SigningCertificate"])
+        cert_node = LET.SubElement(signing_certificate, XADES_TAGS["Cert"])
+        cert_digest_node = LET.SubElement(cert_node, XADES_TAGS["CertDigest"])
+        LET.SubElement(
+            cert_digest_node,
+            DS_TAGS["DigestMethod"],
+            {"Algorithm": "http://www.w3.org/2001/04/xmlenc#sha256"},
+        )
+        LET.SubElement(cert_digest_node, DS_TAGS["DigestValue"]).text = self.certificate_digest_b64
+        issuer_serial = LET.SubElement(cert_node, XADES_TAGS["IssuerSerial"])
+        LET.SubElement(issuer_serial, DS_TAGS["X509IssuerName"]).text = self.issuer_name
+        LET.SubElement(issuer_serial, DS_TAGS["X509SerialNumber"]).text = self.serial_number
+
+        signature_policy_identifier = LET.SubElement(
+            signed_signature_properties,
+            XADES_TAGS["SignaturePolicyIdentifier"],
+        )
+        signature_policy_id = LET.SubElement(signature_policy_identifier, XADES_TAGS["SignaturePolicyId"])
+        sig_policy_id = LET.SubElement(signature_policy_id, XADES_TAGS["SigPolicyId"])
+        LET.SubElement(sig_policy_id, XADES_TAGS["Identifier"]).text = XADES_SIGNATURE_POLICY_IDENTIFIER
+        LET.SubElement(sig_policy_id, XADES_TAGS["Description"]).text = ""
+
+        sig_policy_hash = LET.SubElement(signature_policy_id, XADES_TAGS["SigPolicyHash"])
+        LET.SubElement(
+            sig_policy_hash,
+            DS_TAGS["DigestMethod"],
+            {"Algorithm": XADES_SIGNATURE_POLICY_HASH_ALGORITHM},
+        )
+        LET.SubElement(sig_policy_hash, DS_TAGS["DigestValue"]).text = XADES_SIGNATURE_POLICY_HASH
+
+        signer_role = LET.SubElement(signed_signature_properties, XADES_TAGS["SignerRole"])
+        claimed_roles = LET.SubElement(signer_role, XADES_TAGS["ClaimedRoles"])
+        LET.SubElement(claimed_roles, XADES_TAGS["ClaimedRole"]).text = "ObligadoTributario"
+
+        signed_data_object_properties = LET.SubElement(signed_properties, XADES_TAGS["SignedDataObjectProperties"])
+        data_object_format = LET.SubElement(
+            signed_data_object_properties,
+            XADES_TAGS["DataObjectFormat"],
+            {"ObjectReference": f"#{reference_id}"},
+        )
+        LET.SubElement(data_object_format, XADES_TAGS["MimeType"]).text = "text/xml"
+        LET.SubElement(data_object_format, XADES_TAGS["Encoding"]).text = "UTF-8"
+
+        signed_properties_c14n = LET.tostring(signed_properties, method="c14n", exclusive=False, with_comments=False)
+        reference_signed_properties_digest.text = base64.b64encode(hashlib.sha256(signed_properties_c14n).digest()).decode("utf-8")
+
+        signed_info_c14n = LET.tostring(signed_info, method="c14n", exclusive=False, with_comments=False)
+        signature = self.sign(signed_info_c14n)
+        signature_value_node = LET.SubElement(
+            signature_node,
+            DS_TAGS["SignatureValue"],
+            {"Id": f"SignatureValue-{signature_token}"},
+        )
+        signature_value_node.text = base64.b64encode(signature).decode("utf-8")
+        signature_node.insert(1, signature_value_node)
+
+    def sign_document(self, root):
+        """Sign ``root`` and return ``(signed_bytes, sha256 hex digest)``."""
+        self.sign_tree(root)
+        signed_bytes = LET.tostring(root, encoding="utf-8", xml_declaration=True)
+        return signed_bytes, hashlib.sha256(signed_bytes).hexdigest()
+
+
+def password_fingerprint(password):
+    """Hash the password so the cache never keys on (or keeps) it in clear text."""
+    return hashlib.sha256(password or b"").hexdigest()
+
+
+def get_signer(key, fingerprint, load_certificate):
+    """Return the signer cached under ``key``, reloading it if ``fingerprint`` changed.
+
+    ``load_certificate()`` returns ``(cert_bytes, password)`` and is only
+    called on a cache miss, so the binary is not even read when cached.
+    """
+    with _SIGNERS_LOCK:
+        cached = _SIGNERS.get(key)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+    # La apertura del PKCS#12 ocurre fuera del candado para no bloquear a otras compañías.
+    signer = XmlSigner(*load_certificate())
+    with _SIGNERS_LOCK:
+        _SIGNERS[key] = (fingerprint, signer)
+    return signer
+
+
+def invalidate_signer(key):
+    with _SIGNERS_LOCK:
+        _SIGNERS.pop(key, None)
+    _shutdown_pool(key)
+
+
+def _init_worker(cert_bytes, password):
+    global _WORKER_SIGNER
+    _WORKER_SIGNER = XmlSigner(cert_bytes, password)
+
+
+def _sign_in_worker(xml_bytes):
+    return _WORKER_SIGNER.sign_document(LET.fromstring(xml_bytes))
+
+
+def _get_pool(key, fingerprint, load_certificate, processes):
+    with _POOLS_LOCK:
+        cached = _POOLS.get(key)
+        if cached and cached[0] == (fingerprint, processes):
+            return cached[1]
+        if cached:
+            cached[1].shutdown(wait=False, cancel_futures=True)
+        cert_bytes, password = load_certificate()
+        pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=_SPAWN_CONTEXT,
+            initializer=exec,
+            initargs=(
+                _WORKER_BOOTSTRAP,
+                {"module_name": __name__, "module_path": __file__, "cert_bytes": cert_bytes, "password": password},
+            ),
+        )
+        _POOLS[key] = ((fingerprint, processes), pool)
+        return pool
+
+
+def _shutdown_pool(key):
+    with _POOLS_LOCK:
+        cached = _POOLS.pop(key, None)
+    if cached:
+        cached[1].shutdown(wait=False, cancel_futures=True)
+
+
+@atexit.register
+def shutdown_pools():
+    """Stop every signing pool of this process so no idle worker keeps a private key loaded."""
+    with _POOLS_LOCK:
+        pools = [pool for _config, pool in _POOLS.values()]
+        _POOLS.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def sign_batch(key, fingerprint, load_certificate, roots, processes=0):
+    """Sign the document trees ``roots`` and return ``(signed_bytes, sha256 hex)`` pairs in input order.
+
+    With ``processes`` > 1 and a large enough batch the documents are
+    serialized and signed by the process pool cached under ``key`` until
+    :func:`shutdown_pools`; otherwise, or if the pool breaks, they are
+    signed in this process.
+    """
+    # Abrir el certificado aquí primero da el error real antes de levantar procesos con él.
+    signer = get_signer(key, fingerprint, load_certificate)
+    if processes > 1 and len(roots) >= POOL_MIN_BATCH:
+        documents = [LET.tostring(root, encoding="utf-8") for root in roots]
+        try:
+            pool = _get_pool(key, fingerprint, load_certificate, processes)
+            return list(pool.map(_sign_in_worker, documents, chunksize=max(1, len(documents) // (processes * 4))))
+        except BrokenProcessPool:
+            _logger.warning("El pool de firma FE %s dejó de responder; se firma en el proceso actual.", key)
+            _shutdown_pool(key)
+    return [signer.sign_document(root) for root in roots]
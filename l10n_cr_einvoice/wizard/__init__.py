@@ -0,0 +1 @@
+from . import fp_mass_action_wizard
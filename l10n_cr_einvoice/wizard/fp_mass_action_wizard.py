@@ -0,0 +1,170 @@
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+FP_MASS_RESULTS = [
+    ("queued", "En cola"),
+    ("done", "Procesado"),
+    ("skipped", "Omitido"),
+    ("failed", "Fallido"),
+]
+
+
+class FpMassActionWizard(models.TransientModel):
+    _name = "fp.mass.action.wizard"
+    _description = "Envío o consulta masiva a Hacienda"
+
+    action = fields.Selection(
+        [
+            ("send", "Enviar a Hacienda"),
+            ("consult", "Consultar estado en Hacienda"),
+            ("retry", "Reactivar reintentos con Hacienda"),
+        ],
+        string="Acción",
+        required=True,
+        default="send",
+    )
+    move_ids = fields.Many2many("account.move", string="Documentos")
+    move_count = fields.Integer(string="Documentos seleccionados", compute="_compute_move_count")
+    state = fields.Selection([("draft", "Borrador"), ("running", "En proceso")], default="draft")
+    line_ids = fields.One2many("fp.mass.action.wizard.line", "wizard_id", string="Resultados")
+    queued_count = fields.Integer(string="En cola", compute="_compute_progress")
+    done_count = fields.Integer(string="Procesados", compute="_compute_progress")
+    skipped_count = fields.Integer(string="Omitidos", compute="_compute_progress")
+    failed_count = fields.Integer(string="Fallidos", compute="_compute_progress")
+    progress = fields.Float(string="Avance", compute="_compute_progress")
+
+    @api.model
+    def default_get(self, fields_list):
+        values = super().default_get(fields_list)
+        if self.env.context.get("active_model") == "account.move" and "move_ids" in fields_list:
+            values["move_ids"] = [(6, 0, self.env.context.get("active_ids", []))]
+        return values
+
+    @api.depends("move_ids")
+    def _compute_move_count(self):
+        for wizard in self:
+            wizard.move_count = len(wizard.move_ids)
+
+    @api.depends("line_ids.result")
+    def _compute_progress(self):
+        for wizard in self:
+            counts = dict.fromkeys(("queued", "done", "skipped", "failed"), 0)
+            for line in wizard.line_ids:
+                counts[line.result] += 1
+            wizard.queued_count = counts["queued"]
+            wizard.done_count = counts["done"]
+            wizard.skipped_count = counts["skipped"]
+            wizard.failed_count = counts["failed"]
+            total = len(wizard.line_ids)
+            wizard.progress = 100.0 * (total - counts["queued"]) / total if total else 0.0
+
+    def _get_skip_rules(self):
+        """Return ``(reason, domain)`` pairs; a document is skipped with the first one it matches."""
+        self.ensure_one()
+        rules = [
+            (_("El diario no está marcado como factura electrónica."), [("fp_is_electronic_invoice", "=", False)]),
+            (
+                _("Solo se permite facturación de cliente, nota de crédito o factura de compra."),
+                [("move_type", "not in", ("out_invoice", "out_refund", "in_invoice"))],
+            ),
+            (_("La factura no está publicada."), [("state", "!=", "posted")]),
+        ]
+        if self.action == "send":
+            rules.append((_("La factura ya fue enviada a Hacienda."), [("fp_api_state", "!=", "pending")]))
+        elif self.action == "retry":
+            rules += [
+                (_("La factura ya recibió una respuesta final de Hacienda."), [("fp_invoice_status", "in", ("accepted", "rejected"))]),
+                (_("La factura no tiene errores con Hacienda."), [("fp_api_state", "not in", ("error", "dead"))]),
+            ]
+        else:
+            # Las mismas condiciones que el botón "Consultar Hacienda".
+            rules += self.env["account.move"]._fp_get_consult_blocking_rules()
+        rules.append((_("El documento se está procesando en segundo plano."), [("fp_lease_until", ">", fields.Datetime.now())]))
+        return rules
+
+    def action_run(self):
+        self.ensure_one()
+        if not self.move_ids:
+            raise UserError(_("Seleccione al menos un documento."))
+        moves = self.move_ids
+        skip_reasons = {}
+        remaining = moves
+        # Cada regla es una sola consulta sobre todo el conjunto, no una validación por documento.
+        for reason, domain in self._get_skip_rules():
+            if not remaining:
+                break
+            matched = self.env["account.move"].search([("id", "in", remaining.ids), *domain])
+            skip_reasons.update(dict.fromkeys(matched.ids, reason))
+            remaining -= matched
+
+        if self.action == "send":
+            remaining._fp_enqueue_send()
+        elif self.action == "retry":
+            remaining.action_fp_retry_api()
+        else:
+            remaining._fp_enqueue_consult()
+
+        self.line_ids = [
+            (0, 0, {"move_id": move.id, "skip_reason": skip_reasons.get(move.id, False)}) for move in moves
+        ]
+        self.state = "running"
+        return self._reopen()
+
+    def action_refresh(self):
+        self.ensure_one()
+        return self._reopen()
+
+    def _reopen(self):
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+            "name": _("Envío o consulta masiva a Hacienda"),
+        }
+
+
+class FpMassActionWizardLine(models.TransientModel):
+    _name = "fp.mass.action.wizard.line"
+    _description = "Resultado de envío o consulta masiva a Hacienda"
+
+    wizard_id = fields.Many2one("fp.mass.action.wizard", required=True, ondelete="cascade")
+    move_id = fields.Many2one("account.move", string="Documento", required=True)
+    skip_reason = fields.Char(string="Motivo de omisión")
+    fp_pipeline_stage = fields.Selection(related="move_id.fp_pipeline_stage")
+    result = fields.Selection(FP_MASS_RESULTS, string="Resultado", compute="_compute_result")
+    detail = fields.Char(string="Detalle", compute="_compute_result")
+
+    @api.depends(
+        "skip_reason",
+        "wizard_id.action",
+        "move_id.fp_api_state",
+        "move_id.fp_invoice_status",
+        "move_id.fp_api_last_error",
+        "move_id.fp_next_consult_at",
+    )
+    def _compute_result(self):
+        for line in self:
+            move = line.move_id
+            if line.skip_reason:
+                line.result = "skipped"
+                line.detail = line.skip_reason
+            elif move.fp_api_state in ("error", "dead") and move.fp_invoice_status != "rejected":
+                line.result = "failed"
+                line.detail = move.fp_api_last_error
+            elif line.wizard_id.action in ("send", "retry") and move.fp_api_state != "pending":
+                line.result = "done"
+                line.detail = dict(move._fields["fp_pipeline_stage"].selection).get(move.fp_pipeline_stage)
+            elif line.wizard_id.action == "consult" and (
+                move.fp_invoice_status in ("accepted", "rejected")
+                # Tras la consulta la siguiente queda agendada después de poner el documento en cola.
+                or (move.fp_next_consult_at and move.fp_next_consult_at > line.create_date)
+                # En un documento aún no enviado la consulta atendida limpia la solicitud.
+                or (move.fp_api_state == "pending" and not move.fp_next_consult_at)
+            ):
+                line.result = "done"
+                line.detail = dict(move._fields["fp_invoice_status"].selection).get(move.fp_invoice_status)
+            else:
+                line.result = "queued"
+                line.detail = move.fp_api_last_error if move.fp_api_next_attempt_at else False